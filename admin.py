@@ -0,0 +1,106 @@
+"""
+Admin commands of a running server, over a local unix socket.
+
+Usage:
+    python admin.py metrics
+    python admin.py --socket messenger-admin-1.sock queues
+"""
+import argparse
+import os
+import socket
+import threading
+
+ADMIN_SOCKET = "messenger-admin.sock"
+MAX_COMMAND_SIZE = 4096
+
+
+def worker_path(path, worker_id):
+    """messenger-admin.sock -> messenger-admin-2.sock for worker 2."""
+    if worker_id is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{worker_id}{ext}"
+
+
+class AdminServer:
+    """
+    Answers one command per connection: the client sends a line such as
+    "metrics", gets the reply as text and the connection is closed.
+    commands maps a name to a function taking the rest of the line as a
+    list of words and returning the reply. The socket is only accessible
+    to the user running the server.
+    """
+
+    def __init__(self, path, commands):
+        self.path = path
+        self.commands = dict(commands)
+        self.commands.setdefault('help', lambda args: "\n".join(sorted(self.commands)) + "\n")
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen()
+        self.closed = False
+        threading.Thread(target=self.accept_loop, name="admin", daemon=True).start()
+
+    def accept_loop(self):
+        while not self.closed:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            with sock:
+                try:
+                    self.handle(sock)
+                except OSError as e:
+                    print(f"Admin error: {e}")
+
+    def handle(self, sock):
+        data = b""
+        while b"\n" not in data and len(data) < MAX_COMMAND_SIZE:
+            chunk = sock.recv(MAX_COMMAND_SIZE)
+            if not chunk:
+                break
+            data += chunk
+        words = data.decode('utf-8', 'replace').split()
+        if not words:
+            return
+        command = self.commands.get(words[0])
+        if command is None:
+            reply = f"unknown command: {words[0]}\n"
+        else:
+            try:
+                reply = command(words[1:])
+            except Exception as e:
+                reply = f"error: {e}\n"
+        sock.sendall(reply.encode('utf-8'))
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def request(path, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(command.encode('utf-8') + b"\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks).decode('utf-8')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=ADMIN_SOCKET)
+    parser.add_argument("command", nargs="+")
+    args = parser.parse_args()
+    print(request(args.socket, " ".join(args.command)), end="")
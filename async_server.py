@@ -0,0 +1,122 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from connection import AsyncClientConnection
+from heartbeat import WHEEL_TICK, set_keepalive
+from protocol import RECV_SIZE, StreamCodec, ProtocolError
+from server import Server
+
+
+class AsyncServer(Server):
+    """
+    Same login/message semantics as Server, but every connection is a
+    coroutine on one event loop instead of a thread blocked in recv().
+    Messages are saved by the shared group-commit writer and longer
+    queries run on a database thread, so the loop never waits on disk.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.server.setblocking(False)
+        # Set by serve(); the bus may deliver before that.
+        self.loop = None
+        # One thread, so work runs and finishes in the order it was asked for.
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    def blocking(self, work, done=None):
+        future = self.loop.run_in_executor(self.db_executor, work)
+        future.add_done_callback(lambda future: self.blocking_done(future, done))
+
+    def blocking_done(self, future, done):
+        # Back on the loop.
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"Database error: {future.exception()}")
+            return
+        if done is not None:
+            done(future.result())
+
+    def deliver(self, message_data, saved, received, connection=None):
+        # Called on the writer thread; hand the message back to the loop.
+        if saved.exception() is None and self.loop is not None and not self.loop.is_closed():
+            message_data, resent = self.stored_message(message_data, saved.result())
+            if not resent:
+                self.loop.call_soon_threadsafe(self.message_queue.put_nowait, (message_data, received))
+            elif connection is not None:
+                self.loop.call_soon_threadsafe(connection.deliver, message_data)
+
+    def receive_routed(self, message_data):
+        # Called on a bus thread; asyncio queues are not thread-safe.
+        if self.loop is None:
+            # Not serving yet: nobody is connected, but a group_changed
+            # still has to clear the cache.
+            super().receive_routed(message_data)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(super().receive_routed, message_data)
+
+    async def process_message_queue(self):
+        while True:
+            message_data, received = await self.message_queue.get()
+            self.route(message_data)
+            self.metrics.route_seconds.observe(time.perf_counter() - received)
+            self.message_queue.task_done()
+
+    async def check_heartbeats(self):
+        # On the loop, where connections may be sent to and closed.
+        while True:
+            await asyncio.sleep(WHEEL_TICK)
+            self.heartbeats.check()
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        self.metrics.connections.inc()
+        set_keepalive(writer.get_extra_info('socket'), self.heartbeats.interval, self.heartbeats.timeout)
+        connection = AsyncClientConnection(writer, address, StreamCodec(metrics=self.metrics),
+                                           **self.connection_options)
+        self.heartbeats.watch(connection)
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                connection.last_activity = time.monotonic()
+
+                for message in connection.codec.feed(data):
+                    self.handle_request(connection, message)
+
+        except ProtocolError as e:
+            self.metrics.decode_errors.inc()
+            print(f"Bad request: {e}")
+        except ConnectionResetError:
+            print("Error")
+        finally:
+            self.disconnect(connection)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.message_queue = asyncio.Queue()
+        dispatcher = asyncio.create_task(self.process_message_queue())
+        heartbeats = asyncio.create_task(self.check_heartbeats())
+        server = await asyncio.start_server(self.handle_client, sock=self.server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            dispatcher.cancel()
+            heartbeats.cancel()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server is off")
+        finally:
+            self.db_executor.shutdown()
+            self.shutdown()
+
+
+if __name__ == "__main__":
+    server = AsyncServer()
+    server.run()
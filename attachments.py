@@ -0,0 +1,146 @@
+"""
+Client side of attachment transfers. Files do not go over the chat
+connection: each upload or download is a connection of its own to the
+server's file port (see file_server.py), so a large file never holds up
+messages. Both directions resume from what a previous attempt left behind.
+"""
+import hashlib
+import json
+import os
+import re
+import socket
+
+from protocol import HEADER, ProtocolError, encode_frame
+
+# Bytes per read or write; the most either side holds of a file at once.
+CHUNK_SIZE = 256 * 1024
+MAX_ATTACHMENT_SIZE = 4 * 1024 * 1024 * 1024
+# Seconds a transfer may stall before it is given up (and resumed later).
+TRANSFER_TIMEOUT = 60
+SHA256 = re.compile(r'[0-9a-f]{64}')
+# Profile pictures are kept at the sizes the GUI shows them at: contact
+# list, own picture, profile page.
+AVATAR_SIZES = (40, 50, 120)
+MAX_AVATAR_SIZE = 512 * 1024
+# Requests and replies are a few hundred bytes.
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def hash_file(f, size, buffer=None):
+    """sha256 of the first size bytes of an open file, read in chunks."""
+    hasher = hashlib.sha256()
+    view = memoryview(buffer or bytearray(CHUNK_SIZE))
+    f.seek(0)
+    while size > 0:
+        read = f.readinto(view[:min(size, len(view))])
+        if not read:
+            break
+        hasher.update(view[:read])
+        size -= read
+    return hasher
+
+
+def file_digest(path):
+    """(sha256, size) of a file."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        return hash_file(f, size).hexdigest(), size
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """Reads one frame and nothing past it: the file's bytes may follow."""
+    (length,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if length > MAX_REQUEST_SIZE:
+        raise ProtocolError(f"frame of {length} bytes is too large")
+    try:
+        return json.loads(recv_exactly(sock, length))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ProtocolError("bad frame")
+
+
+def upload_file(host, port, username, path):
+    """
+    Sends a file unless the server already has one with the same content.
+    Returns (sha256, size), which is what a message refers to it by.
+    """
+    sha256, size = file_digest(path)
+    with socket.create_connection((host, port), TRANSFER_TIMEOUT) as sock:
+        sock.sendall(encode_frame({'type': 'upload', 'username': username, 'attachment': sha256, 'size': size}))
+        reply = read_frame(sock)
+        if reply['type'] == 'upload_ready':
+            with open(path, 'rb') as f:
+                sock.sendfile(f, reply['offset'], size - reply['offset'])
+            reply = read_frame(sock)
+        if reply['type'] != 'upload_done':
+            raise TransferError(reply.get('message', reply['type']))
+    return sha256, size
+
+
+def download_file(host, port, username, sha256, destination):
+    """
+    Fetches an attachment into destination. What has arrived so far is
+    kept in destination + '.part', so the next call carries on from there.
+    """
+    part_path = destination + '.part'
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(part_path, 'ab+') as part:
+        offset = part.tell()
+        with socket.create_connection((host, port), TRANSFER_TIMEOUT) as sock:
+            sock.sendall(encode_frame({'type': 'download', 'username': username, 'attachment': sha256,
+                                       'offset': offset}))
+            reply = read_frame(sock)
+            if reply['type'] != 'download_ready':
+                raise TransferError(reply.get('message', reply['type']))
+            size = reply['size']
+            if reply['offset'] != offset:
+                part.truncate(reply['offset'])
+                offset = reply['offset']
+            hasher = hash_file(part, offset, buffer)
+
+            remaining = size - offset
+            while remaining > 0:
+                received = sock.recv_into(view, min(remaining, CHUNK_SIZE))
+                if not received:
+                    raise ConnectionError("connection closed")
+                part.write(view[:received])
+                hasher.update(view[:received])
+                remaining -= received
+
+    if hasher.hexdigest() != sha256:
+        os.unlink(part_path)
+        raise TransferError("downloaded file does not match its hash")
+    os.replace(part_path, destination)
+    return destination
+
+
+def fetch_avatar(host, port, username, user, size, have=None):
+    """
+    One of user's scaled profile pictures. have is the avatar hash of a
+    copy the caller already has; if it is still current nothing is sent.
+    Returns (avatar, png bytes), with None as bytes when have is current,
+    or None if the user has no picture.
+    """
+    with socket.create_connection((host, port), TRANSFER_TIMEOUT) as sock:
+        sock.sendall(encode_frame({'type': 'avatar', 'username': username, 'user': user, 'size': size,
+                                   'have': have}))
+        reply = read_frame(sock)
+        if reply['type'] == 'avatar_unchanged':
+            return reply['avatar'], None
+        if reply['type'] != 'avatar_ready':
+            return None
+        return reply['avatar'], bytes(recv_exactly(sock, reply['size']))
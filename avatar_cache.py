@@ -0,0 +1,215 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+from PyQt6.QtGui import QImage, QImageReader, QPainter, QPainterPath, QPixmap
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+
+from attachments import AVATAR_SIZES, file_digest
+from database import BASE_DIR
+
+THUMBNAIL_DIR = os.path.join(BASE_DIR, "avatar_cache")
+MEMORY_CACHE_SIZE = 1024
+DECODE_THREADS = 4
+PLACEHOLDER_TEXT = "عکس"
+
+
+def avatar_path(avatar, size):
+    return os.path.join(THUMBNAIL_DIR, f"{avatar}-{size}.png")
+
+
+def thumbnail_path(key):
+    if key[0] == 'server':
+        _, _, avatar, size = key
+        return avatar_path(avatar, size)
+    _, path, mtime_ns, size = key
+    digest = hashlib.sha1(f"{path}|{mtime_ns}|{size}".encode('utf-8')).hexdigest()
+    return os.path.join(THUMBNAIL_DIR, f"{digest}.png")
+
+
+def render_circle(image, size):
+    scaled = image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
+                          Qt.TransformationMode.SmoothTransformation)
+    circle = QImage(size, size, QImage.Format.Format_ARGB32_Premultiplied)
+    circle.fill(Qt.GlobalColor.transparent)
+    painter = QPainter(circle)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    path = QPainterPath()
+    path.addEllipse(0, 0, size, size)
+    painter.setClipPath(path)
+    painter.drawImage(0, 0, scaled)
+    painter.end()
+    return circle
+
+
+def save_image(image, path):
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    temp_path = f"{path}.{id(image)}.tmp"
+    if image.save(temp_path, "PNG"):
+        os.replace(temp_path, path)
+
+
+def save_variants(path):
+    """
+    Renders a newly chosen picture at every size in AVATAR_SIZES into the
+    cache, where it is found without asking the server. Returns the
+    picture's avatar hash and {size: png path}, or None if it cannot be read.
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    original = reader.read()
+    if original.isNull():
+        return None
+    avatar, _ = file_digest(path)
+    paths = {}
+    for size in AVATAR_SIZES:
+        paths[size] = avatar_path(avatar, size)
+        save_image(render_circle(original, size), paths[size])
+    return avatar, paths
+
+
+class DecodeJob(QRunnable):
+    """
+    Loads one avatar on a pool thread. Only QImage is used here: QPixmap
+    may only be created on the GUI thread.
+    """
+
+    def __init__(self, service, key):
+        super().__init__()
+        self.service = service
+        self.key = key
+
+    def run(self):
+        cached_path = thumbnail_path(self.key)
+        image = QImage(cached_path)
+        if not image.isNull():
+            if self.key[0] == 'server':
+                self.service.latest[(self.key[1], self.key[3])] = self.key[2]
+        elif self.key[0] == 'server':
+            image = self.service.fetch(self.key)
+        else:
+            image = self.render(cached_path)
+        self.service.decoded.emit(self.key, image)
+
+    def render(self, cached_path):
+        _, path, _, size = self.key
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        original = reader.read()
+        if original.isNull():
+            return None
+        image = render_circle(original, size)
+        try:
+            save_image(image, cached_path)
+        except OSError as e:
+            print(f"Error saving avatar thumbnail: {e}")
+        return image
+
+
+class AvatarService(QObject):
+    """
+    Circular profile pictures for QLabels. Pictures come from the server
+    already scaled, named by the user's avatar hash and the size, so each
+    one is downloaded once per change and then read from THUMBNAIL_DIR.
+    Pictures from before the server kept them are local files, rendered
+    here and keyed by (path, mtime, size). Pixmaps are kept in an LRU in
+    memory; misses are loaded on a thread pool while the label shows a
+    placeholder.
+    """
+
+    decoded = pyqtSignal(object, object)
+
+    def __init__(self, parent=None, fetcher=None, max_entries=MEMORY_CACHE_SIZE):
+        super().__init__(parent)
+        # fetcher(username, size, have) -> (avatar, png bytes or None) or
+        # None, as attachments.fetch_avatar; called on pool threads.
+        self.fetcher = fetcher
+        # (username, size) -> newest avatar hash on disk.
+        self.latest = {}
+        self.max_entries = max_entries
+        self.pixmaps = OrderedDict()
+        self.waiting = {}
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(DECODE_THREADS)
+        self.decoded.connect(self.on_decoded)
+
+    def set_avatar(self, label, user, size):
+        """user is a dict with 'username', 'avatar' and 'profile_pic_path'."""
+        if user.get('avatar') and self.fetcher is not None:
+            key = ('server', user['username'], user['avatar'], size)
+        else:
+            path = user.get('profile_pic_path')
+            if not path:
+                self.show_placeholder(label, None)
+                return
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                self.show_placeholder(label, None)
+                return
+            key = ('file', path, mtime_ns, size)
+        if key in self.pixmaps:
+            self.pixmaps.move_to_end(key)
+            pixmap = self.pixmaps[key]
+            if pixmap is None:
+                self.show_placeholder(label, key)
+            else:
+                label.setProperty("avatar_key", None)
+                label.setPixmap(pixmap)
+            return
+
+        self.show_placeholder(label, key)
+        if key in self.waiting:
+            self.waiting[key].append(label)
+            return
+        self.waiting[key] = [label]
+        self.pool.start(DecodeJob(self, key))
+
+    def fetch(self, key):
+        _, username, _, size = key
+        have = self.latest.get((username, size))
+        result = self.fetcher(username, size, have)
+        if result is None:
+            return None
+        avatar, data = result
+        path = avatar_path(avatar, size)
+        if data is None:
+            image = QImage(path)
+            return None if image.isNull() else image
+        image = QImage.fromData(data, "PNG")
+        if image.isNull():
+            return None
+        try:
+            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+            temp_path = f"{path}.{id(key)}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self.latest[(username, size)] = avatar
+        except OSError as e:
+            print(f"Error saving avatar: {e}")
+        return image
+
+    def show_placeholder(self, label, key):
+        # Remembered so a late result for an older picture is not shown.
+        label.setProperty("avatar_key", thumbnail_path(key) if key else None)
+        label.setText(PLACEHOLDER_TEXT)
+
+    def on_decoded(self, key, image):
+        pixmap = QPixmap.fromImage(image) if image is not None else None
+        # A file that cannot be read stays unreadable until its mtime
+        # changes, but a failed fetch may only mean the server was away:
+        # it is tried again the next time the picture is shown.
+        if pixmap is not None or key[0] != 'server':
+            self.pixmaps[key] = pixmap
+            if len(self.pixmaps) > self.max_entries:
+                self.pixmaps.popitem(last=False)
+
+        for label in self.waiting.pop(key, []):
+            try:
+                if pixmap is not None and label.property("avatar_key") == thumbnail_path(key):
+                    label.setProperty("avatar_key", None)
+                    label.setPixmap(pixmap)
+            except RuntimeError:
+                # The label was deleted, e.g. by a contact list rebuild.
+                pass
@@ -0,0 +1,92 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+BATCH_SIZE = 256
+BATCH_DELAY = 0.002
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Write-behind stage for SQLite (group commit), on its own pooled connection.
+    Rows submitted from any thread are written by write_batch(cursor, rows)
+    and committed together in one transaction, once batch_size rows are
+    waiting or batch_delay seconds after the first one arrived. Each submit()
+    returns a Future that resolves only after its transaction has committed,
+    with the matching item of the list write_batch returned (True if it
+    returned nothing). synchronous, if given, overrides the pool's setting
+    for the writer's connection.
+    """
+
+    def __init__(self, pool, write_batch, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY, synchronous=None):
+        self.pool = pool
+        self.write_batch = write_batch
+        self.synchronous = synchronous
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = Queue()
+        self.thread = threading.Thread(target=self.run, name="batch-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, row):
+        future = Future()
+        self.pending.put((row, future))
+        return future
+
+    def collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            try:
+                item = self.pending.get_nowait()
+            except Empty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except Empty:
+                    break
+            if item is _STOP:
+                self.pending.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def commit(self, conn, batch):
+        rows = [row for row, _ in batch]
+        try:
+            cursor = conn.cursor()
+            results = self.write_batch(cursor, rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving {len(rows)} messages: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        if results is None:
+            results = [True] * len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def run(self):
+        conn = self.pool.writer()
+        if self.synchronous is not None:
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        try:
+            while True:
+                item = self.pending.get()
+                if item is _STOP:
+                    break
+                self.commit(conn, self.collect(item))
+        finally:
+            self.pool.release()
+
+    def close(self):
+        """Commits everything already submitted, then stops the writer thread."""
+        self.pending.put(_STOP)
+        self.thread.join()
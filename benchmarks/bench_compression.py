@@ -0,0 +1,156 @@
+"""
+Frame sizes and CPU cost of compressing the server's frames.
+
+Four kinds of frames are built from generated Persian chat text, with the
+fields the server really sends:
+
+- chat:    one short message
+- long:    one message of --long-chars characters
+- history: a 'history' frame of SYNC_CHUNK_SIZE messages
+- replay:  a 'replay' frame of REPLAY_BATCH_SIZE messages
+
+For each kind, --frames frames are encoded as:
+
+- escaped: JSON with \\uXXXX escapes, as the protocol used to send it
+- utf8:    JSON in raw UTF-8, as encode_frame() does now
+- deflate: utf8, every frame compressed on its own
+- stream:  utf8 through one connection's StreamCodec, so each frame is
+           compressed with the context of the ones before (what a client
+           that negotiated compression gets)
+
+and the result is printed as one JSON line: bytes per frame and the ratio
+to escaped, plus compress and decompress CPU time per frame and per chat
+message.
+
+Usage:
+    python benchmarks/bench_compression.py --frames 200
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import (StreamCodec, encode_frame, HEADER, COMPRESSION_LEVEL, COMPRESSION_MEM_LEVEL,
+                      COMPRESSION_WBITS, COMPRESSION_THRESHOLD)
+from server import REPLAY_BATCH_SIZE, SYNC_CHUNK_SIZE
+
+WORDS = ("سلام", "خوبی", "ممنون", "فردا", "جلسه", "ساعت", "کجایی", "باشه", "عالیه", "پروژه", "امروز", "خیلی",
+         "دانشگاه", "کلاس", "تمرین", "ارسال", "فایل", "ok", "hello", "thanks")
+
+
+def text(chars):
+    words = []
+    while sum(len(word) + 1 for word in words) < chars:
+        words.append(random.choice(WORDS))
+    return " ".join(words)
+
+
+def chat_message(message_id, chars):
+    sender, receiver = random.sample(("ali", "sara", "reza", "maryam"), 2)
+    return {'id': message_id, 'sender': sender, 'receiver': receiver, 'message': text(chars),
+            'timestamp': f"2024-05-{1 + message_id % 28:02d} {message_id % 24:02d}:{message_id % 60:02d}:00"}
+
+
+def build_frames(kind, count, long_chars):
+    frames = []
+    next_id = 1
+    for _ in range(count):
+        if kind in ('chat', 'long'):
+            message = chat_message(next_id, random.randint(10, 120) if kind == 'chat' else long_chars)
+            frames.append(({'type': 'message', **message}, 1))
+            next_id += 1
+            continue
+        size = SYNC_CHUNK_SIZE if kind == 'history' else REPLAY_BATCH_SIZE
+        messages = [chat_message(next_id + i, random.randint(10, 120)) for i in range(size)]
+        next_id += size
+        if kind == 'history':
+            frame = {'type': 'history', 'peer': 'sara', 'after_id': next_id - size - 1, 'messages': messages,
+                     'more': True}
+        else:
+            frame = {'type': 'replay', 'messages': messages, 'more': True}
+        frames.append((frame, size))
+    return frames
+
+
+def escaped_frame(data):
+    body = json.dumps(data).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+def compress_alone(frame):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WBITS, COMPRESSION_MEM_LEVEL)
+    body = compressor.compress(frame[HEADER.size:]) + compressor.flush()
+    return HEADER.pack(len(body)) + body
+
+
+def bench(kind, count, long_chars):
+    frames = build_frames(kind, count, long_chars)
+    messages = sum(size for _, size in frames)
+    escaped = [escaped_frame(data) for data, _ in frames]
+    utf8 = [encode_frame(data) for data, _ in frames]
+
+    started = time.process_time()
+    alone = [compress_alone(frame) for frame in utf8]
+    alone_seconds = time.process_time() - started
+
+    sender = StreamCodec(framed=True)
+    sender.enable_compression(0)
+    started = time.process_time()
+    stream = [sender.compress_frame(frame) for frame in utf8]
+    compress_seconds = time.process_time() - started
+
+    receiver = StreamCodec(framed=True)
+    receiver.enable_compression(0)
+    started = time.process_time()
+    decoded = [receiver.feed(frame)[0] for frame in stream]
+    decode_seconds = time.process_time() - started
+    plain = StreamCodec(framed=True)
+    started = time.process_time()
+    for frame in utf8:
+        plain.feed(frame)
+    parse_seconds = time.process_time() - started
+    assert decoded == [data for data, _ in frames]
+
+    def size(encoded):
+        return round(sum(map(len, encoded)) / count)
+
+    escaped_size = size(escaped)
+    return {
+        'kind': kind,
+        'messages_per_frame': messages // count,
+        'escaped_bytes': escaped_size,
+        'utf8_bytes': size(utf8),
+        'deflate_bytes': size(alone),
+        'stream_bytes': size(stream),
+        'utf8_ratio': round(escaped_size / size(utf8), 2),
+        'deflate_ratio': round(escaped_size / size(alone), 2),
+        'stream_ratio': round(escaped_size / size(stream), 2),
+        'compressed': len(utf8[0]) - HEADER.size > COMPRESSION_THRESHOLD,
+        'deflate_us_per_frame': round(alone_seconds / count * 1e6, 1),
+        'compress_us_per_frame': round(compress_seconds / count * 1e6, 1),
+        'compress_us_per_message': round(compress_seconds / messages * 1e6, 2),
+        # Decompressing and parsing, minus parsing the same frame uncompressed.
+        'decompress_us_per_message': round((decode_seconds - parse_seconds) / messages * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200, help="frames of each kind")
+    parser.add_argument("--long-chars", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for kind in ('chat', 'long', 'history', 'replay'):
+        count = args.frames if kind in ('chat', 'long') else max(1, args.frames // 20)
+        print(json.dumps(bench(kind, count, args.long_chars)))
+
+
+if __name__ == "__main__":
+    main()
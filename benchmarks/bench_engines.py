@@ -0,0 +1,159 @@
+"""
+Compares the threaded Server with AsyncServer.
+
+For each engine a fresh server process is started in a temporary directory,
+N clients log in, and two numbers are reported:
+
+- connected clients per GB of server RSS (measured after all logins)
+- messages/sec with every client sending to a partner in a closed loop
+
+Usage:
+    python benchmarks/bench_engines.py --clients 1000 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from database import DatabaseManager
+
+ENGINES = {
+    'threaded': "from server import Server; Server(port={port}, db_path={db_path!r}).run()",
+    'asyncio': "from async_server import AsyncServer; AsyncServer(port={port}, db_path={db_path!r}).run()",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def create_users(db_path, count):
+    db = DatabaseManager(db_path)
+    db.cursor.executemany(
+        "INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+        ((f"user{i}", "password", f"09{i:09d}") for i in range(count))
+    )
+    db.conn.commit()
+    db.close()
+
+
+def start_server(engine, port, workdir):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    db_path = os.path.join(workdir, 'messenger.db')
+    proc = subprocess.Popen(
+        [sys.executable, "-c", ENGINES[engine].format(port=port, db_path=db_path)],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start")
+
+
+async def login(port, username):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(json.dumps({'type': 'login', 'username': username}).encode('utf-8'))
+    await writer.drain()
+    await reader.read(1024)
+    return reader, writer
+
+
+async def chat(reader, writer, username, receiver, count):
+    # Closed loop: wait for our own echo before sending the next message, so
+    # the unframed protocol never sees two JSON objects in one read.
+    sent = 0
+    for i in range(count):
+        text = f"{username}:{i}"
+        writer.write(json.dumps({'type': 'message', 'receiver': receiver, 'message': text}).encode('utf-8'))
+        await writer.drain()
+        echo = json.dumps(text).encode('utf-8')
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return sent
+            if echo in data:
+                break
+        sent += 1
+    return sent
+
+
+async def run_clients(port, pid, clients, messages):
+    base_rss = rss_bytes(pid)
+    conns = []
+    for i in range(clients):
+        conns.append(await login(port, f"user{i}"))
+    await asyncio.sleep(0.5)
+    connected_rss = rss_bytes(pid)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        chat(reader, writer, f"user{i}", f"user{i ^ 1}", messages) for i, (reader, writer) in enumerate(conns)
+    ))
+    elapsed = time.perf_counter() - started
+
+    for _, writer in conns:
+        writer.close()
+    return base_rss, connected_rss, sum(results), elapsed
+
+
+def bench(engine, clients, messages):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        create_users(os.path.join(workdir, 'messenger.db'), clients)
+        proc = start_server(engine, port, workdir)
+        try:
+            base_rss, connected_rss, delivered, elapsed = asyncio.run(
+                run_clients(port, proc.pid, clients, messages))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    per_client = max(connected_rss - base_rss, 1) / clients
+    return {
+        'engine': engine,
+        'clients': clients,
+        'rss_mb': round(connected_rss / 2**20, 1),
+        'clients_per_gb': int(2**30 / per_client),
+        'messages': delivered,
+        'messages_per_sec': round(delivered / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each client")
+    parser.add_argument("--engine", choices=list(ENGINES), action="append")
+    args = parser.parse_args()
+
+    for engine in args.engine or list(ENGINES):
+        result = bench(engine, args.clients, args.messages)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Cost of delivering one group message to every online member.
+
+A Server is created in-process with a group of N members, all connected
+through in-memory connections (no sockets), and Server.route() is timed
+for one group message. For comparison, the same members are sent the
+message with one encode per recipient, as route() used to do.
+
+Usage:
+    python benchmarks/bench_fanout.py --members 50,500,5000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection import BaseConnection
+from protocol import StreamCodec
+from server import Server
+
+
+class MemoryConnection(BaseConnection):
+    def make_queue(self, max_queue):
+        return Queue(maxsize=max_queue)
+
+    def close(self):
+        self.closed = True
+
+
+def setup(server, members):
+    db = server.db
+    db.cursor.executemany(
+        "INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+        ((f"user{i}", "password", f"09{i:09d}") for i in range(members))
+    )
+    db.conn.commit()
+    db.create_group("bench", 1, range(2, members + 1))
+    connections = []
+    for i in range(members):
+        connection = MemoryConnection(('127.0.0.1', i), StreamCodec(framed=True), max_queue=1000000)
+        connection.username = f"user{i}"
+        server.clients[connection.username] = connection
+        connections.append(connection)
+    return connections
+
+
+def drain(connections):
+    for connection in connections:
+        connection.clear_queue()
+
+
+def bench(members, rounds):
+    with tempfile.TemporaryDirectory() as workdir:
+        server = Server(host='127.0.0.1', port=0, db_path=os.path.join(workdir, 'messenger.db'))
+        connections = setup(server, members)
+        message_data = {'type': 'message', 'id': 1, 'sender': 'user0', 'receiver': None, 'group': 'bench',
+                        'message': "سلام به همه " * 5, 'timestamp': "2024-01-01 12:00:00"}
+        server.route(message_data)
+        drain(connections)
+
+        fan_out = 0.0
+        per_recipient = 0.0
+        for _ in range(rounds):
+            started = time.perf_counter()
+            server.route(message_data)
+            fan_out += time.perf_counter() - started
+            drain(connections)
+
+            started = time.perf_counter()
+            for connection in connections:
+                connection.deliver(message_data)
+            per_recipient += time.perf_counter() - started
+            drain(connections)
+
+        server.server.close()
+        server.writer.close()
+        server.cursor_writer.close()
+        server.db.close()
+
+    return {
+        'members': members,
+        'route_ms': round(fan_out / rounds * 1000, 3),
+        'route_us_per_member': round(fan_out / rounds / members * 1e6, 3),
+        'encode_each_ms': round(per_recipient / rounds * 1000, 3),
+        'encode_each_us_per_member': round(per_recipient / rounds / members * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", default="50,500,5000", help="comma separated group sizes")
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    for members in map(int, args.members.split(',')):
+        print(json.dumps(bench(members, args.rounds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Throughput of the group-commit writer against batch size.
+
+P producer threads play connected clients: each saves a message through
+Server.save_message and waits until it is durable before sending the
+next one, like a client waiting for its own echo. The run is repeated for
+every batch size against a fresh database.
+
+Usage:
+    python benchmarks/bench_group_commit.py --producers 64 --messages 50
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import Server
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(batch_size, batch_delay, producers, messages):
+    with tempfile.TemporaryDirectory() as workdir:
+        server = Server(host='127.0.0.1', port=0, batch_size=batch_size, batch_delay=batch_delay,
+                        db_path=os.path.join(workdir, 'messenger.db'))
+        latencies = []
+
+        def produce(n):
+            for i in range(messages):
+                started = time.perf_counter()
+                server.save_message(n, n + 1, f"message {i}").result()
+                latencies.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        server.writer.close()
+        server.db.close()
+        server.server.close()
+
+    return {
+        'batch_size': batch_size,
+        'messages': len(latencies),
+        'messages_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--producers", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=50, help="messages saved by each producer")
+    parser.add_argument("--batch-delay", type=float, default=0.002)
+    parser.add_argument("--batch-sizes", default="1,4,16,64,256")
+    args = parser.parse_args()
+
+    for batch_size in map(int, args.batch_sizes.split(',')):
+        print(json.dumps(bench(batch_size, args.batch_delay, args.producers, args.messages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Chat-history reads before and after the conversation_id migration.
+
+A database is filled in the old layout (no conversation_id, created_at or
+index) with N messages between U users. Some users are much more active
+than others. The benchmark then times:
+
+- the old OR query that get_messages used, on random user pairs
+- DatabaseManager's online migration (columns, index, batched backfill)
+- get_messages on the conversation index, on the same pairs
+- the contact list: the old DISTINCT/OR join against get_conversations
+
+Usage:
+    python benchmarks/bench_history.py --rows 1000000,10000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager
+
+LEGACY_QUERY = """
+    SELECT sender_id, receiver_id, message_text, timestamp
+    FROM messages
+    WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+    ORDER BY timestamp
+"""
+
+LEGACY_CONTACTS_QUERY = """
+    SELECT DISTINCT u.id, u.username, u.profile_pic_path
+    FROM users u
+    JOIN messages m ON (u.id = m.sender_id OR u.id = m.receiver_id)
+    WHERE (m.sender_id = ? OR m.receiver_id = ?) AND u.id != ?
+"""
+
+
+def skewed_user(users):
+    return 1 + int(users * random.random() ** 3)
+
+
+def fill_legacy(db_path, users, rows, chunk=100000):
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            profile_pic_path TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.executemany("INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+                     ((f"user{i}", "password", f"09{i:09d}") for i in range(users)))
+    start = time.time() - rows
+    for offset in range(0, rows, chunk):
+        batch = []
+        for i in range(offset, min(rows, offset + chunk)):
+            sender = skewed_user(users)
+            receiver = skewed_user(users)
+            if receiver == sender:
+                receiver = sender % users + 1
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i))
+            batch.append((sender, receiver, f"message {i}", stamp))
+        conn.executemany("INSERT INTO messages (sender_id, receiver_id, message_text, timestamp) VALUES (?, ?, ?, ?)", batch)
+        conn.commit()
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(fn, pairs):
+    latencies = []
+    rows = 0
+    for args in pairs:
+        started = time.perf_counter()
+        rows += len(fn(*args))
+        latencies.append(time.perf_counter() - started)
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'avg_rows': round(rows / len(pairs), 1),
+    }
+
+
+def bench(rows, users, samples, legacy_samples):
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'messenger.db')
+        started = time.perf_counter()
+        fill_legacy(db_path, users, rows)
+        fill_seconds = time.perf_counter() - started
+
+        pairs = [(skewed_user(users), skewed_user(users)) for _ in range(samples)]
+        owners = [(user1,) for user1, _ in pairs]
+
+        conn = sqlite3.connect(db_path)
+        legacy = timed(lambda a, b: conn.execute(LEGACY_QUERY, (a, b, b, a)).fetchall(), pairs[:legacy_samples])
+        legacy_contacts = timed(lambda a: conn.execute(LEGACY_CONTACTS_QUERY, (a, a, a)).fetchall(),
+                                owners[:legacy_samples])
+        conn.close()
+
+        started = time.perf_counter()
+        db = DatabaseManager(db_path)
+        db.backfill_messages(pause=0)
+        migration_seconds = time.perf_counter() - started
+
+        indexed = timed(db.get_messages, pairs)
+        contacts = timed(db.get_conversations, owners)
+        db.close()
+
+    return {
+        'rows': rows,
+        'users': users,
+        'fill_s': round(fill_seconds, 1),
+        'migration_s': round(migration_seconds, 1),
+        'legacy_scan': legacy,
+        'conversation_index': indexed,
+        'legacy_contacts': legacy_contacts,
+        'conversations_table': contacts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000000,10000000", help="comma separated dataset sizes")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=200, help="pairs read through the index")
+    parser.add_argument("--legacy-samples", type=int, default=10, help="pairs read with the full scan")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for rows in map(int, args.rows.split(',')):
+        print(json.dumps(bench(rows, args.users, args.samples, args.legacy_samples)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Full-text search latency on a large messages table.
+
+N messages of 3-12 words between U users are inserted in chunks, each
+indexed in its own transaction by index_new_messages() like the server's
+writer does. Words follow a Zipf-like distribution over a synthetic
+Persian vocabulary, and some users are much more active than others. The benchmark then times
+DatabaseManager.search_messages for:
+
+- a common word, a rare word, two words, and a two-letter prefix
+- the second page of each (before = last id of the first page)
+- a LIKE scan over message_text, for comparison
+
+Usage:
+    python benchmarks/bench_search.py --rows 1000000,10000000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager, conversation_id
+
+LETTERS = "ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی"
+LIKE_QUERY = """
+    SELECT id FROM messages
+    WHERE (sender_id = ? OR receiver_id = ?) AND message_text LIKE ?
+    ORDER BY id DESC LIMIT ?
+"""
+
+
+def make_vocabulary(size):
+    words = set()
+    while len(words) < size:
+        words.add("".join(random.choice(LETTERS) for _ in range(random.randint(2, 7))))
+    return sorted(words)
+
+
+def zipf_word(vocabulary):
+    return vocabulary[min(len(vocabulary) - 1, int(len(vocabulary) * random.random() ** 4))]
+
+
+def skewed_user(users):
+    return 1 + int(users * random.random() ** 3)
+
+
+def fill(db, users, rows, vocabulary, chunk=50000):
+    conn = db.conn
+    conn.executemany("INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+                     ((f"user{i}", "password", f"09{i:09d}") for i in range(users)))
+    conn.commit()
+    created = int(time.time() * 1000) - rows
+    for offset in range(0, rows, chunk):
+        batch = []
+        for i in range(offset, min(rows, offset + chunk)):
+            sender = skewed_user(users)
+            receiver = skewed_user(users)
+            if receiver == sender:
+                receiver = sender % users + 1
+            text = " ".join(zipf_word(vocabulary) for _ in range(random.randint(3, 12)))
+            batch.append((sender, receiver, text, conversation_id(sender, receiver), created + i))
+        conn.executemany('''
+            INSERT INTO messages (sender_id, receiver_id, message_text, conversation_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', batch)
+        db.index_new_messages()
+        conn.commit()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(fn, cases):
+    latencies = []
+    rows = 0
+    for args in cases:
+        started = time.perf_counter()
+        rows += len(fn(*args))
+        latencies.append(time.perf_counter() - started)
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'avg_rows': round(rows / len(cases), 1),
+    }
+
+
+def bench(rows, users, samples, like_samples, limit):
+    vocabulary = make_vocabulary(20000)
+    with tempfile.TemporaryDirectory() as workdir:
+        db = DatabaseManager(os.path.join(workdir, 'messenger.db'))
+        started = time.perf_counter()
+        fill(db, users, rows, vocabulary)
+        fill_seconds = time.perf_counter() - started
+
+        queries = {
+            'common_word': lambda: vocabulary[random.randrange(10)],
+            'rare_word': lambda: vocabulary[random.randrange(len(vocabulary) // 2, len(vocabulary))],
+            'two_words': lambda: f"{zipf_word(vocabulary)} {zipf_word(vocabulary)}",
+            'prefix': lambda: random.choice(LETTERS) + random.choice(LETTERS),
+        }
+        result = {
+            'rows': rows,
+            'users': users,
+            'fill_s': round(fill_seconds, 1),
+            'insert_rows_per_s': round(rows / fill_seconds),
+        }
+        for name, make_query in queries.items():
+            cases = [(skewed_user(users), make_query(), limit) for _ in range(samples)]
+            result[name] = timed(db.search_messages, cases)
+            pages = []
+            for user_id, query, _ in cases:
+                first = db.search_messages(user_id, query, limit)
+                if len(first) == limit:
+                    pages.append((user_id, query, limit, first[-1]['id']))
+            if pages:
+                result[name + '_page2'] = timed(db.search_messages, pages)
+
+        reader = db.pool.reader()
+        cases = [(skewed_user(users), vocabulary[random.randrange(10)]) for _ in range(like_samples)]
+        result['like_scan'] = timed(
+            lambda user_id, word: reader.execute(LIKE_QUERY, (user_id, user_id, f"%{word}%", limit)).fetchall(),
+            cases)
+
+        started = time.perf_counter()
+        db.rebuild_search_index()
+        result['rebuild_s'] = round(time.perf_counter() - started, 1)
+        db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000000,10000000", help="comma separated dataset sizes")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=200, help="searches per query type")
+    parser.add_argument("--like-samples", type=int, default=5, help="searches done with a LIKE scan")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for rows in map(int, args.rows.split(',')):
+        print(json.dumps(bench(rows, args.users, args.samples, args.like_samples, args.limit)))
+
+
+if __name__ == "__main__":
+    main()
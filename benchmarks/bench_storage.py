@@ -0,0 +1,214 @@
+"""
+DatabaseManager operations at production data sizes.
+
+A messenger.db is filled with U users and N messages. Some users are much
+more active than others, and most of a user's messages go to a small
+circle of contacts. Then, for each schema variant, a copy of it is timed on:
+
+- register_user, authenticate_user, get_user_info
+- save_message (one commit each, like the GUI)
+- get_messages: the newest page of a chat, as MainWindow shows it
+- contacts: the query behind MainWindow.load_contacts
+
+Variants:
+
+- default:          the schema as DatabaseManager creates it
+- no_search:        without the full-text index
+- no_conversations: without the conversations trigger; contacts use the
+                    old DISTINCT join over messages
+- sync_full:        synchronous=FULL instead of NORMAL
+
+Each variant prints one JSON line with p50/p99 latency and operations per
+second for every operation, plus the fill rate.
+
+Usage:
+    python benchmarks/bench_storage.py --users 100000 --rows 10000000 --db /tmp/storage.db
+    python benchmarks/bench_storage.py --variant default,no_search
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_history import LEGACY_CONTACTS_QUERY
+from database import DatabaseManager, conversation_id
+
+# MainWindow.HISTORY_PAGE_SIZE; main.py needs PyQt to import.
+HISTORY_PAGE_SIZE = 50
+
+VARIANTS = ('default', 'no_search', 'no_conversations', 'sync_full')
+
+WORDS = ("سلام", "خوبی", "ممنون", "فردا", "جلسه", "ساعت", "کجایی", "باشه", "عالیه", "پروژه",
+         "hello", "ok", "thanks", "see", "you", "later", "the", "file", "is", "ready")
+
+
+def skewed_user(users):
+    return 1 + int(users * random.random() ** 3)
+
+
+def partner(sender, users):
+    # Most messages go to a few dozen contacts, some to anyone.
+    if random.random() < 0.9:
+        return 1 + (sender + int(50 * random.random() ** 2)) % users
+    receiver = skewed_user(users)
+    return receiver if receiver != sender else sender % users + 1
+
+
+def message_text():
+    return " ".join(random.choice(WORDS) for _ in range(random.randint(2, 25)))
+
+
+def fill(db_path, users, rows, chunk=100000):
+    """Bulk insert with the triggers and indexes caught up afterwards, not per row."""
+    db = DatabaseManager(db_path)
+    conn = db.conn
+    conn.executemany("INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+                     ((f"user{i}", "password", f"09{i:09d}") for i in range(users)))
+    conn.execute("DROP TRIGGER messages_update_conversations")
+    created = int(time.time() * 1000) - rows * 1000
+    for offset in range(0, rows, chunk):
+        batch = []
+        for i in range(offset, min(rows, offset + chunk)):
+            sender = skewed_user(users)
+            receiver = partner(sender, users)
+            batch.append((sender, receiver, message_text(), conversation_id(sender, receiver), created + i * 1000))
+        conn.executemany('''
+            INSERT INTO messages (sender_id, receiver_id, message_text, conversation_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+    db.rebuild_conversations()
+    db.create_conversations_table()
+    db.reset_search_state()
+    conn.commit()
+    db.index_old_messages(pause=0)
+    db.close()
+
+
+def apply_variant(db, variant):
+    if variant == 'no_search':
+        db.cursor.execute("DROP TABLE IF EXISTS messages_fts")
+        db.cursor.execute("DROP TABLE IF EXISTS search_state")
+        db.search_enabled = False
+    elif variant == 'no_conversations':
+        db.cursor.execute("DROP TRIGGER IF EXISTS messages_update_conversations")
+    elif variant == 'sync_full':
+        db.conn.execute("PRAGMA synchronous=FULL")
+    db.conn.commit()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(fn, cases):
+    latencies = []
+    rows = 0
+    # Several of these methods print on every call.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for args in cases:
+            started = time.perf_counter()
+            result = fn(*args)
+            latencies.append(time.perf_counter() - started)
+            if isinstance(result, list):
+                rows += len(result)
+    total = sum(latencies)
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'ops_per_s': round(len(cases) / total, 1) if total else None,
+        'avg_rows': round(rows / len(cases), 1),
+    }
+
+
+def chat_pairs(db, count):
+    # Real chats, picked by message, so busy chats come up more often.
+    max_id = db.cursor.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+    pairs = []
+    reader = db.pool.reader()
+    while len(pairs) < count:
+        row = reader.execute("SELECT sender_id, receiver_id FROM messages WHERE id = ?",
+                             (random.randint(1, max_id),)).fetchone()
+        if row:
+            pairs.append(row)
+    return pairs
+
+
+def bench(db_path, variant, users, samples, write_samples):
+    db = DatabaseManager(db_path)
+    apply_variant(db, variant)
+    reader = db.pool.reader()
+
+    existing = [f"user{skewed_user(users) - 1}" for _ in range(samples)]
+    pairs = chat_pairs(db, samples)
+    run = f"{variant}{time.time_ns()}"
+    result = {'variant': variant}
+
+    result['register_user'] = timed(db.register_user, [
+        (f"{run}_{i}", "password", f"{run}{i}") for i in range(write_samples)])
+    result['authenticate_user'] = timed(db.authenticate_user, [(name, "password") for name in existing])
+    result['get_user_info'] = timed(lambda name: db.get_user_info(username=name), [(name,) for name in existing])
+    result['save_message'] = timed(db.save_message, [
+        (sender, receiver, message_text()) for sender, receiver in pairs[:write_samples]])
+    result['get_messages'] = timed(lambda a, b: db.get_messages(a, b, limit=HISTORY_PAGE_SIZE), pairs)
+    owners = [(sender,) for sender, _ in pairs]
+    if variant == 'no_conversations':
+        result['contacts'] = timed(lambda a: reader.execute(LEGACY_CONTACTS_QUERY, (a, a, a)).fetchall(),
+                                   owners[:max(1, samples // 10)])
+    else:
+        result['contacts'] = timed(db.get_conversations, owners)
+    db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--variant", default=",".join(VARIANTS), help="comma separated: " + ", ".join(VARIANTS))
+    parser.add_argument("--samples", type=int, default=1000, help="calls per read operation")
+    parser.add_argument("--write-samples", type=int, default=200, help="calls per write operation")
+    parser.add_argument("--db", help="filled database to reuse; created here if missing")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    variants = args.variant.split(',')
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error(f"unknown variant: {variant}")
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        base = args.db or os.path.join(workdir, 'base.db')
+        fill_result = {'users': args.users, 'rows': args.rows}
+        if not os.path.exists(base):
+            started = time.perf_counter()
+            fill(base, args.users, args.rows)
+            fill_seconds = time.perf_counter() - started
+            fill_result.update({'fill_s': round(fill_seconds, 1),
+                                'fill_rows_per_s': round(args.rows / fill_seconds)})
+        fill_result['db_mb'] = round(os.path.getsize(base) / 2**20, 1)
+        db = DatabaseManager(base)
+        users = db.cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        db.close()
+        print(json.dumps(fill_result))
+
+        for variant in variants:
+            # Every variant gets a fresh copy, so the writes of one do not
+            # show up in the next.
+            copy = os.path.join(workdir, f"{variant}.db")
+            shutil.copyfile(base, copy)
+            print(json.dumps(bench(copy, variant, users, args.samples, args.write_samples)))
+            os.remove(copy)
+
+
+if __name__ == "__main__":
+    main()
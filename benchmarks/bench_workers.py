@@ -0,0 +1,195 @@
+"""
+Message throughput of `server.py --workers N` for several N.
+
+For each worker count a fresh server is started in a temporary directory and
+C clients log in with the framed protocol. Client i chats with client i^1;
+each sends M messages in a closed loop (the next one after its own echo)
+and the run ends when every client has received its partner's M messages.
+Partners often land on different workers, so most messages cross the
+routing bus; cross_worker_pairs reports the share from the presence table.
+
+The clients run in this process, so on a machine with few cores they
+compete with the workers for CPU.
+
+Usage:
+    python benchmarks/bench_workers.py --workers 1,2,4 --clients 200 --messages 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from database import DatabaseManager
+from protocol import RECV_SIZE, StreamCodec, encode_frame
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def create_users(db_path, count):
+    db = DatabaseManager(db_path)
+    db.cursor.executemany(
+        "INSERT INTO users (username, password, phone) VALUES (?, ?, ?)",
+        ((f"user{i}", "password", f"09{i:09d}") for i in range(count))
+    )
+    db.conn.commit()
+    db.close()
+
+
+def start_server(workers, port, db_path, workdir, use_asyncio):
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--workers", str(workers),
+               "--port", str(port), "--db", db_path]
+    if use_asyncio:
+        command.append("--asyncio")
+    # A session of its own, so the workers can be stopped with the parent.
+    proc = subprocess.Popen(
+        command,
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            # Every worker has to be listening before clients are spread out.
+            time.sleep(0.5 + 0.2 * workers)
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    stop_server(proc)
+    raise RuntimeError(f"server with {workers} workers did not start")
+
+
+def stop_server(proc):
+    # Like Ctrl+C, so the workers shut down and the bus directory is removed.
+    try:
+        os.killpg(proc.pid, signal.SIGINT)
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+async def login(port, username):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(encode_frame({'type': 'login', 'username': username}))
+    await writer.drain()
+    codec = StreamCodec(framed=True)
+    while True:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            raise RuntimeError(f"{username} was disconnected at login")
+        if any(message['type'] == 'login_success' for message in codec.feed(data)):
+            return reader, writer, codec
+
+
+async def chat(reader, writer, codec, username, receiver, count):
+    def send(i):
+        writer.write(encode_frame({'type': 'message', 'receiver': receiver, 'message': f"{username}:{i}"}))
+
+    sent = 1
+    echoed = 0
+    received = 0
+    send(0)
+    while echoed < count or received < count:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            break
+        for message in codec.feed(data):
+            if message['type'] != 'message':
+                continue
+            if message['sender'] == username:
+                echoed += 1
+                if sent < count:
+                    send(sent)
+                    sent += 1
+            else:
+                received += 1
+        await writer.drain()
+    return received
+
+
+async def run_clients(port, db_path, clients, messages, timeout):
+    conns = []
+    for i in range(clients):
+        conns.append(await login(port, f"user{i}"))
+    crossing = cross_worker_pairs(db_path, clients)
+
+    started = time.perf_counter()
+    results = await asyncio.wait_for(asyncio.gather(*(
+        chat(reader, writer, codec, f"user{i}", f"user{i ^ 1}", messages)
+        for i, (reader, writer, codec) in enumerate(conns)
+    )), timeout)
+    elapsed = time.perf_counter() - started
+
+    for _, writer, _ in conns:
+        writer.close()
+    return sum(results), elapsed, crossing
+
+
+def cross_worker_pairs(db_path, clients):
+    conn = sqlite3.connect(db_path)
+    workers = dict(conn.execute("SELECT username, worker FROM presence"))
+    conn.close()
+    pairs = [(f"user{i}", f"user{i ^ 1}") for i in range(0, clients, 2)]
+    if not workers:
+        return 0.0
+    return round(sum(workers.get(a) != workers.get(b) for a, b in pairs) / len(pairs), 2)
+
+
+def bench(workers, clients, messages, timeout, use_asyncio):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'messenger.db')
+        create_users(db_path, clients)
+        proc = start_server(workers, port, db_path, workdir, use_asyncio)
+        try:
+            delivered, elapsed, crossing = asyncio.run(run_clients(port, db_path, clients, messages, timeout))
+        finally:
+            stop_server(proc)
+
+    return {
+        'engine': 'asyncio' if use_asyncio else 'threaded',
+        'workers': workers,
+        'clients': clients,
+        'delivered': delivered,
+        'messages_per_sec': round(delivered / elapsed, 1),
+        'cross_worker_pairs': crossing,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--clients", type=int, default=200, help="an even number")
+    parser.add_argument("--messages", type=int, default=50, help="messages sent by each client")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--asyncio", action="store_true", help="run AsyncServer workers")
+    args = parser.parse_args()
+
+    print(json.dumps({'cpus': os.cpu_count()}))
+    baseline = None
+    for workers in map(int, args.workers.split(',')):
+        result = bench(workers, args.clients, args.messages, args.timeout, args.asyncio)
+        baseline = baseline or result['messages_per_sec']
+        result['speedup'] = round(result['messages_per_sec'] / baseline, 2)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
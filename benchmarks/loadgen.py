@@ -0,0 +1,333 @@
+"""
+Load generator for the messenger server.
+
+N simulated clients log in over the framed protocol and send messages at
+a fixed total rate for a given duration, then wait for what is still in
+flight. Everything runs on localhost: unless --port is given, a server is
+started in a temporary directory with users user0..user{N-1}.
+
+Receivers are chosen by --pattern:
+
+- pairs:   client i always writes to client i^1
+- random:  any other client
+- hotspot: --hot-share of the messages go to the first --hot-users
+           clients, the rest to any other client
+
+Sending is open loop. Each client sends --burst messages at once every
+burst/rate seconds. Every message carries the time it was due, not the
+time it was actually written, so a stalled client or server shows up as
+latency instead of as a lower send rate.
+
+Reported per run:
+- messages sent, delivered to their receiver, and lost (not delivered by
+  the end of --drain)
+- error frames and clients that were disconnected
+- throughput: deliveries per second, from the first send to the last
+  delivery (below the offered rate once the server falls behind)
+- end-to-end latency percentiles (due time -> receiver) and echo latency
+  (due time -> the sender's own copy, i.e. after the commit)
+
+Each run is appended as one JSON line to --output, with the git commit of
+the tree, so releases can be compared.
+
+Usage:
+    python benchmarks/loadgen.py --clients 200 --rate 2000 --duration 20
+    python benchmarks/loadgen.py --engine asyncio --pattern hotspot --burst 10
+    python benchmarks/loadgen.py --port 5555 --db messenger.db   # a running server
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from database import DatabaseManager
+from protocol import RECV_SIZE, StreamCodec, encode_frame
+
+PATTERNS = ('pairs', 'random', 'hotspot')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_users(db_path, count):
+    db = DatabaseManager(db_path)
+    db.cursor.executemany(
+        "INSERT OR IGNORE INTO users (username, password, phone) VALUES (?, ?, ?)",
+        ((f"user{i}", "password", f"09{i:09d}") for i in range(count))
+    )
+    db.conn.commit()
+    db.close()
+
+
+def start_server(args, port, db_path, workdir):
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port), "--db", db_path,
+               "--workers", str(args.workers)]
+    if args.engine == 'asyncio':
+        command.append("--asyncio")
+    proc = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            time.sleep(0.5 + 0.2 * args.workers)
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    stop_server(proc)
+    raise RuntimeError("server did not start")
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGINT)
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 3)
+
+    return {'p50_ms': at(50), 'p90_ms': at(90), 'p99_ms': at(99), 'p999_ms': at(99.9),
+            'max_ms': round(values[-1] * 1000, 3)}
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = set()
+        self.duplicates = 0
+        self.latencies = []
+        self.echo_latencies = []
+        self.last_delivery = None
+        self.errors = 0
+        self.disconnected = 0
+
+
+class SimulatedClient:
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.username = f"user{index}"
+        self.args = args
+        self.stats = stats
+        self.padding = "x" * max(0, args.size - 40)
+        self.reader = None
+        self.writer = None
+        self.codec = StreamCodec(framed=True)
+        self.closed = False
+
+    async def login(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writer.write(encode_frame({'type': 'login', 'username': self.username}))
+        await self.writer.drain()
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise RuntimeError(f"{self.username} was disconnected at login")
+            for message in self.codec.feed(data):
+                if message['type'] == 'login_success':
+                    return
+                if message['type'] == 'login_failed':
+                    raise RuntimeError(f"{self.username}: {message['message']}")
+
+    def pick_receiver(self):
+        args = self.args
+        if args.pattern == 'pairs':
+            return self.index ^ 1
+        if args.pattern == 'hotspot' and random.random() < args.hot_share:
+            receiver = random.randrange(args.hot_users)
+        else:
+            receiver = random.randrange(args.clients)
+        if receiver == self.index:
+            receiver = (receiver + 1) % args.clients
+        return receiver
+
+    async def send_loop(self, started_wall, started, end):
+        loop = asyncio.get_running_loop()
+        interval = self.args.burst * self.args.clients / self.args.rate
+        due = started + random.random() * interval
+        sequence = 0
+        while due < end and not self.closed:
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            due_wall = started_wall + (due - started)
+            frames = []
+            for _ in range(self.args.burst):
+                # "sender sequence due-time padding", parsed by the receiver.
+                text = f"{self.index} {sequence} {due_wall:.6f} {self.padding}"
+                frames.append(encode_frame({'type': 'message', 'receiver': f"user{self.pick_receiver()}",
+                                            'message': text}))
+                sequence += 1
+            try:
+                self.writer.write(b"".join(frames))
+                await self.writer.drain()
+            except ConnectionError:
+                break
+            self.stats.sent += len(frames)
+            due += interval
+
+    async def read_loop(self):
+        stats = self.stats
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                now = time.time()
+                for message in self.codec.feed(data):
+                    if message['type'] == 'error':
+                        stats.errors += 1
+                        continue
+                    if message['type'] != 'message':
+                        continue
+                    sender, sequence, due = message['message'].split(" ", 3)[:3]
+                    if message['sender'] == self.username:
+                        stats.echo_latencies.append(now - float(due))
+                        continue
+                    key = (int(sender), int(sequence))
+                    if key in stats.delivered:
+                        stats.duplicates += 1
+                    else:
+                        stats.delivered.add(key)
+                        stats.latencies.append(now - float(due))
+                        stats.last_delivery = now
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if not self.closed:
+                stats.disconnected += 1
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        if self.writer:
+            self.writer.close()
+
+
+async def run_load(args, port):
+    stats = Stats()
+    clients = [SimulatedClient(i, args, stats) for i in range(args.clients)]
+    for client in clients:
+        await client.login(port)
+
+    loop = asyncio.get_running_loop()
+    readers = [loop.create_task(client.read_loop()) for client in clients]
+    started_wall = time.time()
+    started = loop.time()
+    end = started + args.duration
+    await asyncio.gather(*(client.send_loop(started_wall, started, end) for client in clients))
+    send_seconds = loop.time() - started
+
+    # Wait for messages still in flight, or until the drain time is up.
+    drain_until = loop.time() + args.drain
+    while len(stats.delivered) < stats.sent and loop.time() < drain_until:
+        await asyncio.sleep(0.05)
+
+    for client in clients:
+        client.close()
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    deliver_seconds = (stats.last_delivery or started_wall) - started_wall
+    return stats, send_seconds, deliver_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second, all clients together")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for late deliveries")
+    parser.add_argument("--pattern", choices=PATTERNS, default='pairs')
+    parser.add_argument("--hot-users", type=int, default=5)
+    parser.add_argument("--hot-share", type=float, default=0.8)
+    parser.add_argument("--burst", type=int, default=1, help="messages each client sends at once")
+    parser.add_argument("--size", type=int, default=64, help="approximate message length in characters")
+    parser.add_argument("--engine", choices=('threaded', 'asyncio'), default='threaded')
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, help="use the server already running on this port")
+    parser.add_argument("--db", help="with --port: the server's database, to create the users in")
+    parser.add_argument("--output", default="loadgen_results.jsonl", help="file each run is appended to")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.clients < 2 or (args.pattern == 'pairs' and args.clients % 2):
+        parser.error("--clients must be an even number of at least 2")
+
+    random.seed(args.seed)
+    proc = None
+    workdir = None
+    if args.port:
+        port = args.port
+        if args.db:
+            create_users(args.db, args.clients)
+    else:
+        port = free_port()
+        workdir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(workdir.name, 'messenger.db')
+        create_users(db_path, args.clients)
+        proc = start_server(args, port, db_path, workdir.name)
+
+    try:
+        stats, send_seconds, deliver_seconds = asyncio.run(run_load(args, port))
+    finally:
+        if proc:
+            stop_server(proc)
+        if workdir:
+            workdir.cleanup()
+
+    delivered = len(stats.delivered)
+    result = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'db')},
+        'sent': stats.sent,
+        'delivered': delivered,
+        'lost': stats.sent - delivered,
+        'duplicates': stats.duplicates,
+        'errors': stats.errors,
+        'disconnected': stats.disconnected,
+        'offered_rate': args.rate,
+        'send_rate': round(stats.sent / send_seconds, 1),
+        'throughput': round(delivered / deliver_seconds, 1) if deliver_seconds > 0 else 0.0,
+        'latency': percentiles(stats.latencies),
+        'echo_latency': percentiles(stats.echo_latencies),
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import socket
+import threading
+
+from connection import ClientConnection
+from protocol import StreamCodec, ProtocolError, encode_frame
+
+# Frames waiting for one peer worker before that link is dropped.
+BUS_QUEUE_SIZE = 10000
+
+
+def socket_path(bus_dir, worker_id):
+    return os.path.join(bus_dir, f"worker-{worker_id}.sock")
+
+
+class RoutingBus:
+    """
+    Links the workers of one server (server.py --workers N) over unix
+    sockets in bus_dir. A worker sends a message to whichever worker holds
+    the recipient's connection; every peer has its own outbound queue, so a
+    busy worker only delays the messages meant for it. Frames received from
+    peers are passed to on_message on the bus threads.
+    """
+
+    def __init__(self, bus_dir, worker_id, worker_count, on_message, max_queue=BUS_QUEUE_SIZE):
+        self.bus_dir = bus_dir
+        self.worker_id = worker_id
+        self.worker_count = worker_count
+        self.on_message = on_message
+        self.max_queue = max_queue
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.path = socket_path(bus_dir, worker_id)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        threading.Thread(target=self.accept_loop, name="bus-accept", daemon=True).start()
+
+    def connect(self, worker_id):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path(self.bus_dir, worker_id))
+        except OSError:
+            sock.close()
+            raise
+        peer = ClientConnection(sock, worker_id, StreamCodec(framed=True), max_queue=self.max_queue)
+        peer.username = f"worker {worker_id}"
+        return peer
+
+    def send(self, worker_id, message_data, payload=None):
+        with self.lock:
+            peer = self.peers.get(worker_id)
+            if peer is None or peer.closed:
+                if peer is not None:
+                    peer.socket.close()
+                try:
+                    peer = self.peers[worker_id] = self.connect(worker_id)
+                except OSError as e:
+                    # The message is saved; the recipient gets it by replay.
+                    print(f"Worker {worker_id} unreachable: {e}")
+                    self.peers.pop(worker_id, None)
+                    return False
+        if payload is not None:
+            return peer.send_bytes(payload)
+        return peer.send(message_data)
+
+    def broadcast(self, message_data):
+        """Sends to every other worker, encoded once."""
+        payload = encode_frame(message_data)
+        for worker_id in range(self.worker_count):
+            if worker_id != self.worker_id:
+                self.send(worker_id, message_data, payload)
+
+    def accept_loop(self):
+        while not self.closed:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.read_loop, args=(sock,), name="bus-reader", daemon=True).start()
+
+    def read_loop(self, sock):
+        codec = StreamCodec(framed=True)
+        try:
+            while True:
+                messages = codec.recv(sock)
+                if messages is None:
+                    break
+                for message_data in messages:
+                    try:
+                        self.on_message(message_data)
+                    except Exception as e:
+                        # One bad frame must not cut this worker off for good.
+                        print(f"Bus error: {e}")
+        except (ProtocolError, OSError) as e:
+            print(f"Bus error: {e}")
+        finally:
+            sock.close()
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        with self.lock:
+            for peer in self.peers.values():
+                peer.close()
+                peer.socket.close()
+            self.peers.clear()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,163 @@
+from PyQt6.QtWidgets import QListView, QStyledItemDelegate, QAbstractItemView
+from PyQt6.QtGui import QFont, QFontMetrics, QColor, QPainter
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QRectF, QSize
+
+MessageRole = Qt.ItemDataRole.UserRole + 1
+
+BUBBLE_FONT = ("Inter", 11)
+TIMESTAMP_FONT = ("Inter", 8)
+BUBBLE_PADDING = 10
+BUBBLE_RADIUS = 10
+BUBBLE_MIN_WIDTH = 100
+# Space kept free on the other side of a bubble, like the old 50px margins.
+BUBBLE_SIDE_MARGIN = 50
+ROW_SPACING = 5
+
+SENDER_COLORS = (QColor("#50fa7b"), QColor("#282a36"))
+RECEIVER_COLORS = (QColor("#6272a4"), QColor("#f8f8f2"))
+TIMESTAMP_COLOR = QColor("#999999")
+
+
+class ChatMessage:
+    __slots__ = ('text', 'is_sender', 'timestamp', 'attachment', 'hint_width', 'hint')
+
+    def __init__(self, text, is_sender, timestamp, attachment=None):
+        self.text = text
+        self.is_sender = is_sender
+        self.timestamp = timestamp.split('.')[0]
+        # {'sha256', 'size'} of an attached file.
+        self.attachment = attachment
+        # Size of the row for the viewport width it was last measured at.
+        self.hint_width = None
+        self.hint = None
+
+
+class MessageListModel(QAbstractListModel):
+    """
+    Messages of the open chat, oldest first. Rows are plain ChatMessage
+    objects; nothing is created for them until the view paints them.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return message.text
+        if role == MessageRole:
+            return message
+        return None
+
+    def append_message(self, text, is_sender, timestamp, attachment=None):
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(ChatMessage(text, is_sender, timestamp, attachment))
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        """messages is a list of (text, is_sender, timestamp, attachment), oldest first."""
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = [ChatMessage(*message) for message in messages]
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages = []
+        self.endResetModel()
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """
+    Paints a message bubble with its timestamp underneath. Row heights
+    depend on the viewport width, so they are cached on the message and
+    measured again only after a resize.
+    """
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.font = QFont(*BUBBLE_FONT)
+        self.timestamp_font = QFont(*TIMESTAMP_FONT)
+        self.metrics = QFontMetrics(self.font)
+        self.timestamp_metrics = QFontMetrics(self.timestamp_font)
+
+    def text_size(self, text, width):
+        max_text_width = max(width - BUBBLE_SIDE_MARGIN - 2 * BUBBLE_PADDING, 1)
+        bounds = self.metrics.boundingRect(QRect(0, 0, max_text_width, 0),
+                                           Qt.TextFlag.TextWordWrap, text)
+        return bounds.width(), bounds.height()
+
+    def bubble_rect(self, rect, message):
+        text_width, text_height = self.text_size(message.text, rect.width())
+        width = max(text_width + 2 * BUBBLE_PADDING, BUBBLE_MIN_WIDTH)
+        height = text_height + 2 * BUBBLE_PADDING
+        if message.is_sender:
+            left = rect.right() - width + 1
+        else:
+            left = rect.left()
+        return QRect(left, rect.top(), width, height)
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageRole)
+        width = self.view.viewport().width()
+        if message.hint_width != width:
+            _, text_height = self.text_size(message.text, width)
+            height = (text_height + 2 * BUBBLE_PADDING + self.timestamp_metrics.height()
+                      + ROW_SPACING)
+            message.hint = QSize(width, height)
+            message.hint_width = width
+        return message.hint
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        background, foreground = SENDER_COLORS if message.is_sender else RECEIVER_COLORS
+        bubble = self.bubble_rect(option.rect, message)
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(background)
+        painter.drawRoundedRect(QRectF(bubble), BUBBLE_RADIUS, BUBBLE_RADIUS)
+
+        painter.setPen(foreground)
+        painter.setFont(self.font)
+        painter.drawText(bubble.adjusted(BUBBLE_PADDING, BUBBLE_PADDING, -BUBBLE_PADDING, -BUBBLE_PADDING),
+                         Qt.TextFlag.TextWordWrap, message.text)
+
+        timestamp_rect = QRect(option.rect.left(), bubble.bottom() + 1,
+                               option.rect.width(), self.timestamp_metrics.height())
+        align = Qt.AlignmentFlag.AlignRight if message.is_sender else Qt.AlignmentFlag.AlignLeft
+        painter.setPen(TIMESTAMP_COLOR)
+        painter.setFont(self.timestamp_font)
+        painter.drawText(timestamp_rect, align | Qt.AlignmentFlag.AlignVCenter, message.timestamp)
+        painter.restore()
+
+
+class ChatView(QListView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.message_model = MessageListModel(self)
+        self.setModel(self.message_model)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        # Re-measure rows when the width changes, and lay out long chats in
+        # batches so opening one never blocks the event loop.
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setLayoutMode(QListView.LayoutMode.Batched)
+        self.setBatchSize(200)
+        self.setStyleSheet("border: none; background: transparent;")
@@ -1,63 +1,272 @@
+import os
+import random
 import socket
-import json
+import threading
+import time
+import uuid
 from PyQt6.QtCore import QThread, pyqtSignal
 
+from attachments import TransferError, upload_file, download_file, fetch_avatar
+from heartbeat import set_keepalive
+from local_cache import Outbox
+from protocol import StreamCodec, ProtocolError, COMPRESSION
+
+SERVER_HOST = 'localhost'
+SERVER_PORT = 5555
+# Attempts at a transfer before giving up; each one resumes the last.
+TRANSFER_ATTEMPTS = 3
+TRANSFER_RETRY_DELAY = 2
+# Reconnect delays double from the first to the largest; each wait is a
+# random fraction of the current delay, so clients dropped by a server
+# restart do not all come back at the same moment.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
 class ClientThread(QThread):
     message_received = pyqtSignal(dict)  
+    history_received = pyqtSignal(dict)
+    connected = pyqtSignal()
+    # sha256 and the path it was saved to, or an empty path if it failed.
+    attachment_downloaded = pyqtSignal(str, str)
+    # The new avatar hash once the server has stored the picture.
+    avatar_set = pyqtSignal(str)
     
     def __init__(self, username):
         super().__init__()
         self.username = username
         self.client_socket = None
         self.running = False
-        
+        self.stop_event = threading.Event()
+        # True from login_success until the connection is lost; until
+        # then messages only go to the outbox.
+        self.online = False
+        # The GUI thread sends messages while this thread sends acks.
+        self.send_lock = threading.Lock()
+        self.codec = StreamCodec(framed=True)
+        self.outbox = Outbox(username)
+        # Told by the server at login.
+        self.file_port = SERVER_PORT + 1
+
     def run(self):
+        """
+        Stays connected until stop_client(): whenever the connection is
+        lost, it is made again after a jittered, growing delay, and the
+        session picks up where it stopped.
+        """
         self.running = True
+        failures = 0
+        while self.running:
+            try:
+                if self.serve():
+                    failures = 0
+                else:
+                    failures += 1
+            except ProtocolError as e:
+                print(f"Bad request: {e}")
+                failures += 1
+            except Exception as e:
+                print(f"Error {e}")
+                failures += 1
+            finally:
+                self.online = False
+                if self.client_socket:
+                    self.client_socket.close()
+            if not self.running:
+                break
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** failures)
+            if self.stop_event.wait(random.uniform(0, delay)):
+                break
+        self.outbox.close()
+
+    def serve(self):
+        """One connection, from login until it is lost. Returns whether login succeeded."""
+        logged_in = False
+        with self.send_lock:
+            self.codec = StreamCodec(framed=True)
+            self.client_socket = socket.create_connection((SERVER_HOST, SERVER_PORT))
+        set_keepalive(self.client_socket)
+
+        login_message = {
+            'type': 'login',
+            'username': self.username,
+            'replay': True,
+            'heartbeat': True,
+            'compression': [COMPRESSION]
+        }
+        # Resume where this device stopped, whatever other devices of the
+        # same user have acknowledged.
+        last_received = self.outbox.last_received()
+        if last_received is not None:
+            login_message['last_id'] = last_received
+        self.write_frame(login_message)
+        codec = self.codec
+        # Our own frames are compressed only once the server agrees.
+        codec.accept_compression()
+
+        while self.running:
+            try:
+                messages = codec.recv(self.client_socket)
+            except ConnectionResetError:
+                messages = None
+            if messages is None:
+                print("Disconnected")
+                return logged_in
+
+            last_id = None
+            for message in messages:
+                if message['type'] == 'message':
+                    if message.get('client_id') and message['sender'] == self.username:
+                        # Saved by the server: no need to send it again.
+                        self.outbox.remove(message['client_id'])
+                    self.message_received.emit(message)
+                    last_id = max(message.get('id', 0), last_id or 0)
+                elif message['type'] == 'history':
+                    self.history_received.emit(message)
+                elif message['type'] == 'login_success':
+                    if message.get('compression') == COMPRESSION:
+                        codec.enable_compression()
+                    self.file_port = message.get('file_port', self.file_port)
+                    logged_in = True
+                    self.flush_outbox()
+                    self.connected.emit()
+                elif message['type'] == 'login_failed':
+                    print(message.get('message'))
+                    self.running = False
+                elif message['type'] == 'error':
+                    if message.get('client_id'):
+                        # Refused, e.g. an unknown receiver; sending it again will not help.
+                        self.outbox.remove(message['client_id'])
+                    print(message.get('message'))
+                elif message['type'] == 'avatar_set':
+                    self.avatar_set.emit(message['avatar'])
+                elif message['type'] == 'acked':
+                    # Everything up to here has arrived, without gaps; the
+                    # newest id received may be past a message still on its way.
+                    self.outbox.set_last_received(message['id'])
+                elif message['type'] == 'heartbeat':
+                    # Any frame will do; the server only checks that we are alive.
+                    self.send({'type': 'heartbeat'})
+                elif message['type'] == 'replay':
+                    # Messages that arrived while we were offline.
+                    for missed in message['messages']:
+                        self.message_received.emit(missed)
+                    last_id = max(message['messages'][-1]['id'], last_id or 0)
+
+            # One ack per read: the server moves our delivery cursor
+            # and sends the next replay batch.
+            if last_id is not None:
+                self.send({'type': 'ack', 'id': last_id})
+        return logged_in
+
+    def flush_outbox(self):
+        # Under the lock, so a message queued meanwhile goes out after
+        # these and not in between.
+        with self.send_lock:
+            for message in self.outbox.pending():
+                self.write_frame(message)
+            self.online = True
+
+    def send_message(self, message_text, receiver):
+        message = {
+            'type': 'message',
+            'receiver': receiver,
+            'message': message_text
+        }
+        self.queue_message(message)
+
+    def queue_message(self, message):
+        """
+        Stores the message in the outbox and sends it if connected. It is
+        sent again after every reconnect until the server echoes it back;
+        the server recognizes a repeat by its client_id and saves it once.
+        """
+        message['client_id'] = uuid.uuid4().hex
+        with self.send_lock:
+            self.outbox.add(message)
+            if self.online:
+                self.write_frame(message)
+
+    def send_attachment(self, path, receiver):
+        """
+        Uploads a file on a thread of its own, then sends it as a message
+        with the file name as its text.
+        """
+        def run():
+            attachment = self.transfer(upload_file, SERVER_HOST, self.file_port, self.username, path)
+            if attachment:
+                self.queue_message({'type': 'message', 'receiver': receiver, 'message': os.path.basename(path),
+                                    'attachment': attachment[0]})
+
+        threading.Thread(target=run, name="upload", daemon=True).start()
+
+    def download_attachment(self, sha256, destination):
+        """Downloads on a thread of its own; attachment_downloaded tells when it is done."""
+        def run():
+            saved = self.transfer(download_file, SERVER_HOST, self.file_port, self.username, sha256, destination)
+            self.attachment_downloaded.emit(sha256, saved or "")
+
+        threading.Thread(target=run, name="download", daemon=True).start()
+
+    def upload_avatar(self, avatar, paths):
+        """Uploads the scaled pictures from avatar_cache.save_variants and makes them the user's avatar."""
+        def run():
+            variants = {}
+            for size, path in paths.items():
+                attachment = self.transfer(upload_file, SERVER_HOST, self.file_port, self.username, path)
+                if attachment is None:
+                    return
+                variants[str(size)] = attachment[0]
+            self.send({'type': 'set_avatar', 'avatar': avatar, 'variants': variants})
+
+        threading.Thread(target=run, name="upload", daemon=True).start()
+
+    def fetch_avatar(self, user, size, have=None):
+        """Blocking, for AvatarService's pool threads; not retried, the label keeps its placeholder."""
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect(('localhost', 5555))
-            
-
-            login_message = {
-                'type': 'login',
-                'username': self.username
-            }
-            self.client_socket.send(json.dumps(login_message).encode('utf-8'))
-            
-            while self.running:
-                try:
-                    data = self.client_socket.recv(1024).decode('utf-8')
-                    if not data:
-                        break
-                    
-                    try:
-                        message = json.loads(data)
-                        if message['type'] == 'message':
-                            self.message_received.emit(message)
-                    except json.JSONDecodeError:
-                        print("Bad request")
-                        
-                except ConnectionResetError:
-                    print("Disconnected")
-                    break
-                
-        except Exception as e:
+            return fetch_avatar(SERVER_HOST, self.file_port, self.username, user, size, have)
+        except (OSError, TransferError, ProtocolError) as e:
+            print(f"Could not fetch avatar of {user}: {e}")
+            return None
+
+    def transfer(self, function, *args):
+        for attempt in range(TRANSFER_ATTEMPTS):
+            try:
+                return function(*args)
+            except (OSError, TransferError, ProtocolError) as e:
+                print(f"Transfer failed: {e}")
+                if not isinstance(e, OSError) or attempt == TRANSFER_ATTEMPTS - 1:
+                    return None
+                time.sleep(TRANSFER_RETRY_DELAY)
+        return None
+
+    def request_sync(self, peer, after_id):
+        """Asks for the chat with peer from after_id on; the answer is a 'history' frame."""
+        self.send({'type': 'sync', 'peer': peer, 'after_id': after_id})
+
+    def send(self, message):
+        """Sends if connected; requests other than messages are not kept while offline."""
+        with self.send_lock:
+            if self.online:
+                self.write_frame(message)
+
+    def write_frame(self, message):
+        # Callers hold send_lock, or own the connection before login.
+        try:
+            frame = self.codec.encode(message)
+            if self.codec.should_compress(frame):
+                frame = self.codec.compress_frame(frame)
+            self.client_socket.sendall(frame)
+        except OSError as e:
             print(f"Error {e}")
-        finally:
-            if self.client_socket:
-                self.client_socket.close()
-    
-    def send_message(self, message_text, receiver):
-        if self.client_socket and self.running:
-            message = {
-                'type': 'message',
-                'receiver': receiver,
-                'message': message_text
-            }
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
 
     
     def stop_client(self):
         self.running = False
+        self.stop_event.set()
         if self.client_socket:
+            try:
+                # Wakes run() from recv(); close() alone may not.
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.client_socket.close()
\ No newline at end of file
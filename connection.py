@@ -0,0 +1,227 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+from queue import Queue, Empty, Full
+
+OUTBOUND_QUEUE_SIZE = 1000
+
+# What to do with a client whose outbound queue is full:
+# - 'disconnect' closes it; every message is already in the database, so it
+#   can catch up after reconnecting.
+# - 'drop' discards the new message and keeps the connection.
+SLOW_CONSUMER_POLICIES = ('disconnect', 'drop')
+
+
+class BaseConnection:
+    """
+    Outbound side of one client: a bounded queue of encoded frames drained by
+    its own writer, so a slow receiver only ever delays itself.
+    """
+
+    def __init__(self, address, codec, max_queue=OUTBOUND_QUEUE_SIZE, policy='disconnect', metrics=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.address = address
+        self.codec = codec
+        self.policy = policy
+        self.metrics = metrics
+        self.username = None
+        self.user_id = None
+        self.closed = False
+        self.dropped = 0
+        # Read by HeartbeatMonitor: when the peer last sent anything, and
+        # whether it answers heartbeats.
+        self.connected_at = self.last_activity = time.monotonic()
+        self.heartbeat = False
+        self.heartbeat_sent = 0.0
+        self.outbound = self.make_queue(max_queue)
+        # While offline messages are replayed, live ones wait in `held` so
+        # the client sees everything in id order.
+        self.replaying = False
+        self.replay_position = 0
+        self.held = []
+        self.replay_lock = threading.Lock()
+        self.compress_lock = threading.Lock()
+        # Ids of the messages queued for the client, in the order they
+        # were queued, until an ack covers them; then they move to
+        # `received`. acked_position is the id up to which the client has
+        # everything meant for it (see Server.acknowledge).
+        self.unacked = collections.deque()
+        self.received = set()
+        self.acked_position = 0
+        self.track_lock = threading.Lock()
+
+    def send(self, data):
+        return self.send_bytes(self.codec.encode(data))
+
+    def send_bytes(self, payload):
+        if self.closed:
+            return False
+        if self.codec.should_compress(payload):
+            # Compressed and queued in one step, so frames leave in the
+            # order the client's decompressor expects.
+            with self.compress_lock:
+                return self.enqueue(self.codec.compress_frame(payload), compressed=True)
+        return self.enqueue(payload)
+
+    def enqueue(self, payload, compressed=False):
+        try:
+            self.outbound.put_nowait(payload)
+            return True
+        except (Full, asyncio.QueueFull):
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.dropped.inc()
+            # Without the dropped frame the client could not decompress the
+            # ones after it, whatever the policy.
+            if self.policy == 'disconnect' or compressed:
+                print(f"{self.username} is too slow, disconnecting")
+                self.close()
+            return False
+
+    def deliver(self, message_data, payloads=None):
+        """
+        Sends a live message, or holds it until the replay has finished.
+        Callers sending one message to many connections pass the same
+        payloads dict, so it is encoded once per protocol, not once per
+        recipient.
+        """
+        with self.replay_lock:
+            if self.replaying:
+                if len(self.held) >= self.outbound.maxsize:
+                    # The client stopped acknowledging the replay.
+                    self.dropped += 1
+                    if self.metrics is not None:
+                        self.metrics.dropped.inc()
+                    self.close()
+                    return False
+                self.held.append(message_data)
+                return True
+        if payloads is None:
+            return self.send_messages(message_data, [message_data['id']])
+        payload = payloads.get(self.codec.framed)
+        if payload is None:
+            payload = payloads[self.codec.framed] = self.codec.encode(message_data)
+        return self.send_messages(message_data, [message_data['id']], payload)
+
+    def send_messages(self, data, ids, payload=None):
+        """Sends a frame carrying the messages with these ids, and remembers them until acknowledged."""
+        with self.track_lock:
+            sent = self.send(data) if payload is None else self.send_bytes(payload)
+            if sent:
+                self.unacked.extend(ids)
+            return sent
+
+    def confirm(self, message_id):
+        """
+        The client acknowledged message_id, so it has every frame queued
+        up to that one; messages queued later may still have lower ids.
+        """
+        with self.track_lock:
+            if message_id not in self.unacked:
+                return
+            while True:
+                queued = self.unacked.popleft()
+                self.received.add(queued)
+                if queued == message_id:
+                    break
+
+    def finish_replay(self):
+        with self.replay_lock:
+            self.replaying = False
+            held, self.held = self.held, []
+            for message_data in held:
+                # Already part of the replay, which has everything sent to
+                # this user and to its groups by others.
+                replayed = (message_data['receiver'] == self.username or
+                            ('group' in message_data and message_data['sender'] != self.username))
+                if replayed and message_data['id'] <= self.replay_position:
+                    continue
+                self.send_messages(message_data, [message_data['id']])
+
+    def queue_depth(self):
+        return self.outbound.qsize()
+
+    def clear_queue(self):
+        try:
+            while True:
+                self.outbound.get_nowait()
+        except (Empty, asyncio.QueueEmpty):
+            pass
+
+    def wake_writer(self):
+        self.clear_queue()
+        try:
+            self.outbound.put_nowait(None)
+        except (Full, asyncio.QueueFull):
+            # Something was queued meanwhile; the writer wakes on it and
+            # sees that the connection is closed.
+            pass
+
+
+class ClientConnection(BaseConnection):
+    def __init__(self, client_socket, address, codec, **kwargs):
+        super().__init__(address, codec, **kwargs)
+        self.socket = client_socket
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def make_queue(self, max_queue):
+        return Queue(maxsize=max_queue)
+
+    def write_loop(self):
+        while True:
+            payload = self.outbound.get()
+            if payload is None or self.closed:
+                break
+            try:
+                self.socket.sendall(payload)
+            except OSError:
+                self.close()
+                break
+            if self.metrics is not None:
+                self.metrics.bytes_sent.inc(len(payload))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Wakes the reader thread blocked in recv(); it closes the socket.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.wake_writer()
+
+
+class AsyncClientConnection(BaseConnection):
+    def __init__(self, writer, address, codec, **kwargs):
+        super().__init__(address, codec, **kwargs)
+        self.writer = writer
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+
+    def make_queue(self, max_queue):
+        return asyncio.Queue(maxsize=max_queue)
+
+    async def write_loop(self):
+        while True:
+            payload = await self.outbound.get()
+            if payload is None or self.closed:
+                break
+            try:
+                self.writer.write(payload)
+                await self.writer.drain()
+            except ConnectionError:
+                self.close()
+                break
+            if self.metrics is not None:
+                self.metrics.bytes_sent.inc(len(payload))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self.wake_writer()
@@ -1,23 +1,225 @@
 import sqlite3
 import os
+import re
+import threading
+import time
+import weakref
+from datetime import datetime
+from pathlib import Path
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = os.path.join(BASE_DIR, 'messenger.db') 
 
+# NORMAL is safe with WAL: a crash can lose the last commits but never
+# corrupts the file, and commits no longer wait for fsync.
+SYNCHRONOUS = 'NORMAL'
+# Except for the server's message writer: a message is delivered once its
+# batch has committed, so that commit has to survive a power loss too.
+DURABLE_SYNCHRONOUS = 'FULL'
+CACHE_SIZE_KB = 16 * 1024
+BUSY_TIMEOUT_MS = 5000
+
+MIGRATION_BATCH_SIZE = 5000
+
+# Characters of the last message kept for the contact list.
+PREVIEW_LENGTH = 100
+
+# Rows indexed per transaction when the search index is built for old messages.
+SEARCH_INDEX_BATCH_SIZE = 20000
+
+# Folded the same way in the index and in queries: Arabic letter forms to
+# their Persian ones, Persian and Arabic digits to ASCII, ZWNJ, tatweel and
+# harakat removed (unicode61 would otherwise split words on them).
+SEARCH_NORMALIZATION = {'ي': 'ی', 'ى': 'ی', 'ك': 'ک', '\u200c': '', '\u0640': ''}
+SEARCH_NORMALIZATION.update({chr(c): '' for c in range(0x064B, 0x0653)})
+SEARCH_NORMALIZATION['\u0670'] = ''
+SEARCH_NORMALIZATION.update({chr(0x06F0 + i): str(i) for i in range(10)})
+SEARCH_NORMALIZATION.update({chr(0x0660 + i): str(i) for i in range(10)})
+SEARCH_TRANSLATION = str.maketrans(SEARCH_NORMALIZATION)
+SEARCH_TOKEN = re.compile(r'[^\W_]+')
+
+# SQL versions of conversation_id() and now_ms(), used to backfill old rows.
+CONVERSATION_ID_SQL = "(MIN(sender_id, receiver_id) << 32) | MAX(sender_id, receiver_id)"
+CREATED_AT_SQL = "CAST(strftime('%s', timestamp) AS INTEGER) * 1000"
+
+
+def conversation_id(user1_id, user2_id):
+    """Key of a one-to-one chat, the same in both directions."""
+    low, high = sorted((user1_id, user2_id))
+    return (low << 32) | high
+
+
+def group_conversation_id(group_id):
+    """Key of a group chat. One-to-one keys are all above 2**32, so they never collide."""
+    return group_id
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+# Group messages are stored once, with receiver_id GROUP_RECEIVER_ID.
+GROUP_RECEIVER_ID = 0
+
+# Messages as the server sends them to clients: usernames instead of ids.
+WIRE_MESSAGE_SQL = """
+    SELECT m.id, s.username, r.username, m.message_text,
+           COALESCE(m.created_at, CAST(strftime('%s', m.timestamp) AS INTEGER) * 1000), g.name,
+           m.attachment, a.size
+    FROM messages m
+    JOIN users s ON s.id = m.sender_id
+    LEFT JOIN users r ON r.id = m.receiver_id
+    LEFT JOIN chat_groups g ON g.id = m.group_id
+    LEFT JOIN attachments a ON a.sha256 = m.attachment
+"""
+
+# The participants column of the search index: both users of a chat, or the group.
+SEARCH_PARTICIPANTS_SQL = """
+    CASE WHEN group_id IS NULL THEN 'u' || sender_id || ' u' || receiver_id ELSE 'g' || group_id END
+"""
+
+
+def normalize_search_text(text):
+    # Also registered as the SQL function search_normalize() on every
+    # pooled connection; the search trigger calls it.
+    if text is None:
+        return None
+    return text.translate(SEARCH_TRANSLATION)
+
+
+def search_query(user_id, text, group_ids=()):
+    """
+    FTS5 query for messages of user_id, or of the groups group_ids,
+    containing words that start with every word of text, or None if text
+    has no words.
+    """
+    words = SEARCH_TOKEN.findall(normalize_search_text(text))
+    if not words:
+        return None
+    terms = " AND ".join(f'"{word}"*' for word in words)
+    chats = " OR ".join([f'"u{user_id}"'] + [f'"g{group_id}"' for group_id in group_ids])
+    return f'body : ({terms}) AND participants : ({chats})'
+
+
+def wire_messages(rows):
+    messages = []
+    for row in rows:
+        message = {
+            'type': 'message',
+            'id': row[0],
+            'sender': row[1],
+            'receiver': row[2],
+            'message': row[3],
+            'timestamp': datetime.fromtimestamp(row[4] / 1000).strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if row[5] is not None:
+            message['group'] = row[5]
+        if row[6] is not None:
+            message['attachment'] = {'sha256': row[6], 'size': row[7]}
+        messages.append(message)
+    return messages
+
+
+def read_message(cursor, message_id):
+    """One message in wire format, read through cursor, e.g. inside a write transaction."""
+    return wire_messages(cursor.execute(f"{WIRE_MESSAGE_SQL} WHERE m.id = ?", (message_id,)).fetchall())[0]
+
+
+class PooledConnection(sqlite3.Connection):
+    # Plain sqlite3.Connection objects cannot be weakly referenced.
+    pass
+
+
+class ConnectionManager:
+    """
+    Gives every thread its own SQLite connections to one database file in WAL
+    mode: a read-write one, and a read-only one for history queries. WAL lets
+    those readers run while another thread is inserting messages.
+    """
+
+    def __init__(self, db_path=DB_NAME, synchronous=SYNCHRONOUS, cache_size_kb=CACHE_SIZE_KB):
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.local = threading.local()
+        # Weak, so a connection goes away with the thread that owned it.
+        self.connections = weakref.WeakSet()
+        self.lock = threading.Lock()
+        # journal_mode is stored in the file, so setting it once is enough.
+        self.writer().execute("PRAGMA journal_mode=WAL")
+
+    def open(self, read_only=False):
+        if read_only:
+            conn = sqlite3.connect(Path(self.db_path).absolute().as_uri() + "?mode=ro", uri=True,
+                                   check_same_thread=False, factory=PooledConnection)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=PooledConnection)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.create_function("search_normalize", 1, normalize_search_text, deterministic=True)
+        with self.lock:
+            self.connections.add(conn)
+        return conn
+
+    def writer(self):
+        conn = getattr(self.local, 'writer', None)
+        if conn is None:
+            conn = self.local.writer = self.open()
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, 'reader', None)
+        if conn is None:
+            conn = self.local.reader = self.open(read_only=True)
+        return conn
+
+    def cursor(self):
+        """The calling thread's cursor on its read-write connection."""
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            cursor = self.local.cursor = self.writer().cursor()
+        return cursor
+
+    def release(self):
+        """Closes the calling thread's connections, e.g. when a handler thread ends."""
+        for name in ('cursor', 'writer', 'reader'):
+            conn = self.local.__dict__.pop(name, None)
+            if conn is not None and name != 'cursor':
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in list(self.connections):
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
 class DatabaseManager:
-    def __init__(self):
-        self.conn = None
+    def __init__(self, db_path=DB_NAME):
+        self.db_path = db_path
+        self.pool = None
+        self.backfilled = False
+        self.search_enabled = False
         self.connect()
         self.create_tables()
 
+    @property
+    def conn(self):
+        return self.pool.writer()
+
+    @property
+    def cursor(self):
+        return self.pool.cursor()
+
     def connect(self):
-        if self.conn:
-            self.conn.close()
+        if self.pool:
+            self.pool.close()
         try:
-            self.conn = sqlite3.connect(DB_NAME)
-            self.cursor = self.conn.cursor()
-            print(f"Connected to database: {DB_NAME}")
+            self.pool = ConnectionManager(self.db_path)
+            print(f"Connected to database: {self.db_path}")
         except sqlite3.Error as e:
             print(f"Database connection error: {e}")
 
@@ -37,6 +239,8 @@ class DatabaseManager:
                     profile_pic_path TEXT
                 )
             ''')
+            self.add_missing_columns('users', {'avatar': 'TEXT'})
+            legacy = self.rename_legacy_server_messages()
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -44,15 +248,378 @@ class DatabaseManager:
                     receiver_id INTEGER NOT NULL,
                     message_text TEXT NOT NULL,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    conversation_id INTEGER,
+                    created_at INTEGER,
                     FOREIGN KEY (sender_id) REFERENCES users(id),
                     FOREIGN KEY (receiver_id) REFERENCES users(id)
                 )
             ''')
+            self.add_missing_columns('messages', {'conversation_id': 'INTEGER', 'created_at': 'INTEGER',
+                                                  'group_id': 'INTEGER', 'attachment': 'TEXT', 'client_id': 'TEXT'})
+            # A chat's history is one range scan: rowid order is arrival order.
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation
+                ON messages (conversation_id, id)
+            ''')
+            # Offline delivery reads a user's inbox from their cursor onwards.
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_receiver
+                ON messages (receiver_id, id)
+            ''')
+            # A resent message is found by the id its client gave it, and
+            # saved once per sender.
+            self.cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client
+                ON messages (sender_id, client_id) WHERE client_id IS NOT NULL
+            ''')
+            self.create_groups_tables()
+            self.create_attachments_table()
+            self.create_avatars_table()
+            self.create_conversations_table()
+            self.create_delivery_cursors_table()
+            self.create_presence_table()
+            self.create_search_index()
+            if legacy:
+                self.import_legacy_server_messages()
             self.conn.commit()
             print("Tables created successfully or already exist.")
         except sqlite3.Error as e:
             print(f"Error creating tables: {e}")
 
+    def create_conversations_table(self):
+        """
+        One row per user and chat partner with the newest message and the
+        number of unread messages, so the contact list never scans
+        'messages'. A trigger keeps it up to date in the same transaction as
+        every insert, whichever code path does the insert.
+        """
+        exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'").fetchone()
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id INTEGER NOT NULL,
+                peer_id INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                last_message_preview TEXT,
+                last_activity INTEGER,
+                unread_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, peer_id)
+            ) WITHOUT ROWID
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conversations_activity
+            ON conversations (user_id, last_activity DESC)
+        ''')
+        # Group messages are not part of any one-to-one chat.
+        trigger = self.cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_update_conversations'").fetchone()
+        if trigger and 'group_id' not in trigger[0]:
+            self.cursor.execute("DROP TRIGGER messages_update_conversations")
+        self.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS messages_update_conversations
+            AFTER INSERT ON messages
+            WHEN NEW.group_id IS NULL
+            BEGIN
+                INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_preview, last_activity)
+                VALUES (NEW.sender_id, NEW.receiver_id, NEW.id, substr(NEW.message_text, 1, {PREVIEW_LENGTH}),
+                        COALESCE(NEW.created_at, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000))
+                ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_message_preview = excluded.last_message_preview,
+                    last_activity = excluded.last_activity;
+                INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_preview, last_activity, unread_count)
+                SELECT NEW.receiver_id, NEW.sender_id, NEW.id, substr(NEW.message_text, 1, {PREVIEW_LENGTH}),
+                       COALESCE(NEW.created_at, CAST(strftime('%s', NEW.timestamp) AS INTEGER) * 1000), 1
+                WHERE NEW.receiver_id != NEW.sender_id
+                ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_message_preview = excluded.last_message_preview,
+                    last_activity = excluded.last_activity,
+                    unread_count = unread_count + 1;
+            END
+        ''')
+        if not exists:
+            self.rebuild_conversations()
+
+    def create_groups_tables(self):
+        """
+        Group chats and their members. A group message is one row in
+        'messages' however many members there are.
+        """
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_groups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                owner_id INTEGER NOT NULL,
+                created_at INTEGER,
+                FOREIGN KEY (owner_id) REFERENCES users(id)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                group_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (group_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_group_members_user
+            ON group_members (user_id, group_id)
+        ''')
+
+    def create_attachments_table(self):
+        """
+        Files attached to messages, stored once per content hash (see
+        file_server.py). A row is only added once the whole file is on disk.
+        """
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attachments (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                uploader_id INTEGER,
+                created_at INTEGER
+            ) WITHOUT ROWID
+        ''')
+        # Download checks look for a message carrying the file.
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_attachment
+            ON messages (attachment) WHERE attachment IS NOT NULL
+        ''')
+
+    def create_avatars_table(self):
+        """
+        The scaled copies of each user's profile picture, stored as
+        attachments. users.avatar is the sha256 of the picture they were
+        made from, so it changes whenever the picture does.
+        """
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS avatars (
+                user_id INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (user_id, size)
+            ) WITHOUT ROWID
+        ''')
+
+    def create_search_index(self):
+        """
+        Full-text index over message text. It is contentless: only the
+        normalized terms are stored, plus both participants as 'u<id>'
+        tokens (a group as 'g<id>') so a search never leaves the user's own
+        messages.
+        Writers call index_new_messages() in the transaction of each batch,
+        which is cheaper than a per-row trigger. Messages that existed
+        before the index are added by index_old_messages().
+        """
+        exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        try:
+            self.cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    body, participants, content='', prefix='2 3', detail=column,
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5: everything but search still works.
+            print(f"Search is disabled: {e}")
+            return
+        self.search_enabled = True
+        # indexed_id: every message up to it has been indexed by a writer.
+        # backfill_*: the range of older messages still to be indexed.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_state (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                indexed_id INTEGER NOT NULL,
+                backfill_next_id INTEGER,
+                backfill_end_id INTEGER
+            )
+        ''')
+        if not exists:
+            self.reset_search_state()
+
+    def reset_search_state(self):
+        self.cursor.execute("DELETE FROM search_state")
+        self.cursor.execute('''
+            INSERT INTO search_state (id, indexed_id, backfill_next_id, backfill_end_id)
+            SELECT 0, COALESCE(MAX(id), 0), MIN(id), MAX(id) FROM messages
+        ''')
+
+    def index_new_messages(self, cursor=None):
+        """
+        Indexes every message above indexed_id. Call it in the same
+        transaction as the inserts; a writer that did not is caught up by
+        the next call.
+        """
+        if not self.search_enabled:
+            return
+        cursor = cursor or self.cursor
+        row = cursor.execute("SELECT indexed_id FROM search_state").fetchone()
+        if row is None:
+            return
+        cursor.execute(f'''
+            INSERT INTO messages_fts (rowid, body, participants)
+            SELECT id, search_normalize(message_text), {SEARCH_PARTICIPANTS_SQL}
+            FROM messages WHERE id > ?
+        ''', row)
+        if cursor.rowcount:
+            cursor.execute("UPDATE search_state SET indexed_id = (SELECT MAX(id) FROM messages)")
+
+    def index_old_messages(self, batch_size=SEARCH_INDEX_BATCH_SIZE, pause=0.01):
+        """
+        Adds messages from before the search index existed, one short
+        transaction per batch. Progress is stored, so it resumes after a
+        restart.
+        """
+        if not self.search_enabled:
+            return 0
+        total = 0
+        try:
+            while True:
+                row = self.cursor.execute("SELECT backfill_next_id, backfill_end_id FROM search_state").fetchone()
+                if row is None or row[0] is None or row[0] > row[1]:
+                    break
+                next_id, end_id = row
+                last_id = min(next_id + batch_size - 1, end_id)
+                self.cursor.execute(f'''
+                    INSERT INTO messages_fts (rowid, body, participants)
+                    SELECT id, search_normalize(message_text), {SEARCH_PARTICIPANTS_SQL}
+                    FROM messages WHERE id BETWEEN ? AND ?
+                ''', (next_id, last_id))
+                total += self.cursor.rowcount
+                self.cursor.execute("UPDATE search_state SET backfill_next_id = ?", (last_id + 1,))
+                self.conn.commit()
+                time.sleep(pause)
+        except sqlite3.Error as e:
+            print(f"Error indexing messages for search: {e}")
+            return total
+        if total:
+            print(f"Indexed {total} messages for search.")
+        return total
+
+    def rebuild_search_index(self, batch_size=SEARCH_INDEX_BATCH_SIZE):
+        """Drops every indexed term and indexes all messages again."""
+        if not self.search_enabled:
+            return 0
+        self.cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+        self.reset_search_state()
+        self.conn.commit()
+        return self.index_old_messages(batch_size, pause=0)
+
+    def create_delivery_cursors_table(self):
+        """
+        The id of the newest message each user has acknowledged. Users who
+        exist when the table is first created start at the current newest
+        message, since their clients already read history from the database.
+        """
+        exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'delivery_cursors'").fetchone()
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS delivery_cursors (
+                user_id INTEGER PRIMARY KEY,
+                last_delivered_id INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if not exists:
+            self.cursor.execute('''
+                INSERT INTO delivery_cursors (user_id, last_delivered_id)
+                SELECT id, (SELECT COALESCE(MAX(id), 0) FROM messages) FROM users
+            ''')
+
+    def create_presence_table(self):
+        """Which server worker holds each online user's connection (server.py --workers)."""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS presence (
+                username TEXT PRIMARY KEY,
+                worker INTEGER NOT NULL
+            )
+        ''')
+
+    def rebuild_conversations(self):
+        """Recomputes 'conversations' from 'messages'; unread counts start at zero."""
+        self.cursor.execute("DELETE FROM conversations")
+        self.cursor.execute(f'''
+            INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_preview, last_activity)
+            SELECT p.user_id, p.peer_id, m.id, substr(m.message_text, 1, {PREVIEW_LENGTH}),
+                   COALESCE(m.created_at, CAST(strftime('%s', m.timestamp) AS INTEGER) * 1000)
+            FROM (
+                SELECT user_id, peer_id, MAX(last_id) AS last_id FROM (
+                    SELECT sender_id AS user_id, receiver_id AS peer_id, MAX(id) AS last_id
+                    FROM messages WHERE group_id IS NULL GROUP BY sender_id, receiver_id
+                    UNION ALL
+                    SELECT receiver_id, sender_id, MAX(id)
+                    FROM messages WHERE group_id IS NULL GROUP BY sender_id, receiver_id
+                ) GROUP BY user_id, peer_id
+            ) p
+            JOIN messages m ON m.id = p.last_id
+        ''')
+        if self.cursor.rowcount:
+            print(f"Built {self.cursor.rowcount} conversation entries from existing messages.")
+
+    def add_missing_columns(self, table, columns):
+        existing = [row[1] for row in self.cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+        for name, column_type in columns.items():
+            if name not in existing:
+                self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def backfill_messages(self, batch_size=MIGRATION_BATCH_SIZE, pause=0.01):
+        """
+        Fills conversation_id and created_at on rows written before those
+        columns existed. Each batch is its own short transaction, so the
+        server keeps inserting while an old database is migrated.
+        """
+        total = 0
+        try:
+            while True:
+                self.cursor.execute(f'''
+                    UPDATE messages
+                    SET conversation_id = {CONVERSATION_ID_SQL},
+                        created_at = COALESCE(created_at, {CREATED_AT_SQL})
+                    WHERE id IN (SELECT id FROM messages WHERE conversation_id IS NULL LIMIT ?)
+                ''', (batch_size,))
+                updated = self.cursor.rowcount
+                self.conn.commit()
+                if not updated:
+                    break
+                total += updated
+                time.sleep(pause)
+        except sqlite3.Error as e:
+            print(f"Error migrating messages: {e}")
+            return total
+        self.backfilled = True
+        if total:
+            print(f"Migrated {total} messages to conversation keys.")
+        return total
+
+    def needs_backfill(self):
+        if not self.backfilled:
+            row = self.pool.reader().execute("SELECT 1 FROM messages WHERE conversation_id IS NULL LIMIT 1").fetchone()
+            self.backfilled = row is None
+        return not self.backfilled
+
+    def rename_legacy_server_messages(self):
+        """
+        The server used to keep its own 'messages' table, keyed by usernames,
+        in the same file. Moves it aside so the shared table can be created.
+        """
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(messages)").fetchall()]
+        if 'sender' not in columns:
+            return False
+        self.cursor.execute("ALTER TABLE messages RENAME TO legacy_server_messages")
+        return True
+
+    def import_legacy_server_messages(self):
+        self.cursor.execute('''
+            INSERT INTO messages (sender_id, receiver_id, message_text, timestamp)
+            SELECT s.id, r.id, m.message, m.timestamp
+            FROM legacy_server_messages m
+            JOIN users s ON s.username = m.sender
+            JOIN users r ON r.username = m.receiver
+            ORDER BY m.id
+        ''')
+        self.index_new_messages()
+        # The old table is kept: rows whose users are unknown here are not lost.
+        print(f"Imported {self.cursor.rowcount} messages from the old server table.")
 
     def register_user(self, username, password, phone):
         try:
@@ -71,13 +638,14 @@ class DatabaseManager:
 
     def authenticate_user(self, username, password):
         try:
-            self.cursor.execute("SELECT id, username, phone, profile_pic_path FROM users WHERE username = ? AND password = ?",
+            self.cursor.execute("SELECT id, username, phone, profile_pic_path, avatar FROM users WHERE username = ? AND password = ?",
                                 (username, password))
             user_data = self.cursor.fetchone()
             if user_data:
-                user_id, username, phone, profile_pic_path = user_data
+                user_id, username, phone, profile_pic_path, avatar = user_data
                 print(f"User '{username}' authenticated successfully. ID: {user_id}")
-                return {"id": user_id, "username": username, "phone": phone, "profile_pic_path": profile_pic_path}
+                return {"id": user_id, "username": username, "phone": phone, "profile_pic_path": profile_pic_path,
+                        "avatar": avatar}
             else:
                 print("Authentication failed: Invalid username or password.")
                 return None
@@ -88,17 +656,18 @@ class DatabaseManager:
     def get_user_info(self, user_id=None, username=None, phone=None):
         try:
             if user_id:
-                self.cursor.execute("SELECT id, username, phone, profile_pic_path FROM users WHERE id = ?", (user_id,))
+                self.cursor.execute("SELECT id, username, phone, profile_pic_path, avatar FROM users WHERE id = ?", (user_id,))
             elif username:
-                self.cursor.execute("SELECT id, username, phone, profile_pic_path FROM users WHERE username = ?", (username,))
+                self.cursor.execute("SELECT id, username, phone, profile_pic_path, avatar FROM users WHERE username = ?", (username,))
             elif phone:
-                self.cursor.execute("SELECT id, username, phone, profile_pic_path FROM users WHERE phone = ?", (phone,))
+                self.cursor.execute("SELECT id, username, phone, profile_pic_path, avatar FROM users WHERE phone = ?", (phone,))
             else:
                 return None
 
             user_data = self.cursor.fetchone()
             if user_data:
-                return {"id": user_data[0], "username": user_data[1], "phone": user_data[2], "profile_pic_path": user_data[3]}
+                return {"id": user_data[0], "username": user_data[1], "phone": user_data[2], "profile_pic_path": user_data[3],
+                        "avatar": user_data[4]}
             else:
                 return None
         except sqlite3.Error as e:
@@ -150,14 +719,15 @@ class DatabaseManager:
         try:
             if timestamp:
                 self.cursor.execute('''
-                    INSERT INTO messages (sender_id, receiver_id, message_text, timestamp)
-                    VALUES (?, ?, ?, ?)
-                ''', (sender_id, receiver_id, message_text, timestamp))
+                    INSERT INTO messages (sender_id, receiver_id, message_text, timestamp, conversation_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, CAST(strftime('%s', ?) AS INTEGER) * 1000)
+                ''', (sender_id, receiver_id, message_text, timestamp, conversation_id(sender_id, receiver_id), timestamp))
             else:
                 self.cursor.execute('''
-                    INSERT INTO messages (sender_id, receiver_id, message_text)
-                    VALUES (?, ?, ?)
-                ''', (sender_id, receiver_id, message_text))
+                    INSERT INTO messages (sender_id, receiver_id, message_text, conversation_id, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (sender_id, receiver_id, message_text, conversation_id(sender_id, receiver_id), now_ms()))
+            self.index_new_messages()
             self.conn.commit()
             return True
         except Exception as e:
@@ -165,31 +735,363 @@ class DatabaseManager:
             return False
         
         
-    def get_messages(self, user1_id, user2_id):
+    def get_messages(self, user1_id, user2_id, before_id=None, limit=None):
+        """
+        Returns a chat in id order. With a limit, only the newest `limit`
+        messages older than before_id are read (keyset paging, no OFFSET).
+        """
         try:
-            self.cursor.execute("""
-                SELECT sender_id, receiver_id, message_text, timestamp
+            if self.needs_backfill():
+                # Old rows are still being migrated; fall back to a full scan.
+                where = "((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))"
+                params = [user1_id, user2_id, user2_id, user1_id]
+            else:
+                where = "conversation_id = ?"
+                params = [conversation_id(user1_id, user2_id)]
+            if before_id is not None:
+                where += " AND id < ?"
+                params.append(before_id)
+            query = f"""
+                SELECT id, sender_id, receiver_id, message_text, timestamp
                 FROM messages
-                WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
-                ORDER BY timestamp
-            """, (user1_id, user2_id, user2_id, user1_id))
+                WHERE {where}
+                ORDER BY id DESC
+            """
+            if limit is not None:
+                query += " LIMIT ?"
+                params.append(limit)
+            cursor = self.pool.reader().execute(query, params)
             messages = []
-            for row in self.cursor.fetchall():
+            for row in reversed(cursor.fetchall()):
                 messages.append({
-                    "sender_id": row[0],
-                    "receiver_id": row[1],
-                    "message_text": row[2],
-                    "timestamp": row[3]
+                    "id": row[0],
+                    "sender_id": row[1],
+                    "receiver_id": row[2],
+                    "message_text": row[3],
+                    "timestamp": row[4]
                 })
             return messages
         except sqlite3.Error as e:
             print(f"Error getting messages: {e}")
             return []
 
+    def search_messages(self, user_id, query, limit=50, before=None):
+        """
+        The user's messages matching every word of query (as a prefix),
+        newest first. Pass the smallest id of a page as `before` to get
+        the next one. Group messages have 'group' set and no receiver.
+        """
+        if not self.search_enabled:
+            return []
+        try:
+            reader = self.pool.reader()
+            group_ids = [row[0] for row in reader.execute(
+                "SELECT group_id FROM group_members WHERE user_id = ?", (user_id,))]
+            match = search_query(user_id, query, group_ids)
+            if match is None:
+                return []
+            where = "messages_fts MATCH ?"
+            params = [match]
+            if before is not None:
+                where += " AND f.rowid < ?"
+                params.append(before)
+            params.append(limit)
+            cursor = reader.execute(f'''
+                SELECT m.id, m.sender_id, m.receiver_id, s.username, r.username, m.message_text, m.timestamp,
+                       g.name
+                FROM messages_fts f
+                CROSS JOIN messages m ON m.id = f.rowid
+                JOIN users s ON s.id = m.sender_id
+                LEFT JOIN users r ON r.id = m.receiver_id
+                LEFT JOIN chat_groups g ON g.id = m.group_id
+                WHERE {where}
+                ORDER BY f.rowid DESC
+                LIMIT ?
+            ''', params)
+            return [{
+                "id": row[0],
+                "sender_id": row[1],
+                "receiver_id": row[2],
+                "sender": row[3],
+                "receiver": row[4],
+                "message_text": row[5],
+                "timestamp": row[6],
+                "group": row[7]
+            } for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Error searching messages: {e}")
+            return []
+
+    def get_user_id(self, username):
+        row = self.pool.reader().execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def add_attachment(self, sha256, size, uploader_id):
+        try:
+            self.cursor.execute("INSERT OR IGNORE INTO attachments (sha256, size, uploader_id, created_at) VALUES (?, ?, ?, ?)",
+                                (sha256, size, uploader_id, now_ms()))
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error adding attachment: {e}")
+            return False
+
+    def get_attachment_size(self, sha256):
+        """Size of a stored attachment, or None if it has not been fully uploaded."""
+        row = self.pool.reader().execute("SELECT size FROM attachments WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def can_read_attachment(self, user_id, sha256):
+        """Whether user_id uploaded the file or can see a message carrying it."""
+        row = self.pool.reader().execute('''
+            SELECT 1 FROM attachments a
+            WHERE a.sha256 = ? AND (a.uploader_id = ? OR EXISTS (
+                SELECT 1 FROM messages m
+                WHERE m.attachment = a.sha256
+                  AND (m.sender_id = ? OR m.receiver_id = ?
+                       OR m.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+            ))
+        ''', (sha256, user_id, user_id, user_id, user_id)).fetchone()
+        return row is not None
+
+    def set_avatar(self, user_id, avatar, variants):
+        """Replaces the user's picture; variants maps each size to the sha256 of its attachment."""
+        try:
+            self.cursor.execute("UPDATE users SET avatar = ? WHERE id = ?", (avatar, user_id))
+            self.cursor.execute("DELETE FROM avatars WHERE user_id = ?", (user_id,))
+            self.cursor.executemany("INSERT INTO avatars (user_id, size, sha256) VALUES (?, ?, ?)",
+                                    [(user_id, size, sha256) for size, sha256 in variants.items()])
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            print(f"Error setting avatar: {e}")
+            return False
+
+    def get_avatar(self, username, size):
+        """(avatar, sha256, bytes) of one of the user's scaled pictures, or None if they have none."""
+        return self.pool.reader().execute('''
+            SELECT u.avatar, v.sha256, a.size FROM users u
+            JOIN avatars v ON v.user_id = u.id AND v.size = ?
+            JOIN attachments a ON a.sha256 = v.sha256
+            WHERE u.username = ?
+        ''', (size, username)).fetchone()
+
+    def get_delivery_cursor(self, user_id):
+        row = self.pool.reader().execute("SELECT last_delivered_id FROM delivery_cursors WHERE user_id = ?",
+                                         (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def set_presence(self, username, worker):
+        try:
+            self.cursor.execute('''
+                INSERT INTO presence (username, worker) VALUES (?, ?)
+                ON CONFLICT (username) DO UPDATE SET worker = excluded.worker
+            ''', (username, worker))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating presence: {e}")
+
+    def clear_presence(self, username, worker):
+        """Removes the entry unless the user has logged in on another worker since."""
+        try:
+            self.cursor.execute("DELETE FROM presence WHERE username = ? AND worker = ?", (username, worker))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating presence: {e}")
+
+    def clear_worker_presence(self, worker):
+        """Drops what a previous run of this worker left behind."""
+        try:
+            self.cursor.execute("DELETE FROM presence WHERE worker = ?", (worker,))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating presence: {e}")
+
+    def get_presence(self, username):
+        row = self.pool.reader().execute("SELECT worker FROM presence WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def get_undelivered_messages(self, user_id, after_id, limit):
+        """
+        Messages to user_id, and to the user's groups from other members,
+        with an id above after_id, oldest first, in the same shape the
+        server uses for live messages.
+        """
+        try:
+            cursor = self.pool.reader().execute(f'''
+                SELECT * FROM (
+                    {WIRE_MESSAGE_SQL}
+                    WHERE m.receiver_id = ? AND m.id > ?
+                    ORDER BY m.id
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    {WIRE_MESSAGE_SQL}
+                    WHERE m.conversation_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+                      AND m.sender_id != ? AND m.id > ?
+                    ORDER BY m.id
+                    LIMIT ?
+                )
+                ORDER BY 1
+                LIMIT ?
+            ''', (user_id, after_id, limit, user_id, user_id, after_id, limit, limit))
+            return wire_messages(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f"Error getting undelivered messages: {e}")
+            return []
+
+    def get_inbox_ids(self, user_id, after_id, up_to_id):
+        """Ids of the messages get_undelivered_messages covers in (after_id, up_to_id], ascending; None on error."""
+        try:
+            rows = self.pool.reader().execute('''
+                SELECT id FROM messages WHERE receiver_id = ? AND id > ? AND id <= ?
+                UNION
+                SELECT id FROM messages
+                WHERE conversation_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+                  AND sender_id != ? AND id > ? AND id <= ?
+                ORDER BY 1
+            ''', (user_id, after_id, up_to_id, user_id, user_id, after_id, up_to_id)).fetchall()
+            return [row[0] for row in rows]
+        except sqlite3.Error as e:
+            print(f"Error getting inbox ids: {e}")
+            return None
+
+    def get_messages_after(self, user1_id, user2_id, after_id, limit):
+        """One chat's messages with an id above after_id, oldest first, in wire format."""
+        try:
+            if self.needs_backfill():
+                where = "((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))"
+                params = [user1_id, user2_id, user2_id, user1_id]
+            else:
+                where = "m.conversation_id = ?"
+                params = [conversation_id(user1_id, user2_id)]
+            cursor = self.pool.reader().execute(f'''
+                {WIRE_MESSAGE_SQL}
+                WHERE {where} AND m.id > ?
+                ORDER BY m.id
+                LIMIT ?
+            ''', params + [after_id, limit])
+            return wire_messages(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f"Error getting messages: {e}")
+            return []
+
+    def get_group_messages_after(self, group_id, after_id, limit):
+        """Like get_messages_after, for a group chat."""
+        try:
+            cursor = self.pool.reader().execute(f'''
+                {WIRE_MESSAGE_SQL}
+                WHERE m.conversation_id = ? AND m.id > ?
+                ORDER BY m.id
+                LIMIT ?
+            ''', (group_conversation_id(group_id), after_id, limit))
+            return wire_messages(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f"Error getting messages: {e}")
+            return []
+
+    def get_conversations(self, user_id):
+        """The user's chat partners, most recently active first."""
+        try:
+            cursor = self.pool.reader().execute('''
+                SELECT u.id, u.username, u.profile_pic_path,
+                       c.last_message_preview, c.last_activity, c.unread_count, u.avatar
+                FROM conversations c
+                JOIN users u ON u.id = c.peer_id
+                WHERE c.user_id = ? AND c.peer_id != c.user_id
+                ORDER BY c.last_activity DESC
+            ''', (user_id,))
+            return [{"id": row[0], "username": row[1], "profile_pic_path": row[2],
+                     "last_message": row[3], "last_activity": row[4], "unread_count": row[5], "avatar": row[6]}
+                    for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Error getting conversations: {e}")
+            return []
+
+    def mark_conversation_read(self, user_id, peer_id):
+        try:
+            self.cursor.execute("UPDATE conversations SET unread_count = 0 WHERE user_id = ? AND peer_id = ? AND unread_count != 0",
+                                (user_id, peer_id))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error updating conversation: {e}")
+
+    def create_group(self, name, owner_id, member_ids=()):
+        """Creates a group with its owner as a member. Returns its id, or None if the name is taken."""
+        try:
+            self.cursor.execute("INSERT INTO chat_groups (name, owner_id, created_at) VALUES (?, ?, ?)",
+                                (name, owner_id, now_ms()))
+            group_id = self.cursor.lastrowid
+            self.cursor.executemany("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)",
+                                    [(group_id, user_id) for user_id in {owner_id, *member_ids}])
+            self.conn.commit()
+            return group_id
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            print(f"Error creating group: {e}")
+            return None
+
+    def add_group_member(self, group_id, user_id):
+        try:
+            self.cursor.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)",
+                                (group_id, user_id))
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error adding group member: {e}")
+            return False
+
+    def remove_group_member(self, group_id, user_id):
+        try:
+            self.cursor.execute("DELETE FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            print(f"Error removing group member: {e}")
+            return False
+
+    def get_group_id(self, name):
+        row = self.pool.reader().execute("SELECT id FROM chat_groups WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_group_members(self, group_id):
+        """Usernames of the group's members."""
+        cursor = self.pool.reader().execute('''
+            SELECT u.username FROM group_members gm
+            JOIN users u ON u.id = gm.user_id
+            WHERE gm.group_id = ?
+        ''', (group_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_user_groups(self, user_id):
+        cursor = self.pool.reader().execute('''
+            SELECT g.id, g.name FROM group_members gm
+            JOIN chat_groups g ON g.id = gm.group_id
+            WHERE gm.user_id = ?
+            ORDER BY g.name
+        ''', (user_id,))
+        return [{"id": row[0], "name": row[1]} for row in cursor.fetchall()]
+
     def close(self):
-        if self.conn:
-            self.conn.close()
+        if self.pool:
+            self.pool.close()
             print("Database connection closed.")
 
 
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance tasks for the messenger database.")
+    parser.add_argument("--db", default=DB_NAME)
+    parser.add_argument("--rebuild-search-index", action="store_true",
+                        help="index every message again for full-text search")
+    args = parser.parse_args()
 
+    manager = DatabaseManager(args.db)
+    if args.rebuild_search_index:
+        started = time.time()
+        count = manager.rebuild_search_index()
+        print(f"Search index rebuilt: {count} messages in {time.time() - started:.1f}s")
+    manager.close()
@@ -0,0 +1,227 @@
+import fcntl
+import os
+import socket
+import threading
+
+from attachments import AVATAR_SIZES, CHUNK_SIZE, MAX_ATTACHMENT_SIZE, SHA256, TRANSFER_TIMEOUT, hash_file, read_frame
+from protocol import ProtocolError, encode_frame
+
+# Fields of each request and their types; all are required except these.
+REQUEST_FIELDS = {
+    'upload': {'username': str, 'attachment': str, 'size': int},
+    'download': {'username': str, 'attachment': str, 'offset': int},
+    'avatar': {'username': str, 'user': str, 'size': int, 'have': str},
+}
+OPTIONAL_FIELDS = ('offset', 'have')
+
+
+def valid_request(request):
+    if not isinstance(request, dict) or request.get('type') not in REQUEST_FIELDS:
+        return False
+    for field, kind in REQUEST_FIELDS[request['type']].items():
+        value = request.get(field)
+        if value is None and field in OPTIONAL_FIELDS:
+            continue
+        # bool is an int subclass, but never a size or an offset.
+        if not isinstance(value, kind) or isinstance(value, bool):
+            return False
+    return True
+
+
+class AttachmentStore:
+    """
+    Attachments on disk, named by their sha256: directory/ab/abcd...
+    Uploads in progress are written to directory/partial/<sha256>.part and
+    renamed into place once their hash has been checked, so a stored file
+    is always complete.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'partial'), exist_ok=True)
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def part_path(self, sha256):
+        return os.path.join(self.directory, 'partial', f"{sha256}.part")
+
+    def open_part(self, sha256):
+        """
+        The partial file of an upload, opened for appending, or None while
+        another connection (in this or another worker) is uploading it.
+        """
+        part = open(self.part_path(sha256), 'ab+')
+        try:
+            fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            part.close()
+            return None
+        return part
+
+    def complete(self, sha256, part):
+        os.makedirs(os.path.dirname(self.path(sha256)), exist_ok=True)
+        part.flush()
+        os.replace(self.part_path(sha256), self.path(sha256))
+
+
+class FileServer:
+    """
+    Uploads and downloads of attachments, one connection each, on a port of
+    their own so a large file never holds up chat traffic; works the same
+    beside either engine. A connection sends one framed request and then
+    the file's bytes flow:
+
+    upload {'username', 'attachment': sha256, 'size'}
+        -> upload_done if the server already has the file, otherwise
+           upload_ready {'offset'}; the client sends the bytes from offset on
+           and gets upload_done once the hash checks out.
+    download {'username', 'attachment': sha256, 'offset'}
+        -> download_ready {'size', 'offset'} followed by the bytes from
+           offset on, sent with sendfile() straight from the page cache.
+    avatar {'username', 'user', 'size', 'have'}
+        -> avatar_unchanged if have is still user's avatar hash, otherwise
+           avatar_ready {'avatar', 'size'} followed by the picture at that
+           size. Every user may fetch every picture.
+
+    A dropped upload keeps what arrived; the next attempt resumes there.
+    Neither direction holds more than CHUNK_SIZE bytes of a file in memory.
+    """
+
+    def __init__(self, host, port, store, db, reuse_port=False, metrics=None):
+        self.store = store
+        self.db = db
+        self.metrics = metrics
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.closed = False
+        threading.Thread(target=self.accept_loop, name="file_server", daemon=True).start()
+
+    def accept_loop(self):
+        while not self.closed:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(sock, address), daemon=True,
+                             name=f"transfer {address[0]}:{address[1]}").start()
+
+    def handle(self, sock, address):
+        try:
+            with sock:
+                sock.settimeout(TRANSFER_TIMEOUT)
+                request = read_frame(sock)
+                if not valid_request(request):
+                    self.error(sock, 'درخواست نامعتبر است')
+                elif request['type'] == 'upload':
+                    self.upload(sock, request)
+                elif request['type'] == 'download':
+                    self.download(sock, request)
+                elif request['type'] == 'avatar':
+                    self.avatar(sock, request)
+        except (OSError, ProtocolError) as e:
+            print(f"Transfer from {address[0]}:{address[1]} stopped: {e}")
+        finally:
+            self.db.pool.release()
+
+    def error(self, sock, message):
+        sock.sendall(encode_frame({'type': 'error', 'message': message}))
+
+    def upload(self, sock, request):
+        sha256, size = request['attachment'], request['size']
+        if not SHA256.fullmatch(sha256) or not 0 <= size <= MAX_ATTACHMENT_SIZE:
+            self.error(sock, 'فایل نامعتبر است')
+            return
+        user_id = self.db.get_user_id(request['username'])
+        if user_id is None:
+            self.error(sock, 'کاربر یافت نشد')
+            return
+        stored = self.db.get_attachment_size(sha256)
+        if stored is not None and self.store.exists(sha256):
+            # Same content already uploaded by someone: nothing to send.
+            if stored == size:
+                sock.sendall(encode_frame({'type': 'upload_done', 'attachment': sha256, 'size': size}))
+            else:
+                self.error(sock, 'فایل نامعتبر است')
+            return
+
+        part = self.store.open_part(sha256)
+        if part is None:
+            self.error(sock, 'این فایل در حال ارسال است')
+            return
+        with part:
+            offset = part.tell()
+            if offset > size:
+                part.truncate(0)
+                offset = 0
+            buffer = bytearray(CHUNK_SIZE)
+            # What is already on disk is hashed first, then the rest as it arrives.
+            hasher = hash_file(part, offset, buffer)
+            sock.sendall(encode_frame({'type': 'upload_ready', 'attachment': sha256, 'offset': offset}))
+
+            remaining = size - offset
+            view = memoryview(buffer)
+            while remaining > 0:
+                received = sock.recv_into(view, min(remaining, CHUNK_SIZE))
+                if not received:
+                    return
+                part.write(view[:received])
+                hasher.update(view[:received])
+                remaining -= received
+                if self.metrics is not None:
+                    self.metrics.attachment_bytes_received.inc(received)
+
+            if hasher.hexdigest() != sha256:
+                os.unlink(self.store.part_path(sha256))
+                self.error(sock, 'فایل دریافتی با هش آن مطابقت ندارد')
+                return
+            self.store.complete(sha256, part)
+        self.db.add_attachment(sha256, size, user_id)
+        if self.metrics is not None:
+            self.metrics.attachments_stored.inc()
+        sock.sendall(encode_frame({'type': 'upload_done', 'attachment': sha256, 'size': size}))
+
+    def download(self, sock, request):
+        sha256, offset = request['attachment'], request.get('offset') or 0
+        user_id = self.db.get_user_id(request['username'])
+        if user_id is None or not self.db.can_read_attachment(user_id, sha256):
+            self.error(sock, 'فایل یافت نشد')
+            return
+        size = self.db.get_attachment_size(sha256)
+        if not 0 <= offset <= size:
+            offset = 0
+        with open(self.store.path(sha256), 'rb') as f:
+            sock.sendall(encode_frame({'type': 'download_ready', 'attachment': sha256, 'size': size,
+                                       'offset': offset}))
+            sent = sock.sendfile(f, offset, size - offset)
+        if self.metrics is not None:
+            self.metrics.attachment_bytes_sent.inc(sent)
+
+    def avatar(self, sock, request):
+        variant = None
+        if request['size'] in AVATAR_SIZES and self.db.get_user_id(request['username']) is not None:
+            variant = self.db.get_avatar(request['user'], request['size'])
+        if variant is None:
+            self.error(sock, 'عکس پروفایل یافت نشد')
+            return
+        avatar, sha256, size = variant
+        if request.get('have') == avatar:
+            sock.sendall(encode_frame({'type': 'avatar_unchanged', 'avatar': avatar}))
+            return
+        with open(self.store.path(sha256), 'rb') as f:
+            sock.sendall(encode_frame({'type': 'avatar_ready', 'avatar': avatar, 'size': size}))
+            sent = sock.sendfile(f)
+        if self.metrics is not None:
+            self.metrics.attachment_bytes_sent.inc(sent)
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
@@ -0,0 +1,124 @@
+import math
+import socket
+import threading
+import time
+
+# Seconds without a frame from a client before it is sent a heartbeat.
+HEARTBEAT_INTERVAL = 30
+# Seconds a client has to answer a heartbeat before it is disconnected.
+HEARTBEAT_TIMEOUT = 15
+# Resolution of the idle checks.
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 64
+
+HEARTBEAT = {'type': 'heartbeat'}
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: deadlines are rounded up to whole ticks and kept
+    in one of `slots` buckets, so scheduling costs the same however many
+    timers there are, and advance() only looks at the buckets whose tick
+    has come. Deadlines more than one turn ahead wait in their bucket for
+    the right turn. Safe to use from several threads.
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, item, deadline):
+        with self.lock:
+            tick = max(math.ceil(deadline / self.tick), self.current + 1)
+            self.slots[tick % len(self.slots)].append((tick, item))
+
+    def advance(self, now):
+        """Returns the items whose deadline is at or before now."""
+        target = int(now / self.tick)
+        due = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                index = self.current % len(self.slots)
+                waiting = []
+                for tick, item in self.slots[index]:
+                    if tick <= self.current:
+                        due.append(item)
+                    else:
+                        waiting.append((tick, item))
+                self.slots[index] = waiting
+        return due
+
+
+class HeartbeatMonitor:
+    """
+    Finds dead and idle connections. Every connection is checked once
+    after it is accepted and then whenever its next deadline comes up:
+
+    - one that has not logged in within `interval` seconds is closed;
+    - a client that asked for heartbeats at login is sent one after
+      `interval` seconds without a frame from it, and closed if nothing
+      arrives within `timeout` more;
+    - older clients do not answer heartbeats, so only TCP keepalive
+      (set_keepalive) finds out when they are gone.
+
+    Reads only stamp connection.last_activity; the wheel is not touched
+    per message. The checks run wherever check() is called from, which
+    has to be where the connection may be sent to and closed.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, metrics=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.metrics = metrics
+        self.wheel = TimerWheel()
+
+    def watch(self, connection):
+        self.wheel.schedule(connection, connection.connected_at + self.interval)
+
+    def check(self, now=None):
+        now = time.monotonic() if now is None else now
+        for connection in self.wheel.advance(now):
+            deadline = self.next_check(connection, now)
+            if deadline is not None:
+                self.wheel.schedule(connection, deadline)
+
+    def next_check(self, connection, now):
+        if connection.closed:
+            return None
+        if connection.username is None:
+            if now - connection.connected_at >= self.interval:
+                self.reap(connection, "did not log in")
+                return None
+            return connection.connected_at + self.interval
+        if not connection.heartbeat:
+            return None
+
+        idle = now - connection.last_activity
+        if idle >= self.interval + self.timeout:
+            self.reap(connection, "did not answer the heartbeat")
+            return None
+        if idle >= self.interval:
+            if connection.heartbeat_sent < connection.last_activity:
+                connection.heartbeat_sent = now
+                connection.send(HEARTBEAT)
+            return connection.last_activity + self.interval + self.timeout
+        return connection.last_activity + self.interval
+
+    def reap(self, connection, reason):
+        print(f"Closing {connection.username or connection.address}: {reason}")
+        if self.metrics is not None:
+            self.metrics.reaped.inc()
+        connection.close()
+
+
+def set_keepalive(sock, idle=HEARTBEAT_INTERVAL, interval=HEARTBEAT_TIMEOUT, count=3):
+    """Lets the kernel probe an idle peer after idle seconds and drop it after count unanswered probes."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux only; elsewhere the system defaults (hours) apply.
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval / count)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+import threading
+
+from database import BASE_DIR
+
+CACHE_DIR = os.path.join(BASE_DIR, "local_cache")
+
+
+class LocalCache:
+    """
+    The client's own copy of its chats, filled from the server's history
+    frames and live messages. synced_id is the id up to which a chat is
+    known to be complete, so the next sync only asks for what came after.
+    """
+
+    def __init__(self, user_id, cache_dir=CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"user_{user_id}.db")
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                peer TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TEXT,
+                attachment TEXT,
+                attachment_size INTEGER
+            )
+        ''')
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(messages)").fetchall()]
+        if 'attachment' not in columns:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+            self.conn.execute("ALTER TABLE messages ADD COLUMN attachment_size INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_peer ON messages (peer, id)")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                peer TEXT PRIMARY KEY,
+                synced_id INTEGER NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def synced_id(self, peer):
+        row = self.conn.execute("SELECT synced_id FROM sync_state WHERE peer = ?", (peer,)).fetchone()
+        return row[0] if row else 0
+
+    def add_messages(self, peer, messages, synced_id=None):
+        """
+        Stores messages of the chat with peer. Live messages may leave gaps,
+        so only history frames pass synced_id. Returns how many were new.
+        """
+        try:
+            added = self.conn.executemany('''
+                INSERT OR IGNORE INTO messages (id, peer, sender, receiver, message, timestamp, attachment,
+                                                attachment_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(m['id'], peer, m['sender'], m['receiver'], m['message'], m['timestamp'],
+                   m.get('attachment', {}).get('sha256'), m.get('attachment', {}).get('size'))
+                  for m in messages]).rowcount
+            if synced_id is not None:
+                self.conn.execute('''
+                    INSERT INTO sync_state (peer, synced_id) VALUES (?, ?)
+                    ON CONFLICT (peer) DO UPDATE SET synced_id = MAX(synced_id, excluded.synced_id)
+                ''', (peer, synced_id))
+            self.conn.commit()
+            return added
+        except sqlite3.Error as e:
+            print(f"Error caching messages: {e}")
+            return 0
+
+    def has_message(self, message_id):
+        return self.conn.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone() is not None
+
+    def get_messages(self, peer, before_id=None, limit=None):
+        """Keyset paging like DatabaseManager.get_messages, in wire format."""
+        query = "SELECT id, sender, receiver, message, timestamp, attachment, attachment_size FROM messages WHERE peer = ?"
+        params = [peer]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = self.conn.execute(query, params).fetchall()
+        messages = []
+        for row in reversed(rows):
+            message = {"id": row[0], "sender": row[1], "receiver": row[2], "message": row[3], "timestamp": row[4]}
+            if row[5] is not None:
+                message["attachment"] = {"sha256": row[5], "size": row[6]}
+            messages.append(message)
+        return messages
+
+    def close(self):
+        self.conn.close()
+
+
+class Outbox:
+    """
+    Messages the user has sent that the server has not yet confirmed, in
+    the order they were sent, and the id up to which the server has seen
+    this device receive everything.
+    Kept on disk so neither a lost connection nor a restart of the app
+    loses them. Used from the GUI thread and ClientThread alike.
+    """
+
+    def __init__(self, username, cache_dir=CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"outbox_{username}.db")
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_id TEXT UNIQUE NOT NULL,
+                    frame TEXT NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER
+                )
+            ''')
+            self.conn.commit()
+
+    def add(self, message):
+        with self.lock:
+            self.conn.execute("INSERT INTO outbox (client_id, frame) VALUES (?, ?)",
+                              (message['client_id'], json.dumps(message, ensure_ascii=False)))
+            self.conn.commit()
+
+    def remove(self, client_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE client_id = ?", (client_id,))
+            self.conn.commit()
+
+    def pending(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT frame FROM outbox ORDER BY seq").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def last_received(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = 'last_received'").fetchone()
+        return row[0] if row else None
+
+    def set_last_received(self, message_id):
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO state (key, value) VALUES ('last_received', ?)
+                ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)
+            ''', (message_id,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,20 +1,27 @@
 from datetime import datetime
 import re
 import sys
-import os
-import shutil
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
     QPushButton, QMessageBox, QStackedWidget, QFileDialog, QScrollArea,
-    QFrame
+    QFrame, QListWidget, QListWidgetItem
 )
 from PyQt6.QtGui import QPixmap, QFont, QPainter, QBrush, QColor, QPalette
-from PyQt6.QtCore import Qt, QSize, QThread, pyqtSignal
+from PyQt6.QtCore import Qt, QSize, QThread, QTimer, pyqtSignal
 from PyQt6.QtGui import QPainterPath
 from PyQt6.QtGui import QIcon
 
-from database import DatabaseManager, BASE_DIR
+from database import DatabaseManager
 from client import ClientThread
+from chat_view import ChatView, MessageRole
+from avatar_cache import AvatarService, save_variants
+from local_cache import LocalCache
+
+HISTORY_PAGE_SIZE = 50
+# How close (in pixels) the chat must be scrolled to the top before the
+# next older page is loaded.
+HISTORY_LOAD_THRESHOLD = 40
+SEARCH_PAGE_SIZE = 50
 
 class CustomMessageBox(QWidget):
     def __init__(self, parent=None):
@@ -302,17 +309,31 @@ class MainWindow(BaseWindow):
         self.db_manager = db_manager
         self.current_user = current_user
         self.current_chat_partner = None
-        self.displayed_message_ids = set()
+        # Ids of the oldest and newest message on screen. A server process
+        # sends each client its messages in id order, so anything at or
+        # below newest_message_id is already shown (for messages that cross
+        # between workers, see handle_received_message).
+        self.oldest_message_id = None
+        self.newest_message_id = 0
+        self.history_complete = True
+        # 0 keeps the view pinned to the newest message.
+        self.distance_from_bottom = 0
+        # Chats are read from here; the server only sends what is missing.
+        self.local_cache = LocalCache(current_user['id'])
 
         self.client_thread = ClientThread(current_user["username"])
         self.client_thread.message_received.connect(self.handle_received_message)
+        self.client_thread.history_received.connect(self.handle_history)
+        self.client_thread.connected.connect(self.sync_current_chat)
+        self.client_thread.attachment_downloaded.connect(self.on_attachment_downloaded)
+        self.client_thread.avatar_set.connect(self.on_avatar_set)
         self.client_thread.start()
+        self.avatars = AvatarService(self, self.client_thread.fetch_avatar)
         
         self.init_ui()
         self.load_contacts()
 
         self.no_contacts_label = None
-        self.no_messages_label = None
 
     def init_ui(self):
         self.setWindowTitle(f"مسنجر - خوش آمدید {self.current_user['username']}")
@@ -334,7 +355,7 @@ class MainWindow(BaseWindow):
         self.user_profile_pic_label.setFixedSize(50, 50)
         self.user_profile_pic_label.setStyleSheet("border-radius: 25px; background-color: #6272a4;")
         self.user_profile_pic_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.load_profile_picture(self.current_user.get('profile_pic_path'))
+        self.load_profile_picture(self.current_user)
         
         user_name_label = QLabel(self.current_user['username'])
         user_name_label.setFont(QFont("Inter", 14, QFont.Weight.Bold))
@@ -384,6 +405,11 @@ class MainWindow(BaseWindow):
         left_panel_layout.addLayout(user_profile_layout)
         #left_panel_layout.addSeparator()
 
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("جستجو در پیام‌ها...")
+        self.search_input.returnPressed.connect(self.start_search)
+        left_panel_layout.addWidget(self.search_input)
+
         self.contacts_list_widget = QWidget()
         self.contacts_list_layout = QVBoxLayout(self.contacts_list_widget)
         self.contacts_list_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
@@ -419,14 +445,16 @@ class MainWindow(BaseWindow):
         self.chat_partner_label.setStyleSheet("padding-bottom: 10px; border-bottom: 1px solid #6272a4;")
         self.chat_layout.addWidget(self.chat_partner_label)
 
-        self.message_display_area = QScrollArea()
-        self.message_display_area.setWidgetResizable(True)
-        self.message_content_widget = QWidget()
-        self.message_content_layout = QVBoxLayout(self.message_content_widget)
-        self.message_content_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-        self.message_content_layout.setContentsMargins(0, 0, 0, 0)
-        self.message_display_area.setWidget(self.message_content_widget)
-        self.message_display_area.setStyleSheet("border: none;")
+        self.no_messages_label = QLabel("هنوز پیامی در این چت وجود ندارد.")
+        self.no_messages_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.no_messages_label.setStyleSheet("color: #6272a4; padding: 20px;")
+        self.no_messages_label.hide()
+        self.chat_layout.addWidget(self.no_messages_label)
+
+        self.message_display_area = ChatView()
+        self.message_display_area.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled)
+        self.message_display_area.verticalScrollBar().rangeChanged.connect(self.on_chat_range_changed)
+        self.message_display_area.doubleClicked.connect(self.on_message_double_clicked)
         self.chat_layout.addWidget(self.message_display_area)
 
         message_input_layout = QHBoxLayout()
@@ -435,6 +463,12 @@ class MainWindow(BaseWindow):
         self.message_input.returnPressed.connect(self.send_message)
         message_input_layout.addWidget(self.message_input)
 
+        attach_button = QPushButton("📎")
+        attach_button.setFixedSize(40, 40)
+        attach_button.setToolTip("ارسال فایل")
+        attach_button.clicked.connect(self.choose_attachment)
+        message_input_layout.addWidget(attach_button)
+
         send_button = QPushButton("ارسال")
         send_button.setFixedSize(100, 40)
         send_button.clicked.connect(self.send_message)
@@ -481,7 +515,7 @@ class MainWindow(BaseWindow):
         self.profile_pic_display.setFixedSize(120, 120)
         self.profile_pic_display.setStyleSheet("border-radius: 60px; background-color: #6272a4;")
         self.profile_pic_display.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.load_profile_picture_full(self.current_user.get('profile_pic_path'))
+        self.load_profile_picture_full(self.current_user)
         profile_layout.addWidget(self.profile_pic_display, alignment=Qt.AlignmentFlag.AlignCenter)
 
         self.profile_username_label = QLabel(f"نام کاربری: {self.current_user['username']}")
@@ -538,54 +572,35 @@ class MainWindow(BaseWindow):
 
         self.right_panel.addWidget(self.settings_panel)
 
+        self.search_panel = QWidget()
+        search_layout = QVBoxLayout(self.search_panel)
+        search_layout.setContentsMargins(10, 10, 10, 10)
+
+        self.search_title = QLabel("نتایج جستجو")
+        self.search_title.setFont(QFont("Inter", 16, QFont.Weight.Bold))
+        self.search_title.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        search_layout.addWidget(self.search_title)
+
+        self.search_results = QListWidget()
+        self.search_results.setWordWrap(True)
+        self.search_results.setStyleSheet("border: none;")
+        self.search_results.itemClicked.connect(self.open_search_result)
+        self.search_results.verticalScrollBar().valueChanged.connect(self.on_search_scrolled)
+        search_layout.addWidget(self.search_results)
+
+        self.right_panel.addWidget(self.search_panel)
+        self.search_text = ""
+        self.search_oldest_id = None
+        self.search_complete = True
+
 
         self.setLayout(main_layout)
 
-    def load_profile_picture(self, path):
-        if path and os.path.exists(path):
-            pixmap = QPixmap(path)
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(50, 50, Qt.AspectRatioMode.KeepAspectRatioByExpanding, Qt.TransformationMode.SmoothTransformation)
-                
-                
-                circle_pixmap = QPixmap(50, 50)
-                circle_pixmap.fill(Qt.GlobalColor.transparent)
-                painter = QPainter(circle_pixmap)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-                path = QPainterPath()
-                path.addEllipse(0, 0, 50, 50)
-                painter.setClipPath(path)
-                painter.drawPixmap(0, 0, scaled_pixmap)
-                painter.end()
-                
-                self.user_profile_pic_label.setPixmap(circle_pixmap)
-            else:
-                self.user_profile_pic_label.setText("عکس")
-        else:
-            self.user_profile_pic_label.setText("عکس")
-
-    def load_profile_picture_full(self, path):
-        if path and os.path.exists(path):
-            pixmap = QPixmap(path)
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(120, 120, Qt.AspectRatioMode.KeepAspectRatioByExpanding, Qt.TransformationMode.SmoothTransformation)
-                
-                
-                circle_pixmap = QPixmap(120, 120)
-                circle_pixmap.fill(Qt.GlobalColor.transparent)
-                painter = QPainter(circle_pixmap)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-                path = QPainterPath()
-                path.addEllipse(0, 0, 120, 120)
-                painter.setClipPath(path)
-                painter.drawPixmap(0, 0, scaled_pixmap)
-                painter.end()
-                
-                self.profile_pic_display.setPixmap(circle_pixmap)
-            else:
-                self.profile_pic_display.setText("عکس")
-        else:
-            self.profile_pic_display.setText("عکس")
+    def load_profile_picture(self, user):
+        self.avatars.set_avatar(self.user_profile_pic_label, user, 50)
+
+    def load_profile_picture_full(self, user):
+        self.avatars.set_avatar(self.profile_pic_display, user, 120)
 
     def choose_image(self):
         file_path, _ = QFileDialog.getOpenFileName(
@@ -596,28 +611,18 @@ class MainWindow(BaseWindow):
         )
 
         if file_path:
-            profile_pics_dir = os.path.join(BASE_DIR, "profile_pics")
-            os.makedirs(profile_pics_dir, exist_ok=True)
-
-            file_extension = os.path.splitext(file_path)[1]
-            dest_file_name = f"user_{self.current_user['id']}{file_extension}"
-            dest_path = os.path.join(profile_pics_dir, dest_file_name)
-
-            try:
-                shutil.copyfile(file_path, dest_path)
-                self.current_user['profile_pic_path'] = dest_path
-                success, msg = self.db_manager.update_user_info(
-                    self.current_user['id'],
-                    new_profile_pic_path=dest_path
-                )
-                if success:
-                    self.show_message("عکس پروفایل با موفقیت به روز شد!")
-                    self.load_profile_picture(dest_path)
-                    self.load_profile_picture_full(dest_path)
-                else:
-                    self.show_message(f"خطا در به روز رسانی عکس پروفایل در دیتابیس: {msg}")
-            except Exception as e:
-                self.show_message(f"خطا در کپی فایل عکس: {e}")
+            # Scaled here, stored on the server; the server tells us when it is done.
+            variants = save_variants(file_path)
+            if variants is None:
+                self.show_message("فایل تصویر قابل خواندن نیست.")
+                return
+            self.client_thread.upload_avatar(*variants)
+
+    def on_avatar_set(self, avatar):
+        self.current_user['avatar'] = avatar
+        self.show_message("عکس پروفایل با موفقیت به روز شد!")
+        self.load_profile_picture(self.current_user)
+        self.load_profile_picture_full(self.current_user)
 
     def save_settings_changes(self):
         new_username = self.settings_username_input.text().strip()
@@ -665,18 +670,8 @@ class MainWindow(BaseWindow):
                 widget_to_remove.setParent(None)
 
 
-        contacts = []
-        try:
-            # دریافت تمام کاربرانی که با کاربر جاری چت داشته‌اند
-            self.db_manager.cursor.execute("""
-                SELECT DISTINCT u.id, u.username, u.profile_pic_path 
-                FROM users u
-                JOIN messages m ON (u.id = m.sender_id OR u.id = m.receiver_id)
-                WHERE (m.sender_id = ? OR m.receiver_id = ?) AND u.id != ?
-            """, (self.current_user['id'], self.current_user['id'], self.current_user['id']))
-            contacts = [{"id": row[0], "username": row[1], "profile_pic_path": row[2]} for row in self.db_manager.cursor.fetchall()]
-        except Exception as e:
-            print(f"Error fetching contacts: {e}")
+        # کاربرانی که با کاربر جاری چت داشته‌اند، به ترتیب آخرین فعالیت
+        contacts = self.db_manager.get_conversations(self.current_user['id'])
 
         # if not contacts:
         #     no_contacts_label = QLabel("مخاطبی وجود ندارد")
@@ -710,35 +705,33 @@ class MainWindow(BaseWindow):
         contact_pic_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         
         # profile
-        if contact_data.get('profile_pic_path') and os.path.exists(contact_data['profile_pic_path']):
-            pixmap = QPixmap(contact_data['profile_pic_path'])
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(40, 40, Qt.AspectRatioMode.KeepAspectRatioByExpanding, Qt.TransformationMode.SmoothTransformation)
-                
-                circle_pixmap = QPixmap(40, 40)
-                circle_pixmap.fill(Qt.GlobalColor.transparent)
-                painter = QPainter(circle_pixmap)
-                painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-                path = QPainterPath()
-                path.addEllipse(0, 0, 40, 40)
-                painter.setClipPath(path)
-                painter.drawPixmap(0, 0, scaled_pixmap)
-                painter.end()
-                
-                contact_pic_label.setPixmap(circle_pixmap)
-            else:
-                contact_pic_label.setText("عکس")
-        else:
-            contact_pic_label.setText("عکس")
+        self.avatars.set_avatar(contact_pic_label, contact_data, 40)
 
         contact_name_label = QLabel(contact_data['username'])
         contact_name_label.setFont(QFont("Inter", 12, QFont.Weight.Bold))
         contact_name_label.setStyleSheet("color: #f8f8f2;")
 
+        contact_text_layout = QVBoxLayout()
+        contact_text_layout.setSpacing(0)
+        contact_text_layout.addWidget(contact_name_label)
+        if contact_data.get('last_message'):
+            last_message_label = QLabel(contact_data['last_message'].splitlines()[0][:40])
+            last_message_label.setFont(QFont("Inter", 9))
+            last_message_label.setStyleSheet("color: #bfbfbf; padding: 0px;")
+            contact_text_layout.addWidget(last_message_label)
+
         contact_layout.addWidget(contact_pic_label)
-        contact_layout.addWidget(contact_name_label)
+        contact_layout.addLayout(contact_text_layout)
         contact_layout.addStretch()
 
+        if contact_data.get('unread_count'):
+            unread_label = QLabel(str(contact_data['unread_count']))
+            unread_label.setFont(QFont("Inter", 9, QFont.Weight.Bold))
+            unread_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+            unread_label.setMinimumWidth(22)
+            unread_label.setStyleSheet("background-color: #50fa7b; color: #282a36; border-radius: 10px; padding: 2px 6px;")
+            contact_layout.addWidget(unread_label)
+
         contact_frame.mousePressEvent = lambda event, cd=contact_data: self.open_chat(cd)
         self.contacts_list_layout.addWidget(contact_frame)
 
@@ -785,7 +778,7 @@ class MainWindow(BaseWindow):
     def show_profile_panel(self):
         self.profile_username_label.setText(f"نام کاربری: {self.current_user['username']}")
         self.profile_phone_label.setText(f"شماره تلفن: {self.current_user['phone']}")
-        self.load_profile_picture_full(self.current_user.get('profile_pic_path'))
+        self.load_profile_picture_full(self.current_user)
         self.right_panel.setCurrentIndex(3)
 
     def show_settings_panel(self):
@@ -795,6 +788,54 @@ class MainWindow(BaseWindow):
         self.settings_confirm_new_password_input.clear()
         self.right_panel.setCurrentIndex(4)
 
+    def start_search(self):
+        # Clearing scrolls the list, which must not load a page of the old search.
+        self.search_complete = True
+        self.search_results.clear()
+        self.search_text = self.search_input.text().strip()
+        self.search_oldest_id = None
+        if not self.search_text:
+            return
+        self.search_complete = False
+        self.search_title.setText(f"نتایج جستجو برای «{self.search_text}»")
+        self.right_panel.setCurrentIndex(5)
+        self.load_search_results()
+        if not self.search_results.count():
+            self.search_title.setText(f"پیامی با «{self.search_text}» پیدا نشد.")
+
+    def load_search_results(self):
+        if self.search_complete:
+            return
+        results = self.db_manager.search_messages(self.current_user['id'], self.search_text,
+                                                  limit=SEARCH_PAGE_SIZE, before=self.search_oldest_id)
+        self.search_complete = len(results) < SEARCH_PAGE_SIZE
+        if not results:
+            return
+        self.search_oldest_id = results[-1]['id']
+        for result in results:
+            if result['group']:
+                # Group chats have no window yet, so there is nothing to open.
+                peer_id, peer = None, f"{result['group']} ({result['sender']})"
+            elif result['sender_id'] == self.current_user['id']:
+                peer_id, peer = result['receiver_id'], result['receiver']
+            else:
+                peer_id, peer = result['sender_id'], result['sender']
+            item = QListWidgetItem(f"{peer} — {result['timestamp'].split('.')[0]}\n{result['message_text']}")
+            item.setData(Qt.ItemDataRole.UserRole, peer_id)
+            self.search_results.addItem(item)
+
+    def on_search_scrolled(self, value):
+        # Next page once the user is near the end of the results.
+        if value >= self.search_results.verticalScrollBar().maximum() - HISTORY_LOAD_THRESHOLD:
+            self.load_search_results()
+
+    def open_search_result(self, item):
+        if item.data(Qt.ItemDataRole.UserRole) is None:
+            return
+        contact_data = self.db_manager.get_user_info(user_id=item.data(Qt.ItemDataRole.UserRole))
+        if contact_data:
+            self.open_chat(contact_data)
+
     def open_chat(self, contact_data):
         """
         Opens the chat window for the selected contact.
@@ -804,94 +845,159 @@ class MainWindow(BaseWindow):
         self.chat_partner_label.setText(f"چت با {contact_data['username']}")
         self.right_panel.setCurrentIndex(1)
         self.load_chat_history()
+        if contact_data.get('unread_count'):
+            self.db_manager.mark_conversation_read(self.current_user['id'], contact_data['id'])
+            # Not from inside the click handler of the item being replaced.
+            QTimer.singleShot(0, self.load_contacts)
 
     def clear_chat_messages(self):
-        for i in reversed(range(self.message_content_layout.count())):
-            item = self.message_content_layout.itemAt(i)
-            if item.widget():
-                item.widget().deleteLater()
-            elif item.layout():
-                for j in reversed(range(item.layout().count())):
-                    sub_item = item.layout().itemAt(j)
-                    if sub_item.widget():
-                        sub_item.widget().deleteLater()
-                item.layout().deleteLater()
-
+        self.message_display_area.message_model.clear()
+        self.no_messages_label.hide()
 
     def load_chat_history(self):
-        self.displayed_message_ids.clear()
+        self.show_cached_history()
+        self.sync_current_chat()
+
+    def show_cached_history(self):
         self.clear_chat_messages()
+        self.oldest_message_id = None
+        self.newest_message_id = 0
+        self.history_complete = True
+        self.distance_from_bottom = 0
 
         if not self.current_chat_partner:
             return
 
-        messages = self.db_manager.get_messages(self.current_user['id'], self.current_chat_partner['id'])
+        # Only the newest page is shown at first; older pages are loaded
+        # when the user scrolls up (see on_chat_scrolled).
+        messages = self.local_cache.get_messages(self.current_chat_partner['username'], limit=HISTORY_PAGE_SIZE)
 
         if not messages:
-            self.no_messages_label = QLabel("هنوز پیامی در این چت وجود ندارد.")
-            self.no_messages_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            self.no_messages_label.setStyleSheet("color: #6272a4; padding: 20px;")
-            self.message_content_layout.addWidget(self.no_messages_label)
+            self.no_messages_label.show()
         else:
-            for msg in messages:
-                is_sender = (msg['sender_id'] == self.current_user['id'])
-                self.display_message(msg['message_text'], is_sender, msg['timestamp'])
+            self.oldest_message_id = messages[0]['id']
+            self.newest_message_id = messages[-1]['id']
+            self.history_complete = len(messages) < HISTORY_PAGE_SIZE
+            self.prepend_messages(messages)
+
+    def sync_current_chat(self):
+        if self.current_chat_partner:
+            peer = self.current_chat_partner['username']
+            self.client_thread.request_sync(peer, self.local_cache.synced_id(peer))
+
+    def handle_history(self, frame):
+        peer = frame['peer']
+        messages = frame['messages']
+        if not messages:
+            return
+        self.local_cache.add_messages(peer, messages, synced_id=messages[-1]['id'])
+        if frame['more']:
+            self.client_thread.request_sync(peer, messages[-1]['id'])
 
-        self.message_display_area.verticalScrollBar().rangeChanged.connect(
-            lambda min_val, max_val: self.message_display_area.verticalScrollBar().setValue(max_val))
+        if not self.current_chat_partner or self.current_chat_partner['username'] != peer:
+            return
+        if messages[0]['id'] > self.newest_message_id:
+            for msg in messages:
+                is_sender = (msg['sender'] == self.current_user['username'])
+                self.display_message(msg['message'], is_sender, msg['timestamp'], msg['id'], msg.get('attachment'))
+        else:
+            # Fills a gap below what is on screen; redraw from the cache.
+            self.show_cached_history()
 
+    def load_older_messages(self):
+        if self.history_complete or not self.current_chat_partner:
+            return
 
-    def display_message(self, message_text, is_sender, timestamp):
-        message_id = f"{message_text}-{timestamp}"
-        if message_id in self.displayed_message_ids:
-            return  
+        messages = self.local_cache.get_messages(self.current_chat_partner['username'],
+                                                 before_id=self.oldest_message_id, limit=HISTORY_PAGE_SIZE)
+        self.history_complete = len(messages) < HISTORY_PAGE_SIZE
+        if not messages:
+            return
+        self.oldest_message_id = messages[0]['id']
+        self.prepend_messages(messages)
+
+    def prepend_messages(self, messages):
+        # Pages come from below oldest_message_id, so they never overlap
+        # what is on screen.
+        rows = []
+        for msg in messages:
+            is_sender = (msg['sender'] == self.current_user['username'])
+            attachment = msg.get('attachment')
+            rows.append((self.message_text(msg['message'], attachment), is_sender, msg['timestamp'],
+                         attachment and dict(attachment, name=msg['message'])))
+        self.message_display_area.message_model.prepend_messages(rows)
+
+    def on_chat_scrolled(self, value):
+        self.distance_from_bottom = self.message_display_area.verticalScrollBar().maximum() - value
+        if value <= HISTORY_LOAD_THRESHOLD:
+            self.load_older_messages()
+
+    def on_chat_range_changed(self, min_val, max_val):
+        # Content grows above the view when older pages are prepended; keeping
+        # the distance from the bottom keeps the visible messages in place.
+        self.message_display_area.verticalScrollBar().setValue(max_val - self.distance_from_bottom)
+
+
+    def display_message(self, message_text, is_sender, timestamp, server_id=None, attachment=None):
+        if server_id is not None:
+            if server_id <= self.newest_message_id:
+                return
+            self.newest_message_id = server_id
+
+        self.no_messages_label.hide()
+        self.message_display_area.message_model.append_message(
+            self.message_text(message_text, attachment), is_sender, timestamp,
+            attachment and dict(attachment, name=message_text))
+
+    def message_text(self, text, attachment):
+        if not attachment:
+            return text
+        size = attachment['size']
+        for unit in ("B", "KB", "MB"):
+            if size < 1024:
+                break
+            size /= 1024
+        else:
+            unit = "GB"
+        return f"📎 {text} ({size:.3g} {unit})"
 
-        self.displayed_message_ids.add(message_id)
-        message_bubble = QLabel(message_text)
-        message_bubble.setWordWrap(True)
-        message_bubble.setFont(QFont("Inter", 11))
-        message_bubble.setContentsMargins(10, 5, 10, 5)
-        message_bubble.setMinimumWidth(100)
+    def on_message_double_clicked(self, index):
+        message = index.data(MessageRole)
+        if not message or not message.attachment:
+            return
+        destination, _ = QFileDialog.getSaveFileName(self, "ذخیره فایل", message.attachment['name'])
+        if destination:
+            self.client_thread.download_attachment(message.attachment['sha256'], destination)
 
-        if is_sender:
-            message_bubble.setStyleSheet("""
-                background-color: #50fa7b; /* Green for sender */
-                color: #282a36;
-                border-radius: 10px;
-                padding: 8px;
-                margin-left: 50px; /* Align right */
-            """)
-            message_bubble.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-            h_layout = QHBoxLayout()
-            h_layout.addStretch()
-            h_layout.addWidget(message_bubble)
+    def on_attachment_downloaded(self, sha256, path):
+        if path:
+            self.show_message(f"فایل ذخیره شد: {path}")
         else:
-            message_bubble.setStyleSheet("""
-                background-color: #6272a4; /* Purple-ish for receiver */
-                color: #f8f8f2;
-                border-radius: 10px;
-                padding: 8px;
-                margin-right: 50px; /* Align left */
-            """)
-            message_bubble.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
-            h_layout = QHBoxLayout()
-            h_layout.addWidget(message_bubble)
-            h_layout.addStretch()
-        
-        self.message_content_layout.addLayout(h_layout)
+            self.show_message("دریافت فایل ناموفق بود")
 
-        timestamp_label = QLabel(timestamp.split('.')[0])
-        timestamp_label.setFont(QFont("Inter", 8))
-        timestamp_label.setStyleSheet("color: #999999;")
-        if is_sender:
-            timestamp_label.setAlignment(Qt.AlignmentFlag.AlignRight)
-        else:
-            timestamp_label.setAlignment(Qt.AlignmentFlag.AlignLeft)
-        self.message_content_layout.addWidget(timestamp_label)
+    def choose_attachment(self):
+        if not self.current_chat_partner:
+            return
+        file_path, _ = QFileDialog.getOpenFileName(self, "انتخاب فایل", "", "همه فایل‌ها (*)")
+        if file_path:
+            self.client_thread.send_attachment(file_path, self.current_chat_partner['username'])
 
 
     def handle_received_message(self, message_data):
-
+        if message_data.get('group'):
+            # Group chats have no window yet.
+            return
+        added = 0
+        if 'id' in message_data:
+            if message_data['sender'] == self.current_user['username']:
+                peer = message_data['receiver']
+            else:
+                peer = message_data['sender']
+            added = self.local_cache.add_messages(peer, [message_data])
+            if not added and self.local_cache.has_message(message_data['id']):
+                # A message resent after a reconnect comes back with the id
+                # it already had; it is on screen or in the cache.
+                return
 
         if (self.current_chat_partner and 
             ((message_data['sender'] == self.current_chat_partner['username'] and 
@@ -899,8 +1005,14 @@ class MainWindow(BaseWindow):
             (message_data['sender'] == self.current_user['username'] and 
             message_data['receiver'] == self.current_chat_partner['username']))):
             
+            if added and message_data['id'] < self.newest_message_id:
+                # Saved by another server worker before a message already on
+                # screen; redraw so it appears in its place.
+                self.show_cached_history()
+                return
             is_sender = (message_data['sender'] == self.current_user['username'])
-            self.display_message(message_data['message'], is_sender, message_data['timestamp'])
+            self.display_message(message_data['message'], is_sender, message_data['timestamp'],
+                                 message_data.get('id'), message_data.get('attachment'))
 
     def send_message(self):
         message_text = self.message_input.text().strip()
@@ -908,10 +1020,6 @@ class MainWindow(BaseWindow):
             return
         
 
-        if self.no_messages_label:
-            self.no_messages_label.deleteLater()
-            self.no_messages_label = None
-
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.message_input.clear()
         
@@ -923,6 +1031,7 @@ class MainWindow(BaseWindow):
     def closeEvent(self, event):
 
         self.client_thread.stop_client()
+        self.local_cache.close()
         event.accept()
 
 class MessengerApp(QApplication):
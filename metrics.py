@@ -0,0 +1,176 @@
+import bisect
+import os
+import threading
+
+# Upper bounds in seconds, from a fast in-memory hop to a stalled disk.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+# Seconds between two writes of the Prometheus text file.
+METRICS_INTERVAL = 15
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, labels):
+        yield self.name, labels, self.value
+
+
+class Gauge:
+    """A value read only when the metrics are rendered, e.g. a queue size."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self, labels):
+        yield self.name, labels, self.read()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One count per bucket plus one for +Inf; made cumulative on render.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            yield f"{self.name}_bucket", {**labels, 'le': le}, cumulative
+        yield f"{self.name}_sum", labels, total
+        yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """
+    A set of metrics rendered in the Prometheus text format. Recording is a
+    lock and an addition, so it stays on; the text is only built when it is
+    asked for or written out.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.metrics = []
+        self.stop = threading.Event()
+        self.export_thread = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, read):
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples(self.labels):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        # Written next to the target and renamed, so a collector never reads
+        # half a file.
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+    def export(self, path, interval=METRICS_INTERVAL):
+        """Writes the metrics to path every interval seconds until close()."""
+        def run():
+            while not self.stop.wait(interval):
+                self.write_safely(path)
+            self.write_safely(path)
+
+        self.export_thread = threading.Thread(target=run, name="metrics-export", daemon=True)
+        self.export_thread.start()
+
+    def write_safely(self, path):
+        try:
+            self.write_file(path)
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+
+    def close(self):
+        self.stop.set()
+        if self.export_thread is not None:
+            self.export_thread.join()
+
+
+class ServerMetrics(Registry):
+    """What a Server records about its connections and messages."""
+
+    def __init__(self, server, labels=None):
+        super().__init__(labels)
+        self.connections = self.counter("messenger_connections_accepted_total", "Connections accepted.")
+        self.gauge("messenger_clients", "Logged-in clients.", lambda: len(server.clients))
+        self.gauge("messenger_message_queue_depth", "Saved messages waiting to be routed.",
+                   lambda: server.message_queue.qsize())
+        self.gauge("messenger_outbound_queue_depth", "Frames waiting in all outbound queues.",
+                   lambda: sum(server.queue_depths().values()))
+        self.gauge("messenger_outbound_queue_max", "Frames waiting in the fullest outbound queue.",
+                   lambda: max(server.queue_depths().values(), default=0))
+        self.messages = self.counter("messenger_messages_received_total", "Message requests received.")
+        self.save_seconds = self.histogram("messenger_save_seconds",
+                                           "Time from queueing a message to its commit.")
+        # Not until it is written: fan-out shares one payload between many sockets.
+        self.route_seconds = self.histogram("messenger_route_seconds",
+                                            "Time from receiving a message to queueing it for its recipients.")
+        self.bytes_received = self.counter("messenger_bytes_received_total", "Bytes read from clients.")
+        self.bytes_sent = self.counter("messenger_bytes_sent_total", "Bytes written to clients.")
+        self.decode_errors = self.counter("messenger_decode_errors_total",
+                                          "Frames that could not be decoded, and oversized frames.")
+        self.dropped = self.counter("messenger_dropped_frames_total", "Frames dropped for slow consumers.")
+        self.reaped = self.counter("messenger_reaped_connections_total",
+                                   "Connections closed for not logging in or not answering heartbeats.")
+        self.attachment_bytes_received = self.counter("messenger_attachment_bytes_received_total",
+                                                      "Attachment bytes uploaded.")
+        self.attachment_bytes_sent = self.counter("messenger_attachment_bytes_sent_total",
+                                                  "Attachment bytes downloaded.")
+        self.attachments_stored = self.counter("messenger_attachments_stored_total",
+                                               "Attachments uploaded in full; duplicates are not stored again.")
+
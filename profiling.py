@@ -0,0 +1,181 @@
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+PROFILE_DIR = "profiles"
+# Seconds between two samples of every thread's stack.
+SAMPLE_INTERVAL = 0.01
+TRACEMALLOC_FRAMES = 10
+TOP_COUNT = 30
+# Innermost frames of threads that are blocked, not working: waiting on a
+# queue or lock, in recv(), accept() or the event loop's select().
+IDLE_FRAMES = ("wait (threading.py", "recv (protocol.py", "accept (socket.py", "select (selectors.py")
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Wall-clock sampler: every interval it records the stack of each thread
+    of the process, so it sees handler threads, the writer and the event
+    loop alike, including time spent blocked. Nothing is hooked into the
+    interpreter; when it is not running it costs nothing.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # Folded stack ("outer;...;inner") -> samples.
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = time.time()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write(self, path):
+        # One "stack count" line each, the input of flamegraph.pl and speedscope.
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top_frames(self, count):
+        """Innermost functions by samples, leaving out idle threads."""
+        leaves = collections.Counter()
+        for stack, samples in self.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            if not leaf.startswith(IDLE_FRAMES):
+                leaves[leaf] += samples
+        return leaves.most_common(count)
+
+
+def thread_stacks():
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f"--- {names.get(ident, 'unknown')} ({ident})")
+        lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """
+    The admin commands for looking inside a running server:
+
+    profile start [interval_ms] | profile stop
+        stack sampling of all threads, written as folded stacks
+    tracemalloc start [frames] | tracemalloc snapshot | tracemalloc stop
+        allocation tracing; each snapshot is written with its top lines and
+        the growth since the previous one
+    stacks
+        the current stack of every thread
+
+    Results go to files in directory, named after tag and the time.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, tag="server"):
+        self.directory = directory
+        self.tag = tag
+        self.sampler = None
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def commands(self):
+        return {'profile': self.profile, 'tracemalloc': self.tracemalloc, 'stacks': self.stacks}
+
+    def path(self, kind, ext):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now % 1 * 1000):03d}"
+        return os.path.join(self.directory, f"{self.tag}-{kind}-{stamp}.{ext}")
+
+    def profile(self, args):
+        action = args[0] if args else ''
+        with self.lock:
+            if action == 'start':
+                if self.sampler is not None:
+                    return "already profiling\n"
+                interval = float(args[1]) / 1000 if len(args) > 1 else SAMPLE_INTERVAL
+                self.sampler = StackSampler(interval)
+                return f"profiling every {interval * 1000:g} ms\n"
+            if action == 'stop':
+                if self.sampler is None:
+                    return "not profiling\n"
+                sampler, self.sampler = self.sampler, None
+                sampler.stop()
+                path = self.path("profile", "folded")
+                sampler.write(path)
+                lines = [f"{path}: {sampler.samples} samples over {time.time() - sampler.started:.1f} s",
+                         "busy threads, innermost function:"]
+                for frame, count in sampler.top_frames(TOP_COUNT):
+                    lines.append(f"{count:8d}  {frame}")
+                return "\n".join(lines) + "\n"
+        return "usage: profile start [interval_ms] | profile stop\n"
+
+    def tracemalloc(self, args):
+        action = args[0] if args else ''
+        with self.lock:
+            if action == 'start':
+                if tracemalloc.is_tracing():
+                    return "already tracing\n"
+                tracemalloc.start(int(args[1]) if len(args) > 1 else TRACEMALLOC_FRAMES)
+                return "tracing allocations\n"
+            if action == 'snapshot':
+                if not tracemalloc.is_tracing():
+                    return "not tracing\n"
+                return self.write_snapshot()
+            if action == 'stop':
+                tracemalloc.stop()
+                self.snapshot = None
+                return "stopped tracing\n"
+        return "usage: tracemalloc start [frames] | tracemalloc snapshot | tracemalloc stop\n"
+
+    def write_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced: {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB", "", "top lines:"]
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:TOP_COUNT])
+        if self.snapshot is not None:
+            lines.extend(["", "growth since the previous snapshot:"])
+            lines.extend(str(stat) for stat in snapshot.compare_to(self.snapshot, 'lineno')[:TOP_COUNT])
+        self.snapshot = snapshot
+
+        path = self.path("tracemalloc", "txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        # The full snapshot, for tracemalloc.Snapshot.load() later.
+        snapshot.dump(path[:-len(".txt")] + ".snapshot")
+        return f"{path}\n" + "\n".join(lines[:TOP_COUNT // 3]) + "\n"
+
+    def stacks(self, args):
+        text = thread_stacks()
+        path = self.path("stacks", "txt")
+        with open(path, "w") as f:
+            f.write(text)
+        return f"{path}\n{text}"
@@ -0,0 +1,221 @@
+import codecs
+import json
+import re
+import struct
+import zlib
+
+# Every frame is a 4-byte big-endian length followed by a UTF-8 JSON body.
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+# Once negotiated at login, the top bit of the length marks a body that is
+# raw deflate, continuing the stream of the previous compressed frame.
+# Peers that never asked for it read such a length as an oversized frame.
+COMPRESSED = 0x80000000
+COMPRESSION = 'deflate'
+# Smaller bodies are not worth the CPU; a chat message is a few hundred bytes.
+COMPRESSION_THRESHOLD = 1024
+# 8 KB window and small hash tables: about 40 KB per connection, not 300.
+COMPRESSION_WBITS = 13
+COMPRESSION_MEM_LEVEL = 5
+COMPRESSION_LEVEL = 6
+# Every compressed body ends with a sync flush, sent without these 4 bytes.
+SYNC_FLUSH_TAIL = b"\x00\x00\xff\xff"
+
+# Old clients send bare JSON objects. A framed connection can never start
+# with '{' because that would announce a frame of more than 2 GB.
+LEGACY_MARKER = ord('{')
+LEGACY_TOKEN = re.compile(r'["\\{}\[\]]')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_json(data):
+    # Raw UTF-8 instead of \uXXXX escapes, which take 6 bytes for each
+    # Persian letter instead of 2. A lone surrogate cannot be UTF-8; it is
+    # written back as the same escape.
+    return json.dumps(data, ensure_ascii=False).encode('utf-8', 'backslashreplace')
+
+
+def encode_frame(data):
+    body = encode_json(data)
+    return HEADER.pack(len(body)) + body
+
+
+def encode_legacy(data):
+    return encode_json(data)
+
+
+class StreamCodec:
+    """
+    Per-connection protocol state.
+    The framing is detected from the first byte the peer sends, unless it is
+    given up front (clients always speak the framed protocol).
+    """
+
+    def __init__(self, framed=None, metrics=None):
+        self.framed = framed
+        # Optional ServerMetrics for bytes read and undecodable frames.
+        self.metrics = metrics
+        self.buffer = bytearray()
+        self.recv_buffer = None
+        self.text = ""
+        self.scan_pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        # Set by enable_compression(); the zlib streams are made on first use.
+        self.compress_threshold = None
+        self.accept_compressed = False
+        self.compressor = None
+        self.decompressor = None
+
+    @property
+    def protocol(self):
+        return 'framed' if self.framed else 'json'
+
+    def encode(self, data):
+        if self.framed is False:
+            return encode_legacy(data)
+        return encode_frame(data)
+
+    def enable_compression(self, threshold=COMPRESSION_THRESHOLD):
+        self.accept_compressed = True
+        self.compress_threshold = threshold
+
+    def accept_compression(self):
+        """
+        Decompresses frames without compressing any yet. A client offering
+        compression calls this before login: the server's first compressed
+        frame may arrive in the same read as its login_success.
+        """
+        self.accept_compressed = True
+
+    def should_compress(self, frame):
+        return self.compress_threshold is not None and len(frame) - HEADER.size > self.compress_threshold
+
+    def compress_frame(self, frame):
+        """
+        Compresses an encoded frame with this connection's stream. Frames
+        must be sent in the order they were compressed in, and none may be
+        left out.
+        """
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WBITS,
+                                               COMPRESSION_MEM_LEVEL)
+        body = self.compressor.compress(memoryview(frame)[HEADER.size:]) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        body = body[:-len(SYNC_FLUSH_TAIL)]
+        return HEADER.pack(len(body) | COMPRESSED) + body
+
+    def decompress(self, body):
+        if not self.accept_compressed:
+            raise ProtocolError("compressed frame without negotiation")
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-COMPRESSION_WBITS)
+        try:
+            data = self.decompressor.decompress(bytes(body) + SYNC_FLUSH_TAIL, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"bad compressed frame: {e}")
+        if self.decompressor.unconsumed_tail:
+            raise ProtocolError("compressed frame is too large")
+        return data
+
+    def recv(self, sock):
+        """
+        Reads once from a blocking socket into the reusable buffer and returns
+        every complete message, or None when the peer has closed.
+        """
+        if self.recv_buffer is None:
+            self.recv_buffer = bytearray(RECV_SIZE)
+            self.recv_view = memoryview(self.recv_buffer)
+        size = sock.recv_into(self.recv_buffer)
+        if not size:
+            return None
+        return self.feed(self.recv_view[:size])
+
+    def feed(self, data):
+        if self.metrics is not None:
+            self.metrics.bytes_received.inc(len(data))
+        if self.framed is None:
+            if not data:
+                return []
+            self.framed = data[0] != LEGACY_MARKER
+
+        if self.framed:
+            self.buffer += data
+            return self._decode_frames()
+        self.text += self.utf8.decode(bytes(data))
+        return self._decode_legacy()
+
+    def decode_error(self):
+        if self.metrics is not None:
+            self.metrics.decode_errors.inc()
+        print("Bad request")
+
+    def _decode_frames(self):
+        messages = []
+        buffer = self.buffer
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            compressed = length & COMPRESSED
+            length &= ~COMPRESSED
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+            start = offset + HEADER.size
+            end = start + length
+            if end > len(buffer):
+                break
+            body = buffer[start:end]
+            if compressed:
+                body = self.decompress(body)
+            try:
+                messages.append(json.loads(body))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                self.decode_error()
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return messages
+
+    def _decode_legacy(self):
+        # Bare JSON has no length, so track brace depth outside of strings to
+        # find where each top-level object ends.
+        messages = []
+        text = self.text
+        start = 0
+        pos = self.scan_pos
+        while True:
+            match = LEGACY_TOKEN.search(text, pos)
+            if not match:
+                pos = max(pos, len(text))
+                break
+            token = match.group()
+            pos = match.end()
+            if self.in_string:
+                if token == '\\':
+                    pos += 1
+                elif token == '"':
+                    self.in_string = False
+            elif token == '"':
+                self.in_string = True
+            elif token in '{[':
+                self.depth += 1
+            elif token in '}]':
+                self.depth -= 1
+                if self.depth <= 0:
+                    try:
+                        messages.append(json.loads(text[start:pos]))
+                    except json.JSONDecodeError:
+                        self.decode_error()
+                    self.depth = 0
+                    start = pos
+
+        self.text = text[start:]
+        self.scan_pos = pos - start
+        if len(self.text) > MAX_FRAME_SIZE:
+            raise ProtocolError("unterminated JSON message is too large")
+        return messages
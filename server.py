@@ -1,57 +1,201 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
 import socket
+import tempfile
 import threading
-import json
+import time
 from datetime import datetime
-import sqlite3
 from queue import Queue
 
+from admin import AdminServer, worker_path
+from batch_writer import BatchWriter, BATCH_SIZE, BATCH_DELAY
+from bus import RoutingBus
+from connection import ClientConnection, OUTBOUND_QUEUE_SIZE
+from heartbeat import HeartbeatMonitor, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, WHEEL_TICK, set_keepalive
+from attachments import AVATAR_SIZES, MAX_AVATAR_SIZE, SHA256
+from file_server import AttachmentStore, FileServer
+from database import (DatabaseManager, DB_NAME, DURABLE_SYNCHRONOUS, GROUP_RECEIVER_ID, conversation_id,
+                      group_conversation_id, now_ms, read_message)
+from metrics import ServerMetrics, METRICS_INTERVAL
+from profiling import Profiler, PROFILE_DIR
+from protocol import StreamCodec, ProtocolError, COMPRESSION, COMPRESSION_THRESHOLD
+
+# Longest client_id accepted on a message.
+MAX_CLIENT_ID = 64
+# Offline messages sent per replay frame; the next frame follows the ack.
+REPLAY_BATCH_SIZE = 500
+# Messages per history frame; clients ask for the next one while 'more' is set.
+SYNC_CHUNK_SIZE = 1000
+# Delivery cursors are saved in small group commits of their own.
+CURSOR_FLUSH_DELAY = 0.05
+# Fields that must be strings wherever a request has them.
+STRING_FIELDS = ('username', 'receiver', 'group', 'peer', 'message', 'name')
+# Fields a request cannot do without.
+REQUIRED_FIELDS = {'login': ('username',), 'add_member': ('group', 'username')}
+
+
+def valid_request(message):
+    if not isinstance(message, dict) or not isinstance(message.get('type'), str):
+        return False
+    if any(field not in message for field in REQUIRED_FIELDS.get(message['type'], ())):
+        return False
+    return all(isinstance(message[field], str) for field in STRING_FIELDS if field in message)
+
+
 class Server:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, outbound_queue_size=OUTBOUND_QUEUE_SIZE, slow_consumer_policy='disconnect',
+                 batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY, db_path=DB_NAME, worker_id=None, bus_dir=None, worker_count=1,
+                 admin_socket=None, metrics_file=None, metrics_interval=METRICS_INTERVAL, profile_dir=PROFILE_DIR,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 compression_threshold=COMPRESSION_THRESHOLD, file_port=None, attachment_dir=None):
         self.host = host
         self.port = port
+        # Always recorded; read through the admin socket or the metrics file.
+        self.metrics = ServerMetrics(self, None if worker_id is None else {'worker': worker_id})
+        self.connection_options = {'max_queue': outbound_queue_size, 'policy': slow_consumer_policy,
+                                   'metrics': self.metrics}
+        # Bodies above this many bytes are compressed for clients that asked.
+        self.compression_threshold = compression_threshold
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A restarted server binds at once, while the connections of the
+        # last one are still in TIME_WAIT and its clients reconnecting.
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker_id is not None:
+            # Workers listen on the same port; the kernel spreads new
+            # connections over them.
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((self.host, self.port))
         self.server.listen()
         
         self.clients = {}  
         self.message_queue = Queue()
+        # Group name -> (id, member usernames), loaded on first use.
+        self.groups = {}
+        self.heartbeats = HeartbeatMonitor(heartbeat_interval, heartbeat_timeout, self.metrics)
         
-        self.db_conn = sqlite3.connect('messenger.db', check_same_thread=False)
-        self.init_db()
+        # Same database and schema as the GUI's DatabaseManager.
+        self.db = DatabaseManager(db_path)
+        self.writer = BatchWriter(self.db.pool, self.write_messages, batch_size, batch_delay, DURABLE_SYNCHRONOUS)
+        self.cursor_writer = BatchWriter(self.db.pool, self.write_cursors, batch_size, CURSOR_FLUSH_DELAY)
+        # Attachments travel on a port of their own, next to the chat port
+        # unless given; files are kept beside the database.
+        if file_port is None:
+            file_port = self.port + 1 if self.port else 0
+        if attachment_dir is None:
+            attachment_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'attachments')
+        self.file_server = FileServer(self.host, file_port, AttachmentStore(attachment_dir), self.db,
+                                      reuse_port=worker_id is not None, metrics=self.metrics)
+        # Databases from older versions are migrated in the background, by
+        # the first worker only.
+        if not worker_id:
+            threading.Thread(target=self.backfill, name="backfill", daemon=True).start()
+
+        self.worker_id = worker_id
+        self.bus = None
+        if worker_id is not None:
+            self.db.clear_worker_presence(worker_id)
+            self.bus = RoutingBus(bus_dir, worker_id, worker_count, self.receive_routed)
+
+        # Each worker has its own socket and file: admin-1.sock, metrics-1.prom.
+        self.admin = None
+        self.profiler = Profiler(profile_dir, "server" if worker_id is None else f"worker-{worker_id}")
+        if admin_socket:
+            self.admin = AdminServer(worker_path(admin_socket, worker_id), self.admin_commands())
+        if metrics_file:
+            self.metrics.export(worker_path(metrics_file, worker_id), metrics_interval)
         
         print(f" Server running {self.host}:{self.port}...")
-        
-        
-        threading.Thread(target=self.process_message_queue, daemon=True).start()
-
-    def init_db(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                receiver TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        self.db_conn.commit()
-
-    def save_message(self, sender, receiver, message):
+
+    def get_user_id(self, username):
+        return self.db.get_user_id(username)
+
+    def backfill(self):
         try:
-            cursor = self.db_conn.cursor()
+            self.db.backfill_messages()
+            self.db.index_old_messages()
+        finally:
+            self.db.pool.release()
+
+    def write_messages(self, cursor, rows):
+        # One execute per row to learn each id; it is the commit that costs.
+        # Each row gets (id, None), or (id, the stored message) for a resend.
+        results = []
+        for row in rows:
             cursor.execute('''
-                INSERT INTO messages (sender, receiver, message)
-                VALUES (?, ?, ?)
-            ''', (sender, receiver, message))
-            self.db_conn.commit()
-            return True
-        except Exception as e:
-            print(f"{e}")
-            return False
+                INSERT INTO messages (sender_id, receiver_id, message_text, conversation_id, created_at, group_id,
+                                      attachment, client_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            ''', row)
+            if cursor.rowcount:
+                results.append((cursor.lastrowid, None))
+            else:
+                # A client sends a message again when it reconnects before
+                # seeing it echoed back; the first copy is the message.
+                saved = cursor.execute("SELECT id FROM messages WHERE sender_id = ? AND client_id = ?",
+                                       (row[0], row[7])).fetchone()
+                results.append((saved[0], read_message(cursor, saved[0])))
+        self.db.index_new_messages(cursor)
+        return results
+
+    def write_cursors(self, cursor, rows):
+        cursor.executemany('''
+            INSERT INTO delivery_cursors (user_id, last_delivered_id) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_delivered_id = MAX(last_delivered_id, excluded.last_delivered_id)
+        ''', rows)
+
+    def save_message(self, sender_id, receiver_id, message, attachment=None, client_id=None):
+        """
+        Queues the message for the next group commit.
+        Returns a Future that resolves to the message id once the row is durable.
+        """
+        return self.submit_message((sender_id, receiver_id, message, conversation_id(sender_id, receiver_id), now_ms(),
+                                    None, attachment, client_id))
+
+    def save_group_message(self, sender_id, group_id, message, attachment=None, client_id=None):
+        """Like save_message; one row however many members the group has."""
+        return self.submit_message((sender_id, GROUP_RECEIVER_ID, message, group_conversation_id(group_id), now_ms(),
+                                    group_id, attachment, client_id))
+
+    def submit_message(self, row):
+        started = time.perf_counter()
+        saved = self.writer.submit(row)
+        saved.add_done_callback(lambda future: self.metrics.save_seconds.observe(time.perf_counter() - started))
+        return saved
 
-    def broadcast(self, sender, receiver, message):
-        self.save_message(sender, receiver, message)
+    def get_group(self, name):
+        """(id, member usernames) of a group, cached until its membership changes."""
+        group = self.groups.get(name)
+        if group is None:
+            group_id = self.db.get_group_id(name)
+            if group_id is None:
+                return None
+            group = self.groups[name] = (group_id, frozenset(self.db.get_group_members(group_id)))
+        return group
+
+    def group_changed(self, name):
+        self.groups.pop(name, None)
+        if self.bus is not None:
+            self.bus.broadcast({'type': 'group_changed', 'group': name})
+
+    def attachment_data(self, sha256):
+        """The 'attachment' field of a message, or None if the file has not been uploaded."""
+        size = self.db.get_attachment_size(sha256) if isinstance(sha256, str) else None
+        if size is None:
+            return None
+        return {'sha256': sha256, 'size': size}
+
+    def broadcast(self, sender, receiver, message, attachment=None, client_id=None, connection=None):
+        received = time.perf_counter()
+        sender_id = self.get_user_id(sender)
+        receiver_id = self.get_user_id(receiver)
+        if sender_id is None or receiver_id is None:
+            print(f"Unknown user: {sender if sender_id is None else receiver}")
+            return False
 
         message_data = {
             'type': 'message',
@@ -60,76 +204,530 @@ class Server:
             'message': message,
             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
+        if attachment:
+            message_data['attachment'] = attachment
+        if client_id:
+            message_data['client_id'] = client_id
+
+        saved = self.save_message(sender_id, receiver_id, message, attachment and attachment['sha256'], client_id)
+        saved.add_done_callback(lambda future: self.deliver(message_data, future, received, connection))
+        return True
+
+    def broadcast_group(self, sender, group_name, message, attachment=None, client_id=None, connection=None):
+        received = time.perf_counter()
+        group = self.get_group(group_name)
+        if group is None or sender not in group[1]:
+            return False
+
+        message_data = {
+            'type': 'message',
+            'sender': sender,
+            'receiver': None,
+            'group': group_name,
+            'message': message,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if attachment:
+            message_data['attachment'] = attachment
+        if client_id:
+            message_data['client_id'] = client_id
+
+        saved = self.save_group_message(self.get_user_id(sender), group[0], message, attachment and attachment['sha256'],
+                                        client_id)
+        saved.add_done_callback(lambda future: self.deliver(message_data, future, received, connection))
+        return True
+
+    def deliver(self, message_data, saved, received, connection=None):
+        # Runs on the writer thread after the commit: recipients never see a
+        # message that is not on disk yet.
+        if saved.exception() is None:
+            message_data, resent = self.stored_message(message_data, saved.result())
+            if not resent:
+                self.message_queue.put((message_data, received))
+            elif connection is not None:
+                # Everyone else got the first copy; only the device that
+                # sent it again is still waiting for the echo.
+                connection.deliver(message_data)
+
+    def stored_message(self, message_data, result):
+        """
+        The message to deliver, given what write_messages returned for it,
+        and whether it is a resend of one already delivered.
+        """
+        message_id, stored = result
+        if stored is None:
+            message_data['id'] = message_id
+            return message_data, False
+        # The message as it was stored the first time.
+        stored['client_id'] = message_data['client_id']
+        return stored, True
+
+    def route(self, message_data):
+        # Only routes: each frame goes to the recipient's own outbound queue,
+        # so a stalled socket never holds up delivery to anyone else.
+        # payloads keeps the encoded frame, so it is serialized once however
+        # many connections it goes to.
+        payloads = {}
+        if message_data.get('group'):
+            self.fan_out(message_data, payloads)
+            if self.bus is not None:
+                self.bus.broadcast(message_data)
+            return
+        
+        #online
+        elsewhere = []
+        if not self.route_local(message_data, message_data['receiver'], payloads):
+            elsewhere.append(message_data['receiver'])
         
-        self.message_queue.put(message_data)
+        #  own display
+        if message_data['sender'] != message_data['receiver']:
+            if not self.route_local(message_data, message_data['sender'], payloads):
+                elsewhere.append(message_data['sender'])
+
+        if elsewhere and self.bus is not None:
+            self.blocking(lambda: self.find_workers(elsewhere), lambda workers: self.forward(workers, message_data))
+
+    def route_local(self, message_data, username, payloads):
+        """Delivers to username if connected here; returns whether they were."""
+        connection = self.clients.get(username)
+        if connection:
+            if not connection.deliver(message_data, payloads):
+                print(f"ارسال پیام به {username} ناموفق بود")
+            return True
+        return False
+
+    def forward(self, workers, message_data):
+        for worker in workers:
+            self.bus.send(worker, message_data)
+
+    def find_workers(self, usernames):
+        """The other workers these users are connected to; none for users who are offline."""
+        workers = set()
+        for username in usernames:
+            worker = self.db.get_presence(username)
+            if worker is not None and worker != self.worker_id:
+                workers.add(worker)
+        return workers
+
+    def fan_out(self, message_data, payloads):
+        """Delivers a group message to the members connected here."""
+        group = self.get_group(message_data['group'])
+        if group is None:
+            return
+        members = group[1]
+        # Walks the members or the connected users, whichever is fewer.
+        if len(self.clients) < len(members):
+            targets = [(username, connection) for username, connection in list(self.clients.items())
+                       if username in members]
+        else:
+            targets = [(username, self.clients.get(username)) for username in members]
+        for username, connection in targets:
+            if connection and not connection.deliver(message_data, payloads):
+                print(f"ارسال پیام به {username} ناموفق بود")
+
+    def receive_routed(self, message_data):
+        # A message another worker saved for a user connected here; called
+        # on a bus thread.
+        if message_data['type'] == 'group_changed':
+            self.groups.pop(message_data['group'], None)
+            return
+        payloads = {}
+        if message_data.get('group'):
+            self.fan_out(message_data, payloads)
+            return
+        for username in {message_data['receiver'], message_data['sender']}:
+            connection = self.clients.get(username)
+            if connection and not connection.deliver(message_data, payloads):
+                print(f"ارسال پیام به {username} ناموفق بود")
 
     def process_message_queue(self):
         while True:
-            message_data = self.message_queue.get()
-            
-            #online
-            if message_data['receiver'] in self.clients:
-                receiver_socket = self.clients[message_data['receiver']]['socket']
-                try:
-                    receiver_socket.send(json.dumps(message_data).encode('utf-8'))
-                except:
-                    print(f"ارسال پیام به {message_data['receiver']} ناموفق بود")
+            message_data, received = self.message_queue.get()
+            self.route(message_data)
+            self.metrics.route_seconds.observe(time.perf_counter() - received)
+            self.message_queue.task_done()
+
+    def queue_depths(self):
+        return {username: connection.queue_depth() for username, connection in list(self.clients.items())}
+
+    def admin_commands(self):
+        # Run on the admin thread, so they answer even while the handlers
+        # or the event loop are stuck.
+        return {
+            **self.profiler.commands(),
+            'metrics': lambda args: self.metrics.render(),
+            'queues': lambda args: json.dumps(self.queue_depths(), ensure_ascii=False) + "\n",
+        }
+
+    def handle_request(self, connection, message):
+        # Shared by both engines; nothing in here blocks on the network, and
+        # disk access is limited to indexed reads.
+        if not valid_request(message):
+            # Well-formed JSON, but not a request: counted like a bad frame.
+            self.metrics.decode_errors.inc()
+            connection.send({'type': 'error', 'message': 'درخواست نامعتبر است'})
+            return
+        if message['type'] == 'login':
+            user_id = self.get_user_id(message['username'])
+            if user_id is None:
+                connection.send({'type': 'login_failed', 'message': 'کاربر یافت نشد'})
+                return
+            connection.username = message['username']
+            connection.user_id = user_id
+            connection.heartbeat = bool(message.get('heartbeat'))
+            if self.bus is not None:
+                # Before the replay reads the inbox: a message saved after
+                # this is routed here, and one saved before is replayed.
+                username = connection.username
+                self.blocking(lambda: self.db.set_presence(username, self.worker_id))
+            # Clients that acknowledge messages get what they missed first;
+            # older clients only see live messages.
+            if message.get('replay'):
+                connection.replaying = True
+                # A client that keeps what it received says where it stopped;
+                # with several devices that may be before the shared cursor.
+                last_id = message.get('last_id')
+                if isinstance(last_id, int) and last_id >= 0:
+                    connection.replay_position = last_id
+                else:
+                    connection.replay_position = self.db.get_delivery_cursor(user_id)
+                connection.acked_position = connection.replay_position
+            self.clients[connection.username] = connection
+            print(f"{connection.username} Connected!")
             
-            #  own display
-            if message_data['sender'] in self.clients:
-                sender_socket = self.clients[message_data['sender']]['socket']
-                try:
-                    sender_socket.send(json.dumps(message_data).encode('utf-8'))
-                except:
-                    print(f"ارسال پیام به {message_data['sender']} ناموفق بود")
+            response = {'type': 'login_success', 'message': 'با موفقیت وارد شدید', 'protocol': connection.codec.protocol,
+                        'groups': [group['name'] for group in self.db.get_user_groups(user_id)],
+                        'file_port': self.file_server.port}
+            compress = connection.codec.framed and isinstance(message.get('compression'), list) \
+                and COMPRESSION in message['compression']
+            if compress:
+                response['compression'] = COMPRESSION
+            connection.send(response)
+            # Only frames after login_success may be compressed.
+            if compress:
+                connection.codec.enable_compression(self.compression_threshold)
+            if connection.replaying:
+                self.send_replay_batch(connection)
+
+        elif message['type'] == 'ack':
+            if connection.user_id is not None and isinstance(message.get('id'), int):
+                self.acknowledge(connection, message['id'])
+                if connection.replaying and message['id'] >= connection.replay_position:
+                    self.send_replay_batch(connection)
             
-            self.message_queue.task_done()
+        elif message['type'] == 'sync':
+            if connection.user_id is not None and isinstance(message.get('after_id'), int) and 'group' in message:
+                group = self.get_group(message['group'])
+                if group is None or connection.username not in group[1]:
+                    connection.send({'type': 'error', 'message': 'گروه یافت نشد'})
+                    return
+                self.blocking(lambda: self.db.get_group_messages_after(group[0], message['after_id'], SYNC_CHUNK_SIZE),
+                              lambda messages: connection.send({'type': 'history', 'group': message['group'],
+                                                                'after_id': message['after_id'], 'messages': messages,
+                                                                'more': len(messages) == SYNC_CHUNK_SIZE}))
+            elif connection.user_id is not None and isinstance(message.get('after_id'), int):
+                peer_id = self.get_user_id(message.get('peer'))
+                if peer_id is None:
+                    connection.send({'type': 'error', 'message': 'کاربر یافت نشد'})
+                    return
+                user_id = connection.user_id
+                self.blocking(lambda: self.db.get_messages_after(user_id, peer_id, message['after_id'], SYNC_CHUNK_SIZE),
+                              lambda messages: connection.send({'type': 'history', 'peer': message['peer'],
+                                                                'after_id': message['after_id'], 'messages': messages,
+                                                                'more': len(messages) == SYNC_CHUNK_SIZE}))
+
+        elif message['type'] == 'message':
+            self.metrics.messages.inc()
+            # Set by clients that resend unconfirmed messages after a reconnect.
+            client_id = message.get('client_id')
+            if client_id is not None and (not isinstance(client_id, str) or not 0 < len(client_id) <= MAX_CLIENT_ID):
+                self.reject_message(connection, message, 'پیام نامعتبر است')
+                return
+            attachment = None
+            if 'attachment' in message:
+                # Uploaded on the file port first; the message only refers to it.
+                attachment = self.attachment_data(message['attachment'])
+                if attachment is None:
+                    self.reject_message(connection, message, 'فایل یافت نشد')
+                    return
+            if connection.username and 'group' in message and 'message' in message:
+                if not self.broadcast_group(connection.username, message['group'], message['message'], attachment,
+                                            client_id, connection):
+                    self.reject_message(connection, message, 'گروه یافت نشد')
+            elif connection.username and 'receiver' in message and 'message' in message:
+                if not self.broadcast(connection.username, message['receiver'], message['message'], attachment,
+                                      client_id, connection):
+                    self.reject_message(connection, message, 'گیرنده یافت نشد')
+
+        elif message['type'] == 'set_avatar':
+            # The scaled pictures are uploaded on the file port first.
+            if connection.user_id is not None:
+                avatar, variants = message.get('avatar'), message.get('variants')
+                if not isinstance(avatar, str) or not SHA256.fullmatch(avatar) or not isinstance(variants, dict) \
+                        or sorted(variants) != sorted(str(size) for size in AVATAR_SIZES):
+                    connection.send({'type': 'error', 'message': 'عکس پروفایل نامعتبر است'})
+                    return
+                for sha256 in variants.values():
+                    # Like a download: only files this user uploaded or was sent.
+                    size = self.db.get_attachment_size(sha256) if isinstance(sha256, str) else None
+                    if size is None or size > MAX_AVATAR_SIZE \
+                            or not self.db.can_read_attachment(connection.user_id, sha256):
+                        connection.send({'type': 'error', 'message': 'عکس پروفایل نامعتبر است'})
+                        return
+                user_id = connection.user_id
+                self.blocking(lambda: self.db.set_avatar(user_id, avatar,
+                                                         {int(size): sha256 for size, sha256 in variants.items()}),
+                              lambda result: connection.send({'type': 'avatar_set', 'avatar': avatar}))
+
+        elif message['type'] == 'create_group':
+            members = message.get('members', [])
+            if not isinstance(members, list) or not all(isinstance(username, str) for username in members):
+                connection.send({'type': 'error', 'message': 'درخواست نامعتبر است'})
+                return
+            if connection.user_id is not None and message.get('name'):
+                owner_id = connection.user_id
+                self.blocking(lambda: self.create_group(message['name'], owner_id, members), connection.send)
+
+        elif message['type'] in ('add_member', 'leave_group'):
+            if connection.user_id is not None:
+                group = self.get_group(message.get('group'))
+                if group is None:
+                    connection.send({'type': 'error', 'message': 'گروه یافت نشد'})
+                    return
+                if message['type'] == 'add_member':
+                    # Groups are invite-only: a member adds others, nobody adds themselves.
+                    if connection.username not in group[1]:
+                        connection.send({'type': 'error', 'message': 'شما عضو این گروه نیستید'})
+                        return
+                    user_id = self.get_user_id(message['username'])
+                    if user_id is None:
+                        connection.send({'type': 'error', 'message': 'کاربر یافت نشد'})
+                        return
+                    change = lambda: self.db.add_group_member(group[0], user_id)
+                    reply = {'type': 'member_added', 'group': message['group'], 'username': message['username']}
+                else:
+                    user_id = connection.user_id
+                    change = lambda: self.db.remove_group_member(group[0], user_id)
+                    reply = {'type': 'group_left', 'group': message['group']}
+
+                def changed(result):
+                    self.group_changed(message['group'])
+                    connection.send(reply)
+
+                self.blocking(change, changed)
+
+    def create_group(self, name, owner_id, members):
+        """Creates the group and returns the reply to send; writes to the database."""
+        member_ids = [self.get_user_id(username) for username in members]
+        if None in member_ids:
+            return {'type': 'error', 'message': 'کاربر یافت نشد'}
+        if self.db.create_group(name, owner_id, member_ids) is None:
+            return {'type': 'error', 'message': 'این نام گروه قبلاً استفاده شده است'}
+        return {'type': 'group_created', 'group': name, 'members': sorted(self.get_group(name)[1])}
+
+    def reject_message(self, connection, message, text):
+        # The client_id tells the client which queued message was refused.
+        reply = {'type': 'error', 'message': text}
+        if isinstance(message.get('client_id'), str):
+            reply['client_id'] = message['client_id']
+        connection.send(reply)
+
+    def blocking(self, work, done=None):
+        """
+        Runs work(), which may wait on disk, then done(result) where the
+        connections may be sent to. Handler threads can simply wait;
+        AsyncServer moves work off the event loop.
+        """
+        result = work()
+        if done is not None:
+            done(result)
+
+    def send_replay_batch(self, connection):
+        position = connection.replay_position
+
+        def send(messages):
+            if connection.closed or not connection.replaying or connection.replay_position != position:
+                return
+            if messages:
+                connection.replay_position = messages[-1]['id']
+                connection.send_messages({'type': 'replay', 'messages': messages,
+                                          'more': len(messages) == REPLAY_BATCH_SIZE},
+                                         [replayed['id'] for replayed in messages])
+            if len(messages) < REPLAY_BATCH_SIZE:
+                connection.finish_replay()
+
+        self.blocking(lambda: self.db.get_undelivered_messages(connection.user_id, position, REPLAY_BATCH_SIZE), send)
+
+    def acknowledge(self, connection, message_id):
+        """
+        Moves the delivery cursor over what the client has received without
+        a gap. Ids are not delivered in order: with several workers, message
+        N+1 can be committed and delivered here while N is still on its way
+        over the bus, and acking N+1 must not skip N. So the cursor only
+        passes an id of the user's inbox once that message itself was acked.
+        The client is told the new position, to resume from next time.
+        """
+        connection.confirm(message_id)
+        start = connection.acked_position
+        # Acking a late message can close the gap below ones acked before.
+        up_to = max(message_id, max(connection.received, default=0))
+        if up_to <= start:
+            return
+
+        def advance(inbox):
+            if inbox is None:
+                return
+            position = connection.acked_position
+            for inbox_id in inbox:
+                if inbox_id <= position:
+                    continue
+                if inbox_id not in connection.received:
+                    position = max(position, inbox_id - 1)
+                    break
+                position = inbox_id
+            else:
+                position = max(position, up_to)
+            if position <= connection.acked_position:
+                return
+            connection.acked_position = position
+            connection.received = {received for received in connection.received if received > position}
+            self.cursor_writer.submit((connection.user_id, position))
+            connection.send({'type': 'acked', 'id': position})
+
+        user_id = connection.user_id
+        self.blocking(lambda: self.db.get_inbox_ids(user_id, start, up_to), advance)
+
+    def disconnect(self, connection):
+        connection.close()
+        username = connection.username
+        if username and self.clients.get(username) is connection:
+            del self.clients[username]
+            if self.bus is not None:
+                self.blocking(lambda: self.db.clear_presence(username, self.worker_id))
+            print(f"{username} disconnected!")
+
+    def check_heartbeats(self):
+        while True:
+            time.sleep(WHEEL_TICK)
+            self.heartbeats.check()
 
     def handle_client(self, client_socket, address):
-        username = None
+        self.metrics.connections.inc()
+        set_keepalive(client_socket, self.heartbeats.interval, self.heartbeats.timeout)
+        connection = ClientConnection(client_socket, address, StreamCodec(metrics=self.metrics), **self.connection_options)
+        self.heartbeats.watch(connection)
         try:
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
+                messages = connection.codec.recv(client_socket)
+                if messages is None:
                     break
+                connection.last_activity = time.monotonic()
                 
-                try:
-                    message = json.loads(data)
-                    
-                    if message['type'] == 'login':
-                        username = message['username']
-                        self.clients[username] = {'socket': client_socket, 'address': address}
-                        print(f"{username} Connected!")
-                        
-                        response = {'type': 'login_success', 'message': 'با موفقیت وارد شدید'}
-                        client_socket.send(json.dumps(response).encode('utf-8'))
-                        
-                    elif message['type'] == 'message':
-                        if username and 'receiver' in message and 'message' in message:
-                            self.broadcast(username, message['receiver'], message['message'])
-                    
-                except json.JSONDecodeError:
-                    print("Bad request")
+                for message in messages:
+                    self.handle_request(connection, message)
                     
+        except ProtocolError as e:
+            self.metrics.decode_errors.inc()
+            print(f"Bad request: {e}")
         except ConnectionResetError:
             print("Error")
         finally:
-            if username and username in self.clients:
-                del self.clients[username]
-                print(f"{username} disconnected!")
+            self.disconnect(connection)
+            self.db.pool.release()
             client_socket.close()
 
     def run(self):
+        threading.Thread(target=self.process_message_queue, name="process_message_queue", daemon=True).start()
+        threading.Thread(target=self.check_heartbeats, name="heartbeats", daemon=True).start()
         try:
             while True:
                 client_socket, address = self.server.accept()
-                thread = threading.Thread(target=self.handle_client, args=(client_socket, address))
+                thread = threading.Thread(target=self.handle_client, args=(client_socket, address),
+                                          name=f"handle_client {address[0]}:{address[1]}")
                 thread.start()
         except KeyboardInterrupt:
             print("Server is off")
-            self.server.close()
-            self.db_conn.close()
+            self.shutdown()
+
+    def shutdown(self):
+        self.server.close()
+        self.file_server.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.admin is not None:
+            self.admin.close()
+        self.writer.close()
+        self.cursor_writer.close()
+        # After the writers, so the last file has every saved message.
+        self.metrics.close()
+        self.db.close()
+
+
+def run_worker(worker_id, worker_count, bus_dir, use_asyncio, options):
+    if use_asyncio:
+        from async_server import AsyncServer
+        server = AsyncServer(worker_id=worker_id, bus_dir=bus_dir, worker_count=worker_count, **options)
+    else:
+        server = Server(worker_id=worker_id, bus_dir=bus_dir, worker_count=worker_count, **options)
+    server.run()
+
+
+def run_workers(count, use_asyncio=False, **options):
+    """
+    Runs count server processes on one port, so message handling is not
+    limited to the one core a Python process can use. Users are looked up in
+    the presence table and messages cross between workers on a RoutingBus.
+    """
+    # Create or migrate the schema once, not in every worker at the same time.
+    DatabaseManager(options.get('db_path', DB_NAME)).close()
+    bus_dir = tempfile.mkdtemp(prefix="messenger-bus-")
+    workers = [multiprocessing.Process(target=run_worker, args=(worker_id, count, bus_dir, use_asyncio, options),
+                                       name=f"worker-{worker_id}")
+               for worker_id in range(count)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; wait for them to shut down.
+        for worker in workers:
+            worker.join()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
 
 if __name__ == "__main__":
-    server = Server()
-    server.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Messenger server.")
+    parser.add_argument("--asyncio", action="store_true", help="serve all connections from one event loop")
+    parser.add_argument("--workers", type=int, default=1, help="number of server processes sharing the port")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--db", default=DB_NAME)
+    parser.add_argument("--admin-socket", help="unix socket for admin.py, e.g. messenger-admin.sock")
+    parser.add_argument("--metrics-file", help="Prometheus text file rewritten every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL)
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="where admin.py profile/tracemalloc/stacks write")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="idle seconds before a client is sent a heartbeat")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="seconds to answer a heartbeat before being disconnected")
+    parser.add_argument("--compression-threshold", type=int, default=COMPRESSION_THRESHOLD,
+                        help="smallest frame body, in bytes, compressed for clients that support it")
+    parser.add_argument("--file-port", type=int, help="port for attachment transfers (default: --port + 1)")
+    parser.add_argument("--attachment-dir", help="where attachments are stored (default: beside the database)")
+    args = parser.parse_args()
+
+    options = {'port': args.port, 'db_path': args.db, 'admin_socket': args.admin_socket,
+               'metrics_file': args.metrics_file, 'metrics_interval': args.metrics_interval,
+               'profile_dir': args.profile_dir, 'heartbeat_interval': args.heartbeat_interval,
+               'heartbeat_timeout': args.heartbeat_timeout, 'compression_threshold': args.compression_threshold,
+               'file_port': args.file_port, 'attachment_dir': args.attachment_dir}
+    if args.workers > 1:
+        run_workers(args.workers, args.asyncio, **options)
+    else:
+        if args.asyncio:
+            from async_server import AsyncServer
+            server = AsyncServer(**options)
+        else:
+            server = Server(**options)
+        server.run()
\ No newline at end of file
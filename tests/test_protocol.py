@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import StreamCodec, ProtocolError, encode_frame
+
+
+def replay_frame(server):
+    messages = [{'type': 'message', 'id': i, 'sender': 'ali', 'receiver': 'sara', 'message': 'سلام ' * 20}
+                for i in range(1, 51)]
+    frame = encode_frame({'type': 'replay', 'messages': messages, 'more': False})
+    assert server.should_compress(frame)
+    return server.compress_frame(frame)
+
+
+class CompressionNegotiationTest(unittest.TestCase):
+    def setUp(self):
+        # The server enables compression right after encoding login_success.
+        self.server = StreamCodec(framed=True)
+        login_success = encode_frame({'type': 'login_success', 'compression': 'deflate'})
+        self.server.enable_compression()
+        self.data = login_success + replay_frame(self.server)
+
+    def test_login_success_and_compressed_replay_in_one_read(self):
+        client = StreamCodec(framed=True)
+        client.accept_compression()
+        messages = client.feed(memoryview(self.data))
+        self.assertEqual([message['type'] for message in messages], ['login_success', 'replay'])
+        self.assertEqual(len(messages[1]['messages']), 50)
+
+    def test_compressed_frame_without_offer(self):
+        client = StreamCodec(framed=True)
+        with self.assertRaises(ProtocolError):
+            client.feed(memoryview(self.data))
+
+    def test_accepting_does_not_compress(self):
+        client = StreamCodec(framed=True)
+        client.accept_compression()
+        self.assertFalse(client.should_compress(encode_frame({'type': 'message', 'message': 'x' * 5000})))
+
+
+if __name__ == '__main__':
+    unittest.main()